@@ -1,95 +1,266 @@
-# -*- coding: utf-8 -*-
-import os
-import ast
-import pandas as pd
-
-IN_PATH = r"D:\2025_26 Spring\Replication\Q&A.xls"
-
-base_dir = os.path.dirname(IN_PATH)
-OUT_XLSX = os.path.join(base_dir, "Q&A_with_nonanswer.xlsx")
-OUT_CSV  = os.path.join(base_dir, "Q&A_with_nonanswer.csv")
-
-from ling_features import non_answers, get_regexes_df
-
-regexes_df = get_regexes_df()
-
-def regex_id_to_category(rid: int):
-    
-    try:
-        return str(regexes_df.loc[rid, "category"])
-    except Exception:
-        pass
-    
-    if "regex_id" in regexes_df.columns:
-        m = regexes_df.loc[regexes_df["regex_id"] == rid, "category"]
-        if len(m) > 0:
-            return str(m.iloc[0])
-    return None
-
-def extract_regex_id(item):
-    if item is None:
-        return None
-    if isinstance(item, dict):
-        return item.get("regex_id", None)
-    if isinstance(item, str):
-        try:
-            d = ast.literal_eval(item.strip())
-            if isinstance(d, dict):
-                return d.get("regex_id", None)
-        except Exception:
-            return None
-    return getattr(item, "regex_id", None)
-
-def classify_answer(ans_text, types=("REFUSE", "UNABLE", "AFTERCALL")):
-    if ans_text is None or (isinstance(ans_text, float) and pd.isna(ans_text)):
-        return {"is_nonans": False, "is_refuse": False, "is_unable": False, "is_aftercall": False}
-
-    ans = str(ans_text).strip()
-    if ans == "":
-        return {"is_nonans": False, "is_refuse": False, "is_unable": False, "is_aftercall": False}
-
-    res = non_answers([ans]) or []
-    cats = []
-    for item in res:
-        rid = extract_regex_id(item)
-        if rid is None:
-            continue
-        cat = regex_id_to_category(rid)
-        if cat is not None:
-            cats.append(cat)
-
-    s = set(cats)
-    is_refuse = "REFUSE" in s
-    is_unable = "UNABLE" in s
-    is_aftercall = "AFTERCALL" in s
-    is_nonans = len(s.intersection(set(types))) > 0
-
-    return {
-        "is_nonans": is_nonans,
-        "is_refuse": is_refuse,
-        "is_unable": is_unable,
-        "is_aftercall": is_aftercall,
-    }
-
-def main():
-   
-    df = pd.read_excel(IN_PATH, engine="openpyxl")
-
-    
-    if "answer" not in df.columns:
-        raise ValueError(f"can not find 'answer'。column name：{list(df.columns)}")
-
-    res = df["answer"].apply(classify_answer)
-    out = pd.concat([df.reset_index(drop=True), pd.json_normalize(res)], axis=1)
-    out["non_answer"] = out["is_nonans"].astype(int)
-
-    
-    out.to_excel(OUT_XLSX, index=False)
-    out.to_csv(OUT_CSV, index=False, encoding="utf-8-sig")
-
-    print("Saved:", OUT_XLSX)
-    print("Saved:", OUT_CSV)
-    print("Non-answer rate:", out["non_answer"].mean())
-
-if __name__ == "__main__":
-    main()
+# -*- coding: utf-8 -*-
+import os
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+IN_PATH = r"D:\2025_26 Spring\Replication\Q&A.xls"
+
+base_dir = os.path.dirname(IN_PATH)
+OUT_XLSX = os.path.join(base_dir, "Q&A_with_nonanswer.xlsx")
+OUT_CSV  = os.path.join(base_dir, "Q&A_with_nonanswer.csv")
+OUT_PARQUET = os.path.join(base_dir, "Q&A_with_nonanswer.parquet")  # read by the Spark scripts
+OUT_CLUSTERS = os.path.join(base_dir, "Q&A_with_nonanswer.clusters.parquet")  # --dedup cluster membership
+
+from nonanswer_regex import build_matcher, check_matcher, classify_answers
+from qa_io import read_table, write_table, iter_dataset, apply_filters
+from qa_dataset import add_filter_args, filters_from_args, sliced_path
+from qa_dedup import dedup_clusters, cluster_table
+
+# random rows re-checked with the per-row non_answers() path before anything is classified (in
+# --stream mode drawn from the whole input in a first pass over the answer column; 0 = off);
+# any difference switches the run to non_answers() for every row
+VERIFY_SAMPLE = 1000
+VERIFY_SEED = 0
+
+
+# The combined matcher (nonanswer_regex.build_matcher) is built from the patterns ling_features
+# compiled itself; classify_answers(answers, None) is the per-row non_answers() path.
+def checked_matcher(answers, matcher, seed: int = VERIFY_SEED):
+    """matcher if it agrees with non_answers() on VERIFY_SAMPLE random rows, else None."""
+    if matcher is None:
+        print("[CHECK] no compiled patterns from ling_features -> non_answers() per row")
+        return None
+    diff = check_matcher(answers, matcher, VERIFY_SAMPLE, seed)
+    if diff is not None:
+        n_bad, n, first = diff
+        print(f"[CHECK] combined matcher disagrees with non_answers() on {n_bad}/{n} random rows "
+              f"(first row={first}) -> non_answers() per row")
+        return None
+    if VERIFY_SAMPLE > 0:
+        print(f"[CHECK] combined matcher == non_answers() on {min(VERIFY_SAMPLE, len(answers))} random rows")
+    return matcher
+
+
+# Multi-core mode: each worker compiles the matcher once, then classifies whole
+# chunks; ex.map keeps chunks in submission order. fast=False: non_answers() per row.
+_WORKER_MATCHER = None
+
+
+def _classify_chunk(answers, fast: bool = True):
+    global _WORKER_MATCHER
+    if fast and _WORKER_MATCHER is None:
+        _WORKER_MATCHER = build_matcher()
+    return classify_answers(answers, _WORKER_MATCHER if fast else None)
+
+
+def classify_answers_parallel(answers, matcher, workers: int, chunk_size: int = 5000) -> pd.DataFrame:
+    answers = list(answers)
+    if workers <= 1 or len(answers) <= chunk_size:
+        return classify_answers(answers, matcher)
+
+    chunks = [answers[i:i + chunk_size] for i in range(0, len(answers), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        parts = list(ex.map(_classify_chunk, chunks, [matcher is not None] * len(chunks)))
+    return pd.concat(parts, ignore_index=True)
+
+
+# Streaming mode: read CSV/Parquet in fixed-size chunks, classify, append.
+# Peak memory is a few chunks regardless of corpus size.
+def iter_input_chunks(path: str, chunk_rows: int, filters=None, columns=None):
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path) or (filters and ext == ".parquet"):
+        # partitioned dataset (qa_dataset.py) / filtered file: matching partitions only
+        yield from iter_dataset(path, chunk_rows, columns=columns, filters=filters)
+    elif ext == ".csv":
+        # filter columns are read too, then dropped
+        usecols = None if columns is None else set(columns) | set(filters or {})
+        for chunk in pd.read_csv(path, chunksize=chunk_rows, encoding="utf-8-sig",
+                                 usecols=None if usecols is None else (lambda c: c in usecols)):
+            chunk = apply_filters(chunk, filters) if filters else chunk
+            yield chunk if columns is None else chunk[[c for c in chunk.columns if c in columns]]
+    elif ext == ".parquet":
+        import pyarrow.parquet as pq  # pip install pyarrow
+        pf = pq.ParquetFile(path, memory_map=True)
+        for batch in pf.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"streaming mode reads .csv, .parquet or a dataset directory, got：{path}")
+
+
+class ChunkAppender:
+    """Append classified chunks to one .csv or .parquet file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ext = os.path.splitext(path)[1].lower()
+        if self.ext not in (".csv", ".parquet"):
+            raise ValueError(f"streaming output must be .csv or .parquet, got：{path}")
+        self._writer = None
+        self._first = True
+
+    def write(self, chunk: pd.DataFrame):
+        if self.ext == ".csv":
+            chunk.to_csv(
+                self.path,
+                index=False,
+                mode="w" if self._first else "a",
+                header=self._first,
+                encoding="utf-8-sig" if self._first else "utf-8",
+            )
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        self._first = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def _attach_labels(chunk: pd.DataFrame, res: pd.DataFrame) -> pd.DataFrame:
+    out = pd.concat([chunk.reset_index(drop=True), res], axis=1)
+    out["non_answer"] = out["is_nonans"].astype(int)
+    return out
+
+
+def sample_answers(args, sample: int, seed: int = VERIFY_SEED) -> list:
+    """`sample` answers drawn uniformly from the whole (filtered) input: smallest random keys win."""
+    rng = np.random.default_rng(seed)
+    kept, keys = [], np.empty(0)
+    for chunk in iter_input_chunks(args.input, args.chunk_rows, filters_from_args(args), columns=["answer"]):
+        if "answer" not in chunk.columns:
+            raise ValueError(f"can not find 'answer'。column name：{list(chunk.columns)}")
+        kept += chunk["answer"].tolist()
+        keys = np.concatenate([keys, rng.random(len(chunk))])
+        if len(kept) > sample:
+            top = np.argpartition(keys, sample)[:sample]
+            kept, keys = [kept[j] for j in top], keys[top]
+    return kept
+
+
+def run_streaming(args):
+    # one decision for the whole output: the sample spans every chunk, before any chunk is written
+    matcher = build_matcher()
+    if matcher is not None and VERIFY_SAMPLE > 0:
+        matcher = checked_matcher(sample_answers(args, VERIFY_SAMPLE), matcher)
+    elif matcher is None:
+        print("[CHECK] no compiled patterns from ling_features -> non_answers() per row")
+    sink = ChunkAppender(args.out)
+    n_rows = 0
+    n_nonans = 0
+
+    def consume(chunk, res):
+        nonlocal n_rows, n_nonans
+        out = _attach_labels(chunk, res)
+        sink.write(out)
+        n_rows += len(out)
+        n_nonans += int(out["non_answer"].sum())
+        print(f"[STREAM] rows={n_rows:,} | non_answer={n_nonans:,}")
+
+    ex = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    pending = deque()
+    try:
+        for chunk in iter_input_chunks(args.input, args.chunk_rows, filters_from_args(args)):
+            if "answer" not in chunk.columns:
+                raise ValueError(f"can not find 'answer'。column name：{list(chunk.columns)}")
+            if ex is None:
+                consume(chunk, classify_answers(chunk["answer"].tolist(), matcher))
+                continue
+
+            # keep at most 2 chunks per worker in flight; write in input order
+            pending.append((chunk, ex.submit(_classify_chunk, chunk["answer"].tolist(), matcher is not None)))
+            while len(pending) >= 2 * args.workers:
+                c, fut = pending.popleft()
+                consume(c, fut.result())
+
+        while pending:
+            c, fut = pending.popleft()
+            consume(c, fut.result())
+    finally:
+        if ex is not None:
+            ex.shutdown()
+        sink.close()
+
+    print("Saved:", args.out)
+    if args.excel:
+        # optional final export; this one does load the full output
+        xlsx = os.path.splitext(args.out)[0] + ".xlsx"
+        full = pd.read_csv(args.out, encoding="utf-8-sig") if sink.ext == ".csv" else pd.read_parquet(args.out)
+        full.to_excel(xlsx, index=False)
+        print("Saved:", xlsx)
+    print("Non-answer rate:", (n_nonans / n_rows) if n_rows else float("nan"))
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Gow et al. (2021) non-answer baseline")
+    ap.add_argument("--workers", type=int, default=1, help="processes for the regex pass (1 = serial)")
+    ap.add_argument("--chunk-size", type=int, default=5000, help="answers per worker task")
+    ap.add_argument("--stream", action="store_true", help="chunked CSV/Parquet in -> appended CSV/Parquet out")
+    ap.add_argument("--input", default=IN_PATH,
+                    help="input file (.parquet/.xlsx; .csv/.parquet in --stream mode) or qa_dataset directory")
+    ap.add_argument("--out", default=None, help="--stream output (.csv or .parquet; default OUT_CSV)")
+    ap.add_argument("--chunk-rows", type=int, default=20000, help="rows read per chunk in --stream mode")
+    ap.add_argument("--excel", action="store_true", help="--stream: also export the result to .xlsx at the end")
+    ap.add_argument("--dedup", choices=("none", "exact", "near"), default="exact",
+                    help="classify each distinct answer once: exact = identical text (lossless), "
+                         "near = MinHash/LSH near-duplicates (approximate); not used with --stream")
+    ap.add_argument("--dedup-threshold", type=float, default=0.9, help="--dedup near: min estimated Jaccard similarity")
+    # slices of the corpus: default output names get a __year.../__gsector... suffix
+    add_filter_args(ap)
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    filters = filters_from_args(args)
+    if args.out is None:
+        args.out = sliced_path(OUT_CSV, filters)
+    if args.stream:
+        run_streaming(args)
+        return
+
+    df = read_table(args.input, filters=filters)
+    if filters:
+        print(f"[FILTER] {filters} | rows={len(df):,}")
+    out_parquet, out_xlsx, out_csv, out_clusters = (
+        sliced_path(p, filters) for p in (OUT_PARQUET, OUT_XLSX, OUT_CSV, OUT_CLUSTERS))
+
+    
+    if "answer" not in df.columns:
+        raise ValueError(f"can not find 'answer'。column name：{list(df.columns)}")
+
+    # regexes run on one representative per cluster; labels are fanned out by position
+    rep = dedup_clusters(df.reset_index(drop=True), ["answer"], mode=args.dedup, normalize=False,
+                         **({"threshold": args.dedup_threshold} if args.dedup == "near" else {}))
+    reps = rep.index[rep.index == rep.to_numpy()]
+    print(f"[DEDUP] mode={args.dedup} | rows={len(rep):,} | classified={len(reps):,}")
+    answers = df["answer"].iloc[reps].tolist()
+    matcher = checked_matcher(answers, build_matcher())
+    res = classify_answers_parallel(answers, matcher, args.workers, args.chunk_size)
+    res = res.set_axis(reps).loc[rep.to_numpy()].reset_index(drop=True)
+    out = _attach_labels(df, res)
+
+    
+    write_table(out, out_parquet)
+    out.to_excel(out_xlsx, index=False)
+    out.to_csv(out_csv, index=False, encoding="utf-8-sig")
+
+    print("Saved:", out_parquet)
+    print("Saved:", out_xlsx)
+    print("Saved:", out_csv)
+    if args.dedup != "none":
+        write_table(cluster_table(out, rep), out_clusters)
+        print("Saved:", out_clusters)
+    print("Non-answer rate:", out["non_answer"].mean())
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,31 @@
-import re
+import os
 import json
 import time
-import base64
-import hmac
-import hashlib
+import queue
+import argparse
+import asyncio
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib.parse import urlencode, urlparse
-from email.utils import formatdate, parsedate_to_datetime
 
 import pandas as pd
-import websocket  # pip install websocket-client
 
 import sys
 sys.path.append(r"D:\2025_26 Spring\mnsc.2023.03253\1_code")
 import kw_logic
 
+from qa_io import read_table, write_table  # .parquet / .xlsx by suffix
+from qa_dataset import dataset_filters, sliced_path  # YEARS / SECTORS slices
+from spark_store import ResponseCache, PromptCache, ResultJournal, DeadLetterQueue
+from spark_client import AsyncSparkClient, AdaptiveRateLimiter, SignedUrlCache, WarmConnectionPool, read_frame, open_ws
+from spark_client import extract_label, label_stop_rule, PROMPT_TEMPLATE_LABEL_FIRST, HedgePolicy, run_hedged, CallTrace
+from spark_telemetry import Telemetry, record_call
+from spark_batch import plan_batches, score_batch, score_batch_async, parse_model_json
+from qa_dedup import dedup_clusters, fan_out, cluster_table, ExactDedupStream
+from kw_automaton import KeywordAutomaton, check_automaton
+from spark_schedule import order_tasks, prompt_cost
+from spark_retry import run_retry_pass
+from qa_compact import compact_answer, gow_hit_fn, any_hit_fn
+
 
 # 0) path and keys
 APP_ID = "eaf7df35"
@@ -35,6 +45,9 @@ API_SECRET = API_SECRET.strip()
 # 1) Spark Max 
 SPARK_URL = "wss://spark-api.xf-yun.com/v3.5/chat"
 SPARK_DOMAIN = "generalv3.5"  # Spark Max
+SPARK_TEMPERATURE = 0.2
+SPARK_MAX_TOKENS = 1024
+SPARK_BATCH_MAX_TOKENS = 4096  # batched prompts answer K pairs at once
 
 
 
@@ -71,8 +84,16 @@ Return JSON in this exact format:
 """
 
 
+LABEL_FIRST = False        # True: spark_client.PROMPT_TEMPLATE_LABEL_FIRST, label before rationale
+COLLECT_RATIONALE = True   # LABEL_FIRST only -- False: close the socket once the label is read
+# part of every cache key: bump it whenever PROMPT_TEMPLATE, spark_client.PROMPT_TEMPLATE_LABEL_FIRST
+# or the way replies are parsed change, so responses cached for the old prompt are not replayed
+PROMPT_VERSION = "1"
+
+
 def make_prompt(question: str, answer: str, comments: str = "N/A") -> str:
-    return PROMPT_TEMPLATE.format(
+    template = PROMPT_TEMPLATE_LABEL_FIRST if LABEL_FIRST else PROMPT_TEMPLATE
+    return template.format(
         question=(question or "").strip(),
         answer=(answer or "").strip(),
         comments=(comments or "N/A").strip(),
@@ -81,35 +102,16 @@ def make_prompt(question: str, answer: str, comments: str = "N/A") -> str:
 
 
 # 3) Generate authentication URL
-def build_auth(ws_url: str, api_key: str, api_secret: str):
-    u = urlparse(ws_url)
-    host = u.netloc
-    path = u.path
-
-    date_str = formatdate(timeval=None, localtime=False, usegmt=True)
-    signature_origin = f"host: {host}\n" f"date: {date_str}\n" f"GET {path} HTTP/1.1"
-
-    signature_sha = hmac.new(
-        api_secret.encode("utf-8"),
-        signature_origin.encode("utf-8"),
-        digestmod=hashlib.sha256,
-    ).digest()
-    signature = base64.b64encode(signature_sha).decode("utf-8")
-
-    authorization_origin = (
-        f'api_key="{api_key}", algorithm="hmac-sha256", '
-        f'headers="host date request-line", signature="{signature}"'
-    )
-    authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode("utf-8")
-
-    params = {"authorization": authorization, "date": date_str, "host": host}
-    authed_url = ws_url + "?" + urlencode(params)
-    return authed_url, date_str, host
-
+# Signed URL is reused for its validity window; the clock offset measured from
+# the server `date` header is applied when re-signing (see spark_client).
+AUTH = SignedUrlCache(SPARK_URL, API_KEY, API_SECRET)
+WS_POOL = None  # WarmConnectionPool, set in main() when PREWARM_CONNECTIONS > 0
+HEDGE = None       # HedgePolicy, set in main() when USE_HEDGE
+HEDGE_POOL = None  # threads running the hedged attempts (2 per worker)
+TELEMETRY = None   # spark_telemetry.Telemetry, set in main() when TELEMETRY_PATH
 
 
 # 4)  Spark
-
 def spark_chat_once(
     prompt: str,
     uid: str,
@@ -117,37 +119,30 @@ def spark_chat_once(
     max_tokens: int = 1024,
     timeout_sec: int = 60,
     debug_time: bool = False,
+    stop_when=None,
+    on_open=None,
+    trace: CallTrace = None,
 ) -> str:
-    authed_url, date_str, _host = build_auth(SPARK_URL, API_KEY, API_SECRET)
-
-    if debug_time:
-        print(f"[AUTH] client date_str = {date_str} (GMT RFC1123)")
-
+    trace = trace or CallTrace(uid)
     try:
-        ws = websocket.create_connection(
-            authed_url,
-            timeout=timeout_sec,
-            header=[f"X-Date: {date_str}"],
-        )
-    except websocket._exceptions.WebSocketBadStatusException as e:
-        if debug_time:
-            server_date = None
-            try:
-                server_date = (e.resp_headers or {}).get("date") or (e.resp_headers or {}).get("Date")
-            except Exception:
-                server_date = None
-            print("[AUTH] handshake failed.")
-            print("       client date_str:", date_str)
-            if server_date:
-                print("       server date    :", server_date)
-                try:
-                    dt_client = parsedate_to_datetime(date_str)
-                    dt_server = parsedate_to_datetime(server_date)
-                    skew_sec = abs((dt_client - dt_server).total_seconds())
-                    print(f"       |client-server| skew_sec = {skew_sec:.1f}")
-                except Exception:
-                    pass
+        text = _spark_chat(prompt, uid, temperature, max_tokens, timeout_sec, debug_time, stop_when, on_open, trace)
+    except Exception as e:
+        record_call(TELEMETRY, trace, error=e)
         raise
+    record_call(TELEMETRY, trace, text)
+    return text
+
+
+def _spark_chat(prompt, uid, temperature, max_tokens, timeout_sec, debug_time, stop_when, on_open, trace) -> str:
+    if WS_POOL is not None and not debug_time:
+        ws = WS_POOL.acquire()
+        ws.settimeout(timeout_sec)
+        trace.pooled = True
+        trace.mark("connected")
+    else:
+        ws = open_ws(AUTH, timeout_sec=timeout_sec, debug_time=debug_time, trace=trace)
+    if on_open is not None:
+        on_open(ws)
 
     req = {
         "header": {"app_id": APP_ID, "uid": uid},
@@ -166,23 +161,13 @@ def spark_chat_once(
     chunks = []
     try:
         while True:
-            raw = ws.recv()
-            msg = json.loads(raw)
-
-            code = msg.get("header", {}).get("code", -1)
-            if code != 0:
-                raise RuntimeError(
-                    f"Spark API error code={code}, message={msg.get('header', {}).get('message')}"
-                )
-
-            choices = msg.get("payload", {}).get("choices", {})
-            status = choices.get("status", 0)
-            for t in choices.get("text", []):
-                if isinstance(t, dict) and "content" in t:
-                    chunks.append(t["content"])
-
+            # non-zero header.code -> SparkAPIError (a RuntimeError carrying .code)
+            status = read_frame(ws.recv(), chunks, trace)
             if status == 2:
                 break
+            # label-first: stop reading (and close) once the label has arrived
+            if stop_when is not None and stop_when("".join(chunks)):
+                break
     finally:
         ws.close()
 
@@ -190,27 +175,26 @@ def spark_chat_once(
 
 
 
-# 5) JSON 
-def parse_model_json(text: str):
-    if not text or str(text).strip() == "":
-        return None, "empty_response", ""
+def spark_chat_hedged(prompt: str, uid: str, timeout_sec: int, stop_when=None, trace: CallTrace = None) -> str:
+    """spark_chat_once; with HEDGE set, a duplicate goes out once the call is slower than usual."""
+    traces = [trace or CallTrace(uid)]
 
-    try:
-        return json.loads(text), None, text
-    except Exception:
-        pass
+    def attempt(on_cancel):
+        # the first attempt keeps the caller's trace (with its limiter wait), the duplicate gets its own
+        t = traces.pop() if traces else CallTrace(uid, kind="hedge")
+        on_cancel(lambda: t.mark("cancelled"))
+        # abort() wakes up the thread blocked in recv() when the other attempt wins
+        return spark_chat_once(prompt, uid=uid, temperature=SPARK_TEMPERATURE, max_tokens=SPARK_MAX_TOKENS,
+                               timeout_sec=timeout_sec, stop_when=stop_when, on_open=lambda ws: on_cancel(ws.abort),
+                               trace=t)
 
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if not m:
-        return None, "no_json_object_found", text
+    if HEDGE is None:
+        return attempt(lambda fn: None)
+    return run_hedged(attempt, HEDGE, HEDGE_POOL)
 
-    cand = m.group(0).strip()
-    try:
-        return json.loads(cand), None, cand
-    except Exception as e:
-        return None, f"json_parse_failed: {repr(e)}", cand
 
 
+# 5) JSON: replies are parsed by spark_batch.parse_model_json (single objects and batch arrays)
 def safe_preview(s: str, n: int = 220) -> str:
     s = "" if s is None else str(s)
     s = s.replace("\n", " ").replace("\r", " ")
@@ -244,80 +228,381 @@ class StartRateLimiter:
         if sleep_sec > 0:
             time.sleep(sleep_sec)
 
+    # fixed spacing ignores call outcomes (AdaptiveRateLimiter uses them)
+    def on_success(self):
+        pass
+
+    def on_error(self, exc):
+        pass
+
 
 
 # 7) Spark Worker
-def spark_worker(row_i, tid, q, a, rate_limiter: StartRateLimiter, max_retry: int, timeout_sec: int):
+def spark_result(row_i, raw: str) -> dict:
+    parsed, err, extracted = parse_model_json(raw)
+    label = extract_label(raw) if (err and LABEL_FIRST) else None
+    if label is not None:
+        # stream closed after the label (or rationale cut off): keep the label
+        return {
+            "row": row_i,
+            "spark_raw": raw,
+            "spark_json_extracted": "",
+            "spark_assessment": "",
+            "spark_pred_nonanswer": label,
+            "spark_parse_error": "",
+        }
+    if err:
+        return {
+            "row": row_i,
+            "spark_raw": raw,
+            "spark_json_extracted": extracted,
+            "spark_assessment": "",
+            "spark_pred_nonanswer": pd.NA,
+            "spark_parse_error": err,
+        }
+    pred = coerce_01(parsed.get("your_classification", pd.NA))
+    return {
+        "row": row_i,
+        "spark_raw": raw,
+        "spark_json_extracted": extracted,
+        "spark_assessment": parsed.get("assessment", ""),
+        "spark_pred_nonanswer": pred,
+        "spark_parse_error": "",
+    }
+
+
+def failed_result(row_i, last_err) -> dict:
+    return {
+        "row": row_i,
+        "spark_raw": "",
+        "spark_json_extracted": "",
+        "spark_assessment": "",
+        "spark_pred_nonanswer": pd.NA,
+        "spark_parse_error": f"call_failed: {last_err}",
+    }
+
+
+def spark_worker(row_i, tid, q, a, rate_limiter, max_retry: int, timeout_sec: int, cache: PromptCache):
     prompt = make_prompt(q, a, comments="N/A")
+    key, raw = cache.lookup(prompt)
+    if raw is not None:
+        return spark_result(row_i, raw)
+
     last_err = None
 
     for attempt in range(max_retry + 1):
         try:
+            trace = CallTrace(f"tid_{tid}_row_{row_i}")
             rate_limiter.wait_turn()
-            raw = spark_chat_once(
+            trace.mark("admitted")
+            raw = spark_chat_hedged(
                 prompt,
-                uid=f"tid_{tid}_row_{row_i}",
+                uid=trace.uid,
                 timeout_sec=timeout_sec,
+                stop_when=label_stop_rule(LABEL_FIRST, COLLECT_RATIONALE),
+                trace=trace,
             )
-            parsed, err, extracted = parse_model_json(raw)
-            if err:
-                return {
-                    "row": row_i,
-                    "spark_raw": raw,
-                    "spark_json_extracted": extracted,
-                    "spark_assessment": "",
-                    "spark_pred_nonanswer": pd.NA,
-                    "spark_parse_error": err,
-                }
-            pred = coerce_01(parsed.get("your_classification", pd.NA))
-            return {
-                "row": row_i,
-                "spark_raw": raw,
-                "spark_json_extracted": extracted,
-                "spark_assessment": parsed.get("assessment", ""),
-                "spark_pred_nonanswer": pred,
-                "spark_parse_error": "",
-            }
+            rate_limiter.on_success()
+            res = spark_result(row_i, raw)
+            cache.store(key, raw)  # only complete responses that parsed (not label-only cuts)
+            return res
         except Exception as e:
+            # no sleeping here: a row that keeps failing goes to the dead-letter retry pass
             last_err = repr(e)
-            
-            time.sleep(1.0 + 0.7 * attempt)
+            rate_limiter.on_error(e)
+
+    return failed_result(row_i, last_err)
+
 
-    return {
-        "row": row_i,
-        "spark_raw": "",
-        "spark_json_extracted": "",
-        "spark_assessment": "",
-        "spark_pred_nonanswer": pd.NA,
-        "spark_parse_error": f"call_failed: {last_err}",
-    }
+
+# 7a) keyword prefilter: kw_dict compiled into one Aho-Corasick automaton
+def checked_kw_finder(answers, kw_dict, whole_words: bool, sample: int, seed: int):
+    """
+    automaton.find if it agrees with kw_logic.find_kw_matches on `sample`
+    random answers, else kw_logic.find_kw_matches row by row.
+    """
+    def kw_logic_find(a):
+        return kw_logic.find_kw_matches(a, kw_dict=kw_dict)
+
+    automaton = KeywordAutomaton.from_kw_dict(kw_dict, whole_words=whole_words)
+    bad = check_automaton(automaton, answers, kw_logic_find, sample, seed)
+    if bad is None:
+        print(f"[CHECK] keyword automaton == kw_logic.find_kw_matches on {min(sample, len(answers))} random rows")
+        return automaton.find
+    n_bad, n, pos = bad
+    a = answers[pos]
+    print(f"[CHECK] keyword automaton differs from kw_logic.find_kw_matches on {n_bad}/{n} random rows "
+          f"(first: row {pos}, kw_logic={sorted(set(kw_logic_find(a)[1] or []))} automaton={automaton.find(a)[1]}); "
+          f"using kw_logic.find_kw_matches (check KW_WHOLE_WORDS)")
+    return kw_logic_find
+
+
+
+# 7b) asyncio Spark Worker (same result dict as spark_worker)
+async def spark_worker_async(row_i, tid, q, a, client: AsyncSparkClient, max_retry: int, cache: PromptCache):
+    prompt = make_prompt(q, a, comments="N/A")
+    key, raw = cache.lookup(prompt)
+    if raw is not None:
+        return spark_result(row_i, raw)
+
+    last_err = None
+
+    for attempt in range(max_retry + 1):
+        try:
+            raw = await client.chat(prompt, uid=f"tid_{tid}_row_{row_i}",
+                                    temperature=SPARK_TEMPERATURE, max_tokens=SPARK_MAX_TOKENS,
+                                    stop_when=label_stop_rule(LABEL_FIRST, COLLECT_RATIONALE))
+        except Exception as e:
+            last_err = repr(e)
+            continue
+
+        res = spark_result(row_i, raw)
+        cache.store(key, raw)  # only complete responses that parsed (not label-only cuts)
+        return res
+
+    return failed_result(row_i, last_err)
+
+
+# 7c) batched workers: K pairs per request -> ({row: single-pair JSON}, [rows to re-queue], err)
+def spark_batch_worker(batch, rate_limiter, timeout_sec: int):
+    def call(prompt):
+        trace = CallTrace(f"tid_{batch[0][1]}_batch{len(batch)}", kind="batch")
+        rate_limiter.wait_turn()
+        trace.mark("admitted")
+        try:
+            raw = spark_chat_once(
+                prompt,
+                uid=trace.uid,
+                temperature=SPARK_TEMPERATURE,
+                max_tokens=SPARK_BATCH_MAX_TOKENS,
+                timeout_sec=timeout_sec,
+                trace=trace,
+            )
+        except Exception as e:
+            rate_limiter.on_error(e)
+            raise
+        rate_limiter.on_success()
+        return raw
+
+    return score_batch([(i, q, a) for (i, tid, q, a) in batch], call, parse_model_json)
+
+
+async def spark_batch_worker_async(batch, client: AsyncSparkClient):
+    def call(prompt):
+        return client.chat(prompt, uid=f"tid_{batch[0][1]}_batch{len(batch)}",
+                           temperature=SPARK_TEMPERATURE, max_tokens=SPARK_BATCH_MAX_TOKENS)
+
+    return await score_batch_async([(i, q, a) for (i, tid, q, a) in batch], call, parse_model_json)
+
+
+async def run_spark_async(tasks, client: AsyncSparkClient, max_retry: int, on_result, cache: PromptCache,
+                          batches=(), on_batch=None, order=list):
+    """
+    Batches first (their leftovers are appended to `tasks` by on_batch), then single pairs.
+    Tasks are created in `order(tasks)` order, which is the order they get a concurrency slot.
+    """
+    try:
+        futs = [asyncio.ensure_future(spark_batch_worker_async(b, client)) for b in batches]
+        for fut in asyncio.as_completed(futs):
+            on_batch(*(await fut))
+
+        futs = [asyncio.ensure_future(spark_worker_async(i, tid, q, a, client, max_retry, cache))
+                for (i, tid, q, a) in order(tasks)]
+        for fut in asyncio.as_completed(futs):
+            on_result(await fut)
+    finally:
+        await client.aclose()
+
+
+
+# 7d) pipelined Step B: Stage A hands kw-positive rows to running workers through a bounded queue
+class SparkPipeline:
+    """
+    n_workers threads call work(task) on queued tasks. Results are collected
+    by the caller (ready() / close()) so all DataFrame writes stay on the
+    main thread.
+    """
+
+    _EXIT = object()
+
+    def __init__(self, work, n_workers: int, maxsize: int):
+        self._tasks = queue.Queue(maxsize=maxsize)
+        self._results = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, args=(work,), daemon=True) for _ in range(n_workers)]
+        for t in self._threads:
+            t.start()
+
+    def _run(self, work):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._results.put(self._EXIT)
+                return
+            try:
+                self._results.put(work(task))
+            except Exception as e:  # re-raised on the main thread
+                self._results.put(e)
+
+    def put(self, task):
+        """Blocks while `maxsize` tasks are waiting, so Stage A runs at the workers' pace."""
+        self._tasks.put(task)
+
+    def ready(self):
+        """Results finished so far, without waiting."""
+        while True:
+            try:
+                res = self._results.get_nowait()
+            except queue.Empty:
+                return
+            yield self._check(res)
+
+    def close(self):
+        """No more tasks: yield the remaining results as they finish."""
+        for _ in self._threads:
+            self._tasks.put(None)
+        running = len(self._threads)
+        while running:
+            res = self._results.get()
+            if res is self._EXIT:
+                running -= 1
+                continue
+            yield self._check(res)
+
+    @staticmethod
+    def _check(res):
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+
+# 7e) evidence-window compaction: agreement with the Manual labels, cut vs full answers
+def report_compaction(df, dedup_rep, compacted):
+    reasons = pd.Series([c.reason for c in compacted.values()]).value_counts()
+    t_in = sum(c.tokens_in for c in compacted.values())
+    t_out = sum(c.tokens_out for c in compacted.values())
+    print(f"[COMPACT] cut answers={len(compacted)} | answer tokens {t_in:,} -> {t_out:,} | "
+          + " ".join(f"{k}={v}" for k, v in reasons.items()))
+
+    manual_col = next((c for c in df.columns if str(c).strip().lower() == "manual"), None)
+    if manual_col is None:
+        return
+    # cluster members were scored with their representative's (cut) answer
+    cut = df.index.isin(dedup_rep.index[dedup_rep.isin(list(compacted))])
+    used = (df["used_spark"] == 1).to_numpy()
+    manual = pd.to_numeric(df[manual_col], errors="coerce")
+    pred = pd.to_numeric(df["spark_pred_nonanswer"], errors="coerce")
+    for name, mask in (("cut", used & cut), ("full", used & ~cut)):
+        ok = mask & manual.notna().to_numpy() & pred.notna().to_numpy()
+        acc = (manual[ok] == pred[ok]).mean() if ok.any() else float("nan")
+        print(f"[COMPACT] vs {manual_col} | {name:<4} answers n={int(ok.sum()):,} | accuracy={acc:.3f}")
 
 
 
 # 8) Main program（kw_match==0 -> final=0；kw_match==1 -> Spark）
 
-def main():
-    in_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer.xlsx"
-    out_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer__AUTHORLOGIC__kw0_is0__sparkmax_parallel.xlsx"
+def main(retry_only: bool = False):
+    global WS_POOL, HEDGE, HEDGE_POOL, TELEMETRY
+
+    in_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer.parquet"
+    out_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer__AUTHORLOGIC__kw0_is0__sparkmax_parallel.parquet"
+
+    # score a slice of the corpus: only the matching partitions of a qa_dataset directory (or rows of a
+    # file with year / gsector columns) are read, and the outputs get a __year...__gsector... suffix
+    YEARS = None      # e.g. ["2013-2016"] or [2019, 2021]; None = all years
+    SECTORS = None    # 2-digit GICS sectors, e.g. ["45"]; None = all sectors
+    FILTERS = dataset_filters(YEARS, SECTORS)
+    out_path = sliced_path(out_path, FILTERS)
 
     
     USE_FUTURE_KW = True  # True: kw_dict_with_future，False: kw_dict
+    USE_KW_AUTOMATON = True  # one Aho-Corasick pass per answer instead of kw_logic.find_kw_matches
+    KW_WHOLE_WORDS = False   # keywords must sit on word boundaries (keep in line with kw_logic)
+    # random answers compared with kw_logic before Stage A; any difference -> kw_logic for every row
+    KW_VERIFY_SAMPLE = 500
+    KW_VERIFY_SEED = 0
 
     
     MAX_WORKERS = 20              
     START_INTERVAL_SEC = 0.08     
+    USE_ADAPTIVE_LIMIT = True     # token bucket + AIMD on Spark throttle codes; False: fixed START_INTERVAL_SEC
+    LIMIT_BURST = 5
+    LIMIT_MAX_QPS = None          # AIMD ceiling; None = the START_INTERVAL_SEC pace, so it only ever backs off
+    USE_ASYNC = False             # True: one asyncio loop, ASYNC_CONCURRENCY requests in flight
+    ASYNC_CONCURRENCY = 200
+    USE_HEDGE = False             # duplicate a call still running after the HEDGE_PERCENTILE of recent latency
+    HEDGE_PERCENTILE = 95
+    HEDGE_BUDGET = 0.05           # at most 5% extra calls per run
+    # handshaken sockets kept ready ahead of demand (0 = off); opt-in, capped at the worker count,
+    # because every idle socket is a handshake the service bills/rate-limits like a real call
+    PREWARM_CONNECTIONS = 0
+
+    # responses keyed by (prompt, model, domain, temperature, max_tokens, PROMPT_VERSION); None = no cache.
+    # Changed the prompt or parsing? bump PROMPT_VERSION or delete this file before the next run.
+    CACHE_PATH = r"D:\2025_26 Spring\Replication\spark_cache.sqlite"
+    CACHE_MAX_MB = 512
     SPARK_TIMEOUT_SEC = 60
-    MAX_RETRY = 1
-
-    
-    CHECKPOINT_EVERY_DONE = 40    
+    MAX_RETRY = 1                 # immediate re-tries inside the worker; longer backoff happens in the retry pass
+
+    # failed / unparseable rows are dead-lettered and retried after Step B with their own workers and
+    # per-error-class policies (spark_retry.RETRY_POLICIES); `--retry-dead-letters` runs only that pass
+    RETRY_AT_END = True
+    RETRY_WORKERS = 4
+
+    # every scored row is appended here; a restart replays it and skips those rows
+    JOURNAL_PATH = os.path.splitext(out_path)[0] + ".journal.jsonl"
+    DEAD_LETTER_PATH = os.path.splitext(out_path)[0] + ".deadletter.jsonl"
+    if retry_only and not os.path.exists(DEAD_LETTER_PATH):
+        raise SystemExit(f"--retry-dead-letters: no dead letters at {DEAD_LETTER_PATH}; run the full script first")
+
+    # overlap Stage A and Step B: kw-positive rows go to the Spark workers as soon as they are found;
+    # Stage A blocks once PIPELINE_QUEUE_SIZE rows are waiting (thread mode, BATCH_K = 1, DEDUP_MODE none/exact)
+    PIPELINE = False
+    PIPELINE_QUEUE_SIZE = 64
+
+    # submission order of queued calls (staged path): "fifo" = dataframe order, "lpt" = longest prompt first;
+    # SCHEDULE_FAIR_BY_TRANSCRIPT round-robins over transcriptid, longest first inside each transcript.
+    # With "lpt" an interrupted run has finished a scattered subset of rows, not a prefix of the file:
+    # the journal still resumes it (rows are keyed, not counted), but a partial output can not be cut
+    # at "first N rows done" or compared with an interrupted fifo run
+    SCHEDULE = "fifo"
+    SCHEDULE_FAIR_BY_TRANSCRIPT = False
+
+    # batched prompts: up to BATCH_K pairs per request within BATCH_TOKEN_BUDGET prompt tokens (1 = off)
+    BATCH_K = 1
+    BATCH_TOKEN_BUDGET = 6000
+
+    # one Spark call per (question, answer) cluster, label copied to the members:
+    # "none" | "exact" (identical raw text) | "near" (MinHash/LSH on normalized text, Jaccard >= DEDUP_THRESHOLD).
+    # Off by default: a copied label is one sample of a stochastic model, so clustering changes the
+    # Table 2 inputs compared with scoring every row. DEDUP_NORMALIZE: "exact" also merges rows that
+    # differ only in case / punctuation / whitespace
+    DEDUP_MODE = "none"
+    DEDUP_NORMALIZE = False
+    DEDUP_THRESHOLD = 0.9
+    CLUSTERS_PATH = os.path.splitext(out_path)[0] + ".clusters.parquet"
+
+    # evidence windows: answers over COMPACT_TOKEN_BUDGET are cut to the sentences with a hit plus
+    # COMPACT_CONTEXT sentences each side; COMPACT_HITS "kw" (kw_dict) | "gow" (ling_features regexes) | "both".
+    # Kept / dropped sentences per row go to COMPACTION_PATH
+    COMPACT = False
+    COMPACT_HITS = "kw"
+    COMPACT_CONTEXT = 1
+    COMPACT_TOKEN_BUDGET = 800
+    COMPACTION_PATH = os.path.splitext(out_path)[0] + ".compaction.parquet"
+
+    # per-attempt stage timings / frames / usage tokens (.jsonl streamed, .csv/.parquet at the end; None = off),
+    # a Prometheus text dump at the end and, with TELEMETRY_PORT, live at http://127.0.0.1:PORT/metrics
+    TELEMETRY_PATH = os.path.splitext(out_path)[0] + ".calls.jsonl"
+    TELEMETRY_PROM_PATH = os.path.splitext(out_path)[0] + ".calls.prom"
+    TELEMETRY_PORT = 0
 
     kw_dict = kw_logic.kw_dict_with_future if USE_FUTURE_KW else kw_logic.kw_dict
 
     print("=" * 90)
-    print("[START] Loading Excel")
-    df = pd.read_excel(in_path, engine="openpyxl")
-    print(f"[OK] rows={len(df):,}, cols={len(df.columns)}")
+    print("[START] Loading", in_path)
+    df = read_table(in_path, filters=FILTERS)
+    print(f"[OK] rows={len(df):,}, cols={len(df.columns)}" + (f" | filter={FILTERS}" if FILTERS else ""))
     print("[INFO] columns:", list(df.columns))
 
     required = {"transcriptid", "question", "answer"}
@@ -350,10 +635,105 @@ def main():
     print("[SMOKE] auth smoke test")
     _ = spark_chat_once('only reply one JSON：{"ok":true}', uid="smoke_test", max_tokens=50, temperature=0.0, timeout_sec=30)
     print("[SMOKE] OK")
+    if TELEMETRY_PATH:
+        TELEMETRY = Telemetry(TELEMETRY_PATH, prom_path=TELEMETRY_PROM_PATH, port=TELEMETRY_PORT)
 
     print("=" * 90)
     print("[STEP A] KW prefilter (serial)")
+    journal = ResultJournal(JOURNAL_PATH)
+    journaled = journal.replay()
+    dead_letters = DeadLetterQueue(DEAD_LETTER_PATH)
+
+    print(f"[RESUME] journal rows={len(journaled):,} | {JOURNAL_PATH}")
+
+    cache = PromptCache(ResponseCache(CACHE_PATH, max_mb=CACHE_MAX_MB) if CACHE_PATH else None,
+                        SPARK_URL, SPARK_DOMAIN, SPARK_TEMPERATURE, SPARK_MAX_TOKENS, PROMPT_VERSION,
+                        replayable=lambda raw: parse_model_json(raw)[1] is None)
+
+    if USE_ADAPTIVE_LIMIT:
+        rate_limiter = AdaptiveRateLimiter(1.0 / START_INTERVAL_SEC, burst=LIMIT_BURST,
+                                           max_rate=LIMIT_MAX_QPS or 1.0 / START_INTERVAL_SEC)
+    else:
+        rate_limiter = StartRateLimiter(START_INTERVAL_SEC)
+
+    if USE_HEDGE:
+        HEDGE = HedgePolicy(percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET)
+        HEDGE_POOL = ThreadPoolExecutor(max_workers=2 * MAX_WORKERS)
+
+    n_queued = 0  # rows sent to Spark; batching reshuffles `tasks`, so counts refer to the original queue
+    done = 0
+    t0 = time.time()
+
+    def apply_result(res, from_journal=False, from_retry=False):
+        nonlocal done
+        i = res["row"]
+
+        df.at[i, "spark_raw"] = res["spark_raw"]
+        df.at[i, "spark_json_extracted"] = res["spark_json_extracted"]
+        df.at[i, "spark_assessment"] = res["spark_assessment"]
+        df.at[i, "spark_pred_nonanswer"] = res["spark_pred_nonanswer"]
+        df.at[i, "spark_parse_error"] = res["spark_parse_error"]
+
+        # kw_match==1 
+        if pd.notna(df.at[i, "spark_pred_nonanswer"]):
+            df.at[i, "final_pred_nonanswer"] = df.at[i, "spark_pred_nonanswer"]
+
+        if from_journal:
+            return
+        if not res["spark_parse_error"].startswith("call_failed"):
+            journal.append(ResultJournal.row_key(df, i), {k: v for k, v in res.items() if k != "row"})
+        if res["spark_parse_error"] and not from_retry:
+            dead_letters.add(ResultJournal.row_key(df, i), {"row": int(i), "error": res["spark_parse_error"]})
+
+        done += 1
+        if done % 10 == 0:
+            elapsed = time.time() - t0
+            qps = f" | qps_limit={rate_limiter.rate:.1f}" if USE_ADAPTIVE_LIMIT else ""
+            print(f"[SPARK] done {done}/{n_queued} | elapsed={elapsed:.1f}s{qps} | last_row={i} pred={df.at[i,'spark_pred_nonanswer']} err={df.at[i,'spark_parse_error']}")
+
+    # PIPELINE: the workers start now and pick up rows while Stage A is still scanning
+    pipelined = PIPELINE and not retry_only and not USE_ASYNC and BATCH_K <= 1 and DEDUP_MODE in ("none", "exact")
+    if PIPELINE and not pipelined:
+        print("[PIPELINE] off: needs USE_ASYNC = False, BATCH_K = 1 and DEDUP_MODE 'none'/'exact'")
+    pipe = None
+    if pipelined:
+        if PREWARM_CONNECTIONS > 0:
+            WS_POOL = WarmConnectionPool(lambda: open_ws(AUTH, timeout_sec=SPARK_TIMEOUT_SEC),
+                                         size=min(PREWARM_CONNECTIONS, MAX_WORKERS))
+        pipe = SparkPipeline(lambda t: spark_worker(*t, rate_limiter, MAX_RETRY, SPARK_TIMEOUT_SEC, cache),
+                             MAX_WORKERS, PIPELINE_QUEUE_SIZE)
+        first_of = ExactDedupStream(normalize=DEDUP_NORMALIZE) if DEDUP_MODE == "exact" else None
+        print(f"[PIPELINE] on | workers={MAX_WORKERS} | queue={PIPELINE_QUEUE_SIZE}")
+
+    if USE_KW_AUTOMATON:
+        find_kw_matches = checked_kw_finder([str(a).strip() for a in df["answer"]], kw_dict,
+                                            KW_WHOLE_WORDS, KW_VERIFY_SAMPLE, KW_VERIFY_SEED)
+    else:
+        def find_kw_matches(a):
+            return kw_logic.find_kw_matches(a, kw_dict=kw_dict)
+
+    compacted = {}  # row -> Compaction, answers that were cut
+
+    def answer_text(i, a):
+        if not COMPACT:
+            return a
+        c = compact_answer(a, compact_hit, context=COMPACT_CONTEXT, token_budget=COMPACT_TOKEN_BUDGET)
+        if c.applied:
+            compacted[i] = c
+        return c.text
+
+    if COMPACT:
+        if COMPACT_HITS not in ("kw", "gow", "both"):
+            raise ValueError(f"COMPACT_HITS must be 'kw', 'gow' or 'both', got {COMPACT_HITS!r}")
+        kw_hit = (lambda s: bool(find_kw_matches(s)[0])) if COMPACT_HITS in ("kw", "both") else None
+        gow_hit = None
+        if COMPACT_HITS in ("gow", "both"):
+            gow_hit = gow_hit_fn()
+        compact_hit = any_hit_fn(kw_hit, gow_hit)
+        print(f"[COMPACT] on | hits={COMPACT_HITS} | context={COMPACT_CONTEXT} | budget={COMPACT_TOKEN_BUDGET} tokens")
+
     tasks = []
+    resumed = []
     skipped_as_zero = 0  # kw_match==0 => final=0，jump over Spark
 
     for k, i in enumerate(df.index, start=1):
@@ -362,7 +742,7 @@ def main():
         a = str(df.at[i, "answer"]).strip()
 
         try:
-            match, matches = kw_logic.find_kw_matches(a, kw_dict=kw_dict)
+            match, matches = find_kw_matches(a)
         except Exception as e:
             match, matches = False, []
             df.at[i, "kw_matches"] = f"kw_error:{repr(e)}"
@@ -379,54 +759,172 @@ def main():
         else:
             # kw_match==1 -> need Spark to decide 0/1
             df.at[i, "used_spark"] = 1
-            tasks.append((i, tid, q, a))
+            rec = journaled.get(ResultJournal.row_key(df, i))
+            if rec is not None:
+                resumed.append({**rec, "row": i})
+            else:
+                tasks.append((i, tid, q, answer_text(i, a)))
+
+            if pipe is not None:
+                # same representatives as the exact dedup below: first row with the key
+                first = first_of.add(i, (df.at[i, "question"], df.at[i, "answer"])) if first_of is not None else i
+                if rec is None and first == i:
+                    n_queued += 1
+                    pipe.put(tasks[-1])
+                for res in pipe.ready():
+                    apply_result(res)
 
         if k % 200 == 0:
-            print(f"[KW] {k}/{len(df)} | kw0->0 skipped={skipped_as_zero} | queued_spark={len(tasks)}")
+            print(f"[KW] {k}/{len(df)} | kw0->0 skipped={skipped_as_zero} | queued_spark={len(tasks)} | resumed={len(resumed)}")
+
+    # kw_match==1 rows only: members of a cluster wait for their representative
+    spark_rows = df.index[df["used_spark"] == 1]
+    dedup_rep = dedup_clusters(df.loc[spark_rows], ["question", "answer"], mode=DEDUP_MODE, normalize=DEDUP_NORMALIZE,
+                               **({"threshold": DEDUP_THRESHOLD} if DEDUP_MODE == "near" else {}))
+    is_rep = dedup_rep.index == dedup_rep.to_numpy()
+    tasks = [t for t in tasks if is_rep[dedup_rep.index.get_loc(t[0])]]
+    if retry_only:
+        # Step B is skipped: only rows that actually failed are retried; never-scored rows wait for a full run
+        if tasks:
+            print(f"[RETRY] {len(tasks):,} rows not scored yet are left for a full run")
+        tasks = []
+    n_queued = len(tasks)
+    print(f"[DEDUP] mode={DEDUP_MODE} | spark_rows={len(spark_rows):,} | clusters={int(is_rep.sum()):,} | queued_spark={len(tasks)}")
 
     print("=" * 90)
-    print(f"[STEP B] Spark Max (parallel) | queued={len(tasks)} | workers={MAX_WORKERS}")
-
-    rate_limiter = StartRateLimiter(START_INTERVAL_SEC)
-
-    done = 0
-    t0 = time.time()
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-        futures = [
-            ex.submit(spark_worker, i, tid, q, a, rate_limiter, MAX_RETRY, SPARK_TIMEOUT_SEC)
-            for (i, tid, q, a) in tasks
-        ]
-
-        for fut in as_completed(futures):
-            res = fut.result()
-            i = res["row"]
-
-            df.at[i, "spark_raw"] = res["spark_raw"]
-            df.at[i, "spark_json_extracted"] = res["spark_json_extracted"]
-            df.at[i, "spark_assessment"] = res["spark_assessment"]
-            df.at[i, "spark_pred_nonanswer"] = res["spark_pred_nonanswer"]
-            df.at[i, "spark_parse_error"] = res["spark_parse_error"]
-
-            # kw_match==1 
-            if pd.notna(df.at[i, "spark_pred_nonanswer"]):
-                df.at[i, "final_pred_nonanswer"] = df.at[i, "spark_pred_nonanswer"]
-
-            done += 1
-            if done % 10 == 0:
-                elapsed = time.time() - t0
-                print(f"[SPARK] done {done}/{len(tasks)} | elapsed={elapsed:.1f}s | last_row={i} pred={df.at[i,'spark_pred_nonanswer']} err={df.at[i,'spark_parse_error']}")
-
-            if done % CHECKPOINT_EVERY_DONE == 0:
-                df.to_excel(out_path, index=False)
-                print(f"[SAVE] checkpoint -> {out_path} | done={done}/{len(tasks)}")
+    print(f"[STEP B] Spark Max (parallel) | queued={len(tasks)} | workers={ASYNC_CONCURRENCY if USE_ASYNC else MAX_WORKERS}")
+
+    for res in resumed:
+        apply_result(res, from_journal=True)
+
+    # batch phase: pairs not answered by the cache are packed K per request;
+    # whatever a batch response misses goes back to the single-pair queue
+    batches = []
+    if BATCH_K > 1:
+        batchable = [t for t in tasks if not cache.contains(make_prompt(t[2], t[3], comments="N/A"))]
+        batches = [b for b in plan_batches(batchable, BATCH_K, BATCH_TOKEN_BUDGET, text_of=lambda t: t[2] + t[3]) if len(b) > 1]
+        in_batch = {t[0] for b in batches for t in b}
+        by_row = {t[0]: t for t in tasks}
+        tasks = [t for t in tasks if t[0] not in in_batch]
+        print(f"[BATCH] requests={len(batches)} | pairs={len(in_batch)} | single={len(tasks)}")
+
+    def schedule(items):
+        return order_tasks(items, lambda t: prompt_cost(t[2] + t[3]), SCHEDULE,
+                           fair_key=(lambda t: t[1]) if SCHEDULE_FAIR_BY_TRANSCRIPT else None)
+
+    batches = order_tasks(batches, lambda b: sum(prompt_cost(t[2] + t[3]) for t in b), SCHEDULE)
+
+    def take_batch(got, missing, err):
+        for i, txt in got.items():
+            apply_result(spark_result(i, txt))
+        tasks.extend(by_row[i] for i in missing)
+        if missing:
+            print(f"[BATCH] {len(missing)} pair(s) re-queued as single | err={err}")
+
+    if pipe is not None:
+        # Stage A is done; wait for the rows still queued or in flight
+        try:
+            for res in pipe.close():
+                apply_result(res)
+        finally:
+            if WS_POOL is not None:
+                WS_POOL.close()
+                WS_POOL = None
+    elif USE_ASYNC:
+        print(f"[INFO] asyncio mode | in_flight<={ASYNC_CONCURRENCY}")
+        client = AsyncSparkClient(
+            APP_ID, API_KEY, API_SECRET, SPARK_URL, SPARK_DOMAIN,
+            concurrency=ASYNC_CONCURRENCY,
+            timeout_sec=SPARK_TIMEOUT_SEC,
+            limiter=rate_limiter if USE_ADAPTIVE_LIMIT else AdaptiveRateLimiter(1.0 / START_INTERVAL_SEC, max_rate=1.0 / START_INTERVAL_SEC),
+            prewarm=min(PREWARM_CONNECTIONS, ASYNC_CONCURRENCY),
+            hedge=HEDGE,
+            telemetry=TELEMETRY,
+        )
+        asyncio.run(run_spark_async(tasks, client, MAX_RETRY, apply_result, cache, batches, take_batch, order=schedule))
+    else:
+        if PREWARM_CONNECTIONS > 0:
+            WS_POOL = WarmConnectionPool(lambda: open_ws(AUTH, timeout_sec=SPARK_TIMEOUT_SEC),
+                                         size=min(PREWARM_CONNECTIONS, MAX_WORKERS))
 
-    df.to_excel(out_path, index=False)
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+                batch_futures = [ex.submit(spark_batch_worker, b, rate_limiter, SPARK_TIMEOUT_SEC) for b in batches]
+                for fut in as_completed(batch_futures):
+                    take_batch(*fut.result())
+
+                futures = [
+                    ex.submit(spark_worker, i, tid, q, a, rate_limiter, MAX_RETRY, SPARK_TIMEOUT_SEC, cache)
+                    for (i, tid, q, a) in schedule(tasks)
+                ]
+
+                for fut in as_completed(futures):
+                    apply_result(fut.result())
+        finally:
+            if WS_POOL is not None:
+                WS_POOL.close()
+                WS_POOL = None
+
+    # deferred retry pass: backoff per error class without holding Step B workers
+    pending = dead_letters.pending(include_gave_up=retry_only) if (RETRY_AT_END or retry_only) else {}
+    if pending:
+        print("=" * 90)
+        print(f"[RETRY] dead letters={len(pending)} | workers={RETRY_WORKERS} | {DEAD_LETTER_PATH}")
+
+        def retry_row(i):
+            a = compacted[i].text if i in compacted else str(df.at[i, "answer"]).strip()
+            res = spark_worker(i, df.at[i, "transcriptid"], str(df.at[i, "question"]).strip(),
+                               a, rate_limiter, 0, SPARK_TIMEOUT_SEC, cache)
+            return res, res["spark_parse_error"] or None
+
+        def retried(key, res):
+            apply_result(res, from_retry=True)
+            dead_letters.resolve(key)
+
+        def gave_up(key, res, err, err_class, attempts):
+            if res is not None:
+                apply_result(res, from_retry=True)
+            dead_letters.give_up(key, {"row": pending[key]["row"], "error": str(err), "error_class": err_class,
+                                       "attempts": attempts})
+
+        lost = run_retry_pass([(key, rec["row"], rec["error"]) for key, rec in pending.items() if rec["row"] in df.index],
+                              retry_row, RETRY_WORKERS, retried, gave_up)
+        print(f"[RETRY] done | gave_up={sum(lost.values())} {lost if lost else ''}")
+    dead_letters.close()
+
+    journal.close()
+    if HEDGE is not None:
+        print(f"[HEDGE] {HEDGE.summary()} | p{HEDGE_PERCENTILE:g}, budget={HEDGE_BUDGET:.0%}")
+        HEDGE_POOL.shutdown(wait=False)
+        HEDGE, HEDGE_POOL = None, None
+    if TELEMETRY is not None:
+        TELEMETRY.close()
+        print(TELEMETRY.summary_text())
+        print("[TELEMETRY] calls saved:", TELEMETRY_PATH)
+        TELEMETRY = None
+    fan_out(df, dedup_rep, ["spark_raw", "spark_json_extracted", "spark_assessment", "spark_pred_nonanswer",
+                            "spark_parse_error", "final_pred_nonanswer"])
+    if DEDUP_MODE != "none":
+        write_table(cluster_table(df, dedup_rep), CLUSTERS_PATH)
+        print("[DEDUP] clusters saved:", CLUSTERS_PATH)
+    if compacted:
+        write_table(pd.DataFrame([{"transcriptid": df.at[i, "transcriptid"],
+                                   "qid": df.at[i, "qid"] if "qid" in df.columns else pd.NA,
+                                   "row": i, **c.record()} for i, c in compacted.items()]), COMPACTION_PATH)
+        report_compaction(df, dedup_rep, compacted)
+        print("[COMPACT] saved:", COMPACTION_PATH)
+    write_table(df, out_path)
     print("\n[DONE] Saved:", out_path)
-    print(f"[SUMMARY] total_rows={len(df)} | kw0->0 skipped={skipped_as_zero} | spark_called={len(tasks)}")
+    if cache.cache is not None:
+        print(f"[CACHE] hits={cache.cache.hits} | misses={cache.cache.misses} | {CACHE_PATH}")
+        cache.cache.close()
+    print(f"[SUMMARY] total_rows={len(df)} | kw0->0 skipped={skipped_as_zero} | spark_called={n_queued} | resumed={len(resumed)}")
     if len(df) > 0:
-        print(f"[SUMMARY] call_rate={(len(tasks)/len(df)):.1%} | skipped_rate={(skipped_as_zero/len(df)):.1%}")
+        print(f"[SUMMARY] call_rate={(n_queued/len(df)):.1%} | skipped_rate={(skipped_as_zero/len(df)):.1%}")
 
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser(description="Keyword prefilter + Spark Max non-answer classification")
+    ap.add_argument("--retry-dead-letters", action="store_true",
+                    help="skip Step B and only retry the rows dead-lettered by an earlier run")
+    main(retry_only=ap.parse_args().retry_dead_letters)
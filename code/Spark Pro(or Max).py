@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 
-import re
+import os
 import json
 import time
-import base64
-import hmac
-import hashlib
+import asyncio
 import pandas as pd
-from urllib.parse import urlencode, urlparse
-from email.utils import formatdate, parsedate_to_datetime
 
-import websocket  
+
+from qa_io import read_table, write_table  # .parquet / .xlsx by suffix
+from qa_dataset import dataset_filters, sliced_path  # YEARS / SECTORS slices
+from spark_store import ResponseCache, PromptCache, ResultJournal
+from spark_client import AsyncSparkClient, AdaptiveRateLimiter, SignedUrlCache, WarmConnectionPool, read_frame, open_ws
+from spark_client import extract_label, label_stop_rule, PROMPT_TEMPLATE_LABEL_FIRST, CallTrace
+from spark_telemetry import Telemetry, record_call
+from spark_batch import plan_batches, score_batch, score_batch_async, parse_model_json
 
 
 
@@ -31,6 +34,9 @@ API_SECRET = API_SECRET.strip()
 # 1) Spark Pro 
 SPARK_URL = "wss://spark-api.xf-yun.com/v3.5/chat"
 SPARK_DOMAIN = "generalv3.5"  # Spark Pro
+SPARK_TEMPERATURE = 0.2
+SPARK_MAX_TOKENS = 1024
+SPARK_BATCH_MAX_TOKENS = 4096  # batched prompts answer K pairs at once
 
 
 
@@ -67,8 +73,16 @@ Return JSON in this exact format:
 """
 
 
+LABEL_FIRST = False        # True: spark_client.PROMPT_TEMPLATE_LABEL_FIRST, label before rationale
+COLLECT_RATIONALE = True   # LABEL_FIRST only -- False: close the socket once the label is read
+# part of every cache key: bump it whenever PROMPT_TEMPLATE, spark_client.PROMPT_TEMPLATE_LABEL_FIRST
+# or the way replies are parsed change, so responses cached for the old prompt are not replayed
+PROMPT_VERSION = "1"
+
+
 def make_prompt(question: str, answer: str, comments: str = "N/A") -> str:
-    return PROMPT_TEMPLATE.format(
+    template = PROMPT_TEMPLATE_LABEL_FIRST if LABEL_FIRST else PROMPT_TEMPLATE
+    return template.format(
         question=(question or "").strip(),
         answer=(answer or "").strip(),
         comments=(comments or "N/A").strip(),
@@ -77,36 +91,11 @@ def make_prompt(question: str, answer: str, comments: str = "N/A") -> str:
 
 
 # 3) genertae URL
-def build_auth(ws_url: str, api_key: str, api_secret: str):
-    """
-    返回: (authed_url, date_str, host)
-    """
-    u = urlparse(ws_url)
-    host = u.netloc  # more stable by using netloc 
-    path = u.path
-
-    
-    date_str = formatdate(timeval=None, localtime=False, usegmt=True)
-
-    signature_origin = f"host: {host}\n" f"date: {date_str}\n" f"GET {path} HTTP/1.1"
-
-    signature_sha = hmac.new(
-        api_secret.encode("utf-8"),
-        signature_origin.encode("utf-8"),
-        digestmod=hashlib.sha256,
-    ).digest()
-    signature = base64.b64encode(signature_sha).decode("utf-8")
-
-    authorization_origin = (
-        f'api_key="{api_key}", algorithm="hmac-sha256", '
-        f'headers="host date request-line", signature="{signature}"'
-    )
-    authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode("utf-8")
-
-    params = {"authorization": authorization, "date": date_str, "host": host}
-    authed_url = ws_url + "?" + urlencode(params)
-    return authed_url, date_str, host
-
+# Signed URL is reused for its validity window; the clock offset measured from
+# the server `date` header is applied when re-signing (see spark_client).
+AUTH = SignedUrlCache(SPARK_URL, API_KEY, API_SECRET)
+WS_POOL = None  # WarmConnectionPool, set in main() when PREWARM_CONNECTIONS > 0
+TELEMETRY = None  # spark_telemetry.Telemetry, set in main() when TELEMETRY_PATH
 
 
 # 4) Spark
@@ -117,42 +106,27 @@ def spark_chat_once(
     max_tokens: int = 1024,
     timeout_sec: int = 60,
     debug_time: bool = False,
+    stop_when=None,
+    trace: CallTrace = None,
 ) -> str:
-    authed_url, date_str, _host = build_auth(SPARK_URL, API_KEY, API_SECRET)
-
-    if debug_time:
-        print(f"[AUTH] client date_str = {date_str} (GMT RFC1123)")
-
+    trace = trace or CallTrace(uid)
     try:
-        ws = websocket.create_connection(
-            authed_url,
-            timeout=timeout_sec,
-            
-            header=[f"X-Date: {date_str}"],
-        )
-    except websocket._exceptions.WebSocketBadStatusException as e:
-        
-        server_date = None
-        try:
-            # resp_headers 可能是 dict
-            server_date = (e.resp_headers or {}).get("date") or (e.resp_headers or {}).get("Date")
-        except Exception:
-            server_date = None
-
-        if debug_time:
-            print("[AUTH] handshake failed.")
-            print("       client date_str:", date_str)
-            if server_date:
-                print("       server date    :", server_date)
-                try:
-                    dt_client = parsedate_to_datetime(date_str)
-                    dt_server = parsedate_to_datetime(server_date)
-                    skew_sec = abs((dt_client - dt_server).total_seconds())
-                    print(f"       |client-server| skew_sec = {skew_sec:.1f}")
-                except Exception as _:
-                    pass
-
+        text = _spark_chat(prompt, uid, temperature, max_tokens, timeout_sec, debug_time, stop_when, trace)
+    except Exception as e:
+        record_call(TELEMETRY, trace, error=e)
         raise
+    record_call(TELEMETRY, trace, text)
+    return text
+
+
+def _spark_chat(prompt, uid, temperature, max_tokens, timeout_sec, debug_time, stop_when, trace) -> str:
+    if WS_POOL is not None and not debug_time:
+        ws = WS_POOL.acquire()
+        ws.settimeout(timeout_sec)
+        trace.pooled = True
+        trace.mark("connected")
+    else:
+        ws = open_ws(AUTH, timeout_sec=timeout_sec, debug_time=debug_time, trace=trace)
 
     req = {
         "header": {"app_id": APP_ID, "uid": uid},
@@ -167,23 +141,13 @@ def spark_chat_once(
     chunks = []
     try:
         while True:
-            raw = ws.recv()
-            msg = json.loads(raw)
-
-            code = msg.get("header", {}).get("code", -1)
-            if code != 0:
-                raise RuntimeError(
-                    f"Spark API error code={code}, message={msg.get('header', {}).get('message')}"
-                )
-
-            choices = msg.get("payload", {}).get("choices", {})
-            status = choices.get("status", 0)
-            for t in choices.get("text", []):
-                if isinstance(t, dict) and "content" in t:
-                    chunks.append(t["content"])
-
+            # non-zero header.code -> SparkAPIError (a RuntimeError carrying .code)
+            status = read_frame(ws.recv(), chunks, trace)
             if status == 2:
                 break
+            # label-first: stop reading (and close) once the label has arrived
+            if stop_when is not None and stop_when("".join(chunks)):
+                break
     finally:
         ws.close()
 
@@ -191,27 +155,7 @@ def spark_chat_once(
 
 
 
-# 5) JSON 
-def parse_model_json(text: str):
-    if not text or str(text).strip() == "":
-        return None, "empty_response", ""
-
-    try:
-        return json.loads(text), None, text
-    except Exception:
-        pass
-
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if not m:
-        return None, "no_json_object_found", text
-
-    cand = m.group(0).strip()
-    try:
-        return json.loads(cand), None, cand
-    except Exception as e:
-        return None, f"json_parse_failed: {repr(e)}", cand
-
-
+# 5) JSON: replies are parsed by spark_batch.parse_model_json (single objects and batch arrays)
 def safe_preview(s: str, n: int = 220) -> str:
     s = "" if s is None else str(s)
     s = s.replace("\n", " ").replace("\r", " ")
@@ -238,19 +182,154 @@ def eval_binary(y_true, y_pred):
 
 
 
+# 6b) result handling (shared by the serial loop and the asyncio mode)
+def store_spark_result(df, i, raw, last_err, verbose: bool = True):
+    if raw is None:
+        df.at[i, "spark_parse_error"] = f"call_failed: {last_err}"
+        return
+
+    df.at[i, "spark_raw"] = raw
+    if verbose:
+        print("[OK] raw_head:", safe_preview(raw, 220))
+
+    parsed, err, extracted = parse_model_json(raw)
+    df.at[i, "spark_json_extracted"] = extracted
+    df.at[i, "spark_parse_error"] = err or ""
+
+    label = extract_label(raw) if (err and LABEL_FIRST) else None
+    if label is not None:
+        # stream closed after the label (or rationale cut off): keep the label
+        df.at[i, "spark_json_extracted"] = ""
+        df.at[i, "spark_parse_error"] = ""
+        df.at[i, "spark_pred_nonanswer"] = label
+        if verbose:
+            print("[OK] pred_nonanswer (label only) =", label)
+    elif err:
+        if verbose:
+            print("[WARN] JSON parse error:", err)
+    else:
+        df.at[i, "spark_assessment"] = parsed.get("assessment", "")
+        df.at[i, "spark_pred_nonanswer"] = parsed.get("your_classification", pd.NA)
+        if verbose:
+            print("[OK] pred_nonanswer =", df.at[i, "spark_pred_nonanswer"])
+
+
+
+# 6c) asyncio mode: many rows in flight on one event loop
+async def spark_call_async(row_i, tid, prompt, client: AsyncSparkClient, max_retry: int, cache: PromptCache):
+    key, raw = cache.lookup(prompt)
+    if raw is not None:
+        return row_i, raw, None
+
+    last_err = None
+    for attempt in range(max_retry + 1):
+        try:
+            raw = await client.chat(prompt, uid=f"transcript_{tid}",
+                                    temperature=SPARK_TEMPERATURE, max_tokens=SPARK_MAX_TOKENS,
+                                    stop_when=label_stop_rule(LABEL_FIRST, COLLECT_RATIONALE))
+            cache.store(key, raw)
+            return row_i, raw, None
+        except Exception as e:
+            last_err = repr(e)
+            print(f"[ERROR] row={row_i} call_failed attempt={attempt+1}/{max_retry+1} -> {last_err}")
+            await asyncio.sleep(1.0)
+    return row_i, None, last_err
+
+
+async def run_spark_async(df, rows, client: AsyncSparkClient, max_retry: int, on_result, cache: PromptCache,
+                          batches=(), on_batch=None):
+    """Batches first (their leftovers are appended to `rows` by on_batch), then single rows."""
+    try:
+        coros = [
+            score_batch_async(b, lambda prompt, b=b: client.chat(prompt, uid=batch_uid(df, b), temperature=SPARK_TEMPERATURE,
+                                                                  max_tokens=SPARK_BATCH_MAX_TOKENS), parse_model_json)
+            for b in batches
+        ]
+        for fut in asyncio.as_completed(coros):
+            on_batch(*(await fut))
+
+        coros = []
+        for i in rows:
+            q = str(df.at[i, "question"]).strip()
+            a = str(df.at[i, "answer"]).strip()
+            coros.append(spark_call_async(i, df.at[i, "transcriptid"], make_prompt(q, a, comments="N/A"), client, max_retry, cache))
+        for fut in asyncio.as_completed(coros):
+            on_result(*(await fut))
+    finally:
+        await client.aclose()
+
+
+
+# 6d) batched prompts: K rows per request; rows the response misses go back to single scoring
+def batch_rows(df, rows):
+    return [(i, str(df.at[i, "question"]).strip(), str(df.at[i, "answer"]).strip()) for i in rows]
+
+
+def batch_uid(df, batch) -> str:
+    return f"transcript_{df.at[batch[0][0], 'transcriptid']}_batch{len(batch)}"
+
+
+def spark_batch_call(prompt: str, uid: str, rate_limiter: AdaptiveRateLimiter) -> str:
+    trace = CallTrace(uid, kind="batch")
+    rate_limiter.wait_turn()
+    trace.mark("admitted")
+    try:
+        raw = spark_chat_once(prompt, uid=uid, temperature=SPARK_TEMPERATURE, max_tokens=SPARK_BATCH_MAX_TOKENS,
+                              trace=trace)
+    except Exception as e:
+        rate_limiter.on_error(e)
+        raise
+    rate_limiter.on_success()
+    return raw
+
+
+
 # 7) Main program
 def main():
-    in_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer.xlsx"
-    out_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer__sparkpro_scored.xlsx"
+    global WS_POOL, TELEMETRY
+
+    in_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer.parquet"
+    out_path = r"D:\2025_26 Spring\Replication\Q&A_with_nonanswer__sparkpro_scored.parquet"
+
+    # score a slice of the corpus: only the matching partitions of a qa_dataset directory (or rows of a
+    # file with year / gsector columns) are read, and the outputs get a __year...__gsector... suffix
+    YEARS = None      # e.g. ["2013-2016"] or [2019, 2021]; None = all years
+    SECTORS = None    # 2-digit GICS sectors, e.g. ["45"]; None = all sectors
+    FILTERS = dataset_filters(YEARS, SECTORS)
+    out_path = sliced_path(out_path, FILTERS)
 
-    SLEEP_BETWEEN_CALLS_SEC = 0.25
-    CHECKPOINT_EVERY_N = 20
+    SLEEP_BETWEEN_CALLS_SEC = 0.25   # starting pace; adapted on Spark throttle codes
     MAX_RETRY = 1
 
+    USE_ASYNC = False              # True: asyncio client, many rows in flight
+    ASYNC_CONCURRENCY = 200
+    ASYNC_START_INTERVAL_SEC = 0.08  # starting pace in asyncio mode
+    LIMIT_BURST = 5
+    LIMIT_MAX_QPS = None           # AIMD ceiling; None = the starting pace, so it only ever backs off
+    PREWARM_CONNECTIONS = 0        # handshaken sockets kept ready ahead of demand (0 = off, opt-in)
+
+    # responses keyed by (prompt, model, domain, temperature, max_tokens, PROMPT_VERSION); None = no cache.
+    # Changed the prompt or parsing? bump PROMPT_VERSION or delete this file before the next run.
+    CACHE_PATH = r"D:\2025_26 Spring\Replication\spark_cache.sqlite"
+    CACHE_MAX_MB = 512
+
+    # every answered row is appended here; a restart replays it and skips those rows
+    JOURNAL_PATH = os.path.splitext(out_path)[0] + ".journal.jsonl"
+
+    # per-attempt stage timings / frames / usage tokens (.jsonl streamed, .csv/.parquet at the end; None = off),
+    # a Prometheus text dump at the end and, with TELEMETRY_PORT, live at http://127.0.0.1:PORT/metrics
+    TELEMETRY_PATH = os.path.splitext(out_path)[0] + ".calls.jsonl"
+    TELEMETRY_PROM_PATH = os.path.splitext(out_path)[0] + ".calls.prom"
+    TELEMETRY_PORT = 0
+
+    # batched prompts: up to BATCH_K rows per request within BATCH_TOKEN_BUDGET prompt tokens (1 = off)
+    BATCH_K = 1
+    BATCH_TOKEN_BUDGET = 6000
+
     print("=" * 90)
-    print("[START] Loading Excel")
-    df = pd.read_excel(in_path, engine="openpyxl")
-    print(f"[OK] rows={len(df):,}, cols={len(df.columns)}")
+    print("[START] Loading", in_path)
+    df = read_table(in_path, filters=FILTERS)
+    print(f"[OK] rows={len(df):,}, cols={len(df.columns)}" + (f" | filter={FILTERS}" if FILTERS else ""))
     print("[INFO] columns:", list(df.columns))
 
     required = {"transcriptid", "question", "answer"}
@@ -274,6 +353,8 @@ def main():
     try:
         raw = spark_chat_once('just reply one JSON：{"ok":true}', uid="smoke_test", max_tokens=50, temperature=0.0, debug_time=True)
         print("[SMOKE] success, raw:", safe_preview(raw, 200))
+        if TELEMETRY_PATH:
+            TELEMETRY = Telemetry(TELEMETRY_PATH, prom_path=TELEMETRY_PROM_PATH, port=TELEMETRY_PORT)
     except Exception as e:
         print("[SMOKE] failed:", repr(e))
         print("         If you see a large skew_sec value: Please set your Windows time to automatic synchronization (error should be <300 seconds).")
@@ -282,54 +363,120 @@ def main():
     print("=" * 90)
     print("[RUN] Calling Spark Pro ...")
     t0 = time.time()
+    cache = PromptCache(ResponseCache(CACHE_PATH, max_mb=CACHE_MAX_MB) if CACHE_PATH else None,
+                        SPARK_URL, SPARK_DOMAIN, SPARK_TEMPERATURE, SPARK_MAX_TOKENS, PROMPT_VERSION,
+                        replayable=lambda raw: parse_model_json(raw)[1] is None)
+
+    journal = ResultJournal(JOURNAL_PATH)
+    journaled = journal.replay()
+
+    todo = []
+    for i in df.index:
+        rec = journaled.get(ResultJournal.row_key(df, i))
+        if rec is not None:
+            store_spark_result(df, i, rec["raw"], None, verbose=False)
+        else:
+            todo.append(i)
+    print(f"[RESUME] journal rows={len(df) - len(todo):,} | to score={len(todo):,} | {JOURNAL_PATH}")
+
+    def journal_row(i, raw):
+        if raw is not None:
+            journal.append(ResultJournal.row_key(df, i), {"raw": raw})
+
+    # batch phase: rows not answered by the cache are packed K per request;
+    # whatever a batch response misses goes back to the single-row queue
+    batches = []
+    if BATCH_K > 1:
+        batchable = [r for r in batch_rows(df, todo) if not cache.contains(make_prompt(r[1], r[2], comments="N/A"))]
+        batches = [b for b in plan_batches(batchable, BATCH_K, BATCH_TOKEN_BUDGET, text_of=lambda r: r[1] + r[2]) if len(b) > 1]
+        in_batch = {r[0] for b in batches for r in b}
+        todo = [i for i in todo if i not in in_batch]
+        print(f"[BATCH] requests={len(batches)} | rows={len(in_batch)} | single={len(todo)}")
+
+    def take_batch(got, missing, err):
+        for i, txt in got.items():
+            store_spark_result(df, i, txt, None, verbose=False)
+            journal_row(i, txt)
+        todo.extend(missing)
+        print(f"[BATCH] scored={len(got)} | re-queued={len(missing)} | err={err}")
+
+    if USE_ASYNC:
+        done = 0
+
+        def on_result(i, raw, last_err):
+            nonlocal done
+            done += 1
+            print(f"\n[PROGRESS] done {done}/{len(todo)} row={i} transcriptid={df.at[i, 'transcriptid']} elapsed={time.time()-t0:.1f}s")
+            store_spark_result(df, i, raw, last_err)
+            journal_row(i, raw)
+
+        client = AsyncSparkClient(
+            APP_ID, API_KEY, API_SECRET, SPARK_URL, SPARK_DOMAIN,
+            concurrency=ASYNC_CONCURRENCY,
+            limiter=AdaptiveRateLimiter(1.0 / ASYNC_START_INTERVAL_SEC, burst=LIMIT_BURST,
+                                        max_rate=LIMIT_MAX_QPS or 1.0 / ASYNC_START_INTERVAL_SEC),
+            prewarm=PREWARM_CONNECTIONS,
+            telemetry=TELEMETRY,
+        )
+        asyncio.run(run_spark_async(df, todo, client, MAX_RETRY, on_result, cache, batches, take_batch))
+    else:
+        rate_limiter = AdaptiveRateLimiter(1.0 / SLEEP_BETWEEN_CALLS_SEC,
+                                           max_rate=LIMIT_MAX_QPS or 1.0 / SLEEP_BETWEEN_CALLS_SEC)
+        if PREWARM_CONNECTIONS > 0:
+            WS_POOL = WarmConnectionPool(lambda: open_ws(AUTH), size=PREWARM_CONNECTIONS, fillers=1)
 
-    for k, i in enumerate(df.index, start=1):
-        tid = df.at[i, "transcriptid"]
-        q = str(df.at[i, "question"]).strip()
-        a = str(df.at[i, "answer"]).strip()
-
-        print(f"\n[PROGRESS] {k}/{len(df)} row={i} transcriptid={tid} q_len={len(q)} a_len={len(a)}")
-
-        prompt = make_prompt(q, a, comments="N/A")
-
-        raw = None
-        last_err = None
-
-        for attempt in range(MAX_RETRY + 1):
-            try:
-                raw = spark_chat_once(prompt, uid=f"transcript_{tid}", debug_time=False)
-                break
-            except Exception as e:
-                last_err = repr(e)
-                print(f"[ERROR] call_failed attempt={attempt+1}/{MAX_RETRY+1} -> {last_err}")
-                time.sleep(1.0)
-
-        if raw is None:
-            df.at[i, "spark_parse_error"] = f"call_failed: {last_err}"
-            continue
+        for b in batches:
+            take_batch(*score_batch(b, lambda prompt: spark_batch_call(prompt, batch_uid(df, b), rate_limiter), parse_model_json))
 
-        df.at[i, "spark_raw"] = raw
-        print("[OK] raw_head:", safe_preview(raw, 220))
+        for k, i in enumerate(todo, start=1):
+            tid = df.at[i, "transcriptid"]
+            q = str(df.at[i, "question"]).strip()
+            a = str(df.at[i, "answer"]).strip()
 
-        parsed, err, extracted = parse_model_json(raw)
-        df.at[i, "spark_json_extracted"] = extracted
-        df.at[i, "spark_parse_error"] = err or ""
+            print(f"\n[PROGRESS] {k}/{len(todo)} row={i} transcriptid={tid} q_len={len(q)} a_len={len(a)}")
 
-        if err:
-            print("[WARN] JSON parse error:", err)
-        else:
-            df.at[i, "spark_assessment"] = parsed.get("assessment", "")
-            df.at[i, "spark_pred_nonanswer"] = parsed.get("your_classification", pd.NA)
-            print("[OK] pred_nonanswer =", df.at[i, "spark_pred_nonanswer"])
+            prompt = make_prompt(q, a, comments="N/A")
 
-        if k % CHECKPOINT_EVERY_N == 0:
-            df.to_excel(out_path, index=False)
-            print(f"[SAVE] checkpoint -> {out_path}  elapsed={time.time()-t0:.1f}s")
+            key, raw = cache.lookup(prompt)
+            last_err = None
+            if raw is not None:
+                print("[CACHE] hit")
 
-        time.sleep(SLEEP_BETWEEN_CALLS_SEC)
-
-    df.to_excel(out_path, index=False)
+            for attempt in range(MAX_RETRY + 1 if raw is None else 0):
+                try:
+                    trace = CallTrace(f"transcript_{tid}")
+                    rate_limiter.wait_turn()
+                    trace.mark("admitted")
+                    raw = spark_chat_once(prompt, uid=trace.uid, debug_time=False,
+                                          temperature=SPARK_TEMPERATURE, max_tokens=SPARK_MAX_TOKENS,
+                                          stop_when=label_stop_rule(LABEL_FIRST, COLLECT_RATIONALE), trace=trace)
+                    rate_limiter.on_success()
+                    cache.store(key, raw)
+                    break
+                except Exception as e:
+                    rate_limiter.on_error(e)
+                    last_err = repr(e)
+                    print(f"[ERROR] call_failed attempt={attempt+1}/{MAX_RETRY+1} -> {last_err}")
+                    time.sleep(1.0)
+
+            store_spark_result(df, i, raw, last_err)
+            journal_row(i, raw)
+
+    if WS_POOL is not None:
+        WS_POOL.close()
+        WS_POOL = None
+
+    journal.close()
+    if TELEMETRY is not None:
+        TELEMETRY.close()
+        print(TELEMETRY.summary_text())
+        print("[TELEMETRY] calls saved:", TELEMETRY_PATH)
+        TELEMETRY = None
+    write_table(df, out_path)
     print("\n[DONE] Saved:", out_path)
+    if cache.cache is not None:
+        print(f"[CACHE] hits={cache.cache.hits} | misses={cache.cache.misses} | {CACHE_PATH}")
+        cache.cache.close()
 
     
     if "non_answer" in df.columns:
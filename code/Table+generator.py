@@ -1,16 +1,40 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 from pathlib import Path
 
+from qa_io import read_columns, read_table, write_workbook, TEXT_COLS
+
 
 IN_PATH = Path(r"Q&A.xlsx")  
 OUT_PATH = Path(r"replication_table2_table3_results.xlsx")
 
+# bootstrap CIs / paired comparisons for Table 2 (sheets Table2_bootstrap_CI, Table2_paired);
+# 0 = off, point-estimate tables only. Opt in with e.g. 10000. Measured on one core over 500k
+# Manual rows and 41 methods: ~5 s per 10,000 replicates resampling 20k transcripts, but ~210 s
+# when resampling pairs whose label patterns are all distinct (cost ~ replicates x distinct
+# patterns, at most x pairs); ~200 MB per worker process either way.
+BOOTSTRAP_REPS = 0
+BOOTSTRAP_CLUSTER = "transcriptid"  # resample whole transcripts; None = resample pairs
+BOOTSTRAP_SEED = 20240601
+BOOTSTRAP_WORKERS = os.cpu_count() or 1  # processes drawing replicates
+CI_LEVEL = 0.95
+BOOTSTRAP_METRICS = [
+    "Accuracy", "Type I error", "Type II error",
+    "Non-answers: Precision", "Non-answers: Recall", "Non-answers: F1 score",
+]
+
+# also write the per-pair labels (ids, Manual, every method) as sheet Predictions_rows
+WRITE_PREDICTION_ROWS = False
+
 
 def to_binary_series(s: pd.Series) -> pd.Series:
     """Coerce to 0/1 with NaNs preserved. Accepts strings like '1','0','yes','no'."""
     x = s.copy()
-    if x.dtype == "object":
+    if x.dtype == "object" or pd.api.types.is_string_dtype(x.dtype):
         x = (
             x.astype(str)
             .str.strip()
@@ -26,70 +50,221 @@ def to_binary_series(s: pd.Series) -> pd.Series:
     return x
 
 
-def confusion_metrics(y_true: pd.Series, y_pred: pd.Series) -> dict:
-    """Compute confusion matrix + paper-style metrics. Positive class = 1 (non-answer)."""
-    mask = y_true.notna() & y_pred.notna()
-    yt = y_true[mask].astype(int)
-    yp = y_pred[mask].astype(int)
+# Vectorized engine: every method becomes one int8 column of a label matrix
+# (0/1, MISSING where to_binary_series gives NaN); counts for all methods come
+# from one matrix product with the truth vector.
+MISSING = np.int8(-1)
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def binary_values(s: pd.Series) -> np.ndarray:
+    """to_binary_series(s) as float64, converting each distinct text value once."""
+    if pd.api.types.is_numeric_dtype(s.dtype) or pd.api.types.is_bool_dtype(s.dtype):
+        return pd.to_numeric(s, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    codes, uniques = pd.factorize(s)
+    lut = to_binary_series(pd.Series(np.asarray(uniques, dtype=object), dtype=object))
+    lut = np.append(pd.to_numeric(lut, errors="coerce").to_numpy(dtype=float, na_value=np.nan), np.nan)
+    return lut[codes]  # code -1 (missing) picks the trailing NaN
 
-    TP = int(((yt == 1) & (yp == 1)).sum())
-    FP = int(((yt == 0) & (yp == 1)).sum())
-    TN = int(((yt == 0) & (yp == 0)).sum())
-    FN = int(((yt == 1) & (yp == 0)).sum())
-    N = int(len(yt))
 
-    acc = (TP + TN) / N if N else np.nan
-    type1 = FP / (FP + TN) if (FP + TN) else np.nan  # FP rate
-    type2 = FN / (FN + TP) if (FN + TP) else np.nan  # FN rate
-    prec = TP / (TP + FP) if (TP + FP) else np.nan
-    rec = TP / (TP + FN) if (TP + FN) else np.nan
+def is_binary(v: np.ndarray) -> bool:
+    ok = (v == 0) | (v == 1)
+    return bool(ok.any()) and bool((ok | np.isnan(v)).all())
 
-    # Paper's F1: TP / (TP + 0.5*(FP+FN))  (equals standard F1 when defined)
-    f1 = TP / (TP + 0.5 * (FP + FN)) if (TP + 0.5 * (FP + FN)) else np.nan
 
+def binary_matrix(values) -> np.ndarray:
+    """int8 (rows x methods) from a list of binary_values arrays; MISSING for NaN."""
+    M = np.full((len(values[0]) if values else 0, len(values)), MISSING, dtype=np.int8)
+    for j, v in enumerate(values):
+        ok = (v == 0) | (v == 1)
+        M[ok, j] = v[ok]
+    return M
+
+
+def confusion_counts(M: np.ndarray, y: np.ndarray) -> dict:
+    """
+    TP/FP/TN/FN/N per method (column of M) against truth y (int8, MISSING = no label).
+    Positive class = 1 (non-answer); a row counts for a method when both are present.
+    """
+    Y = np.stack([y == 1, y == 0]).astype(np.int32)            # 2 x rows
+    X = np.hstack([M == 1, M != MISSING]).astype(np.int32)      # rows x 2k
+    C = Y @ X                                                   # 2 x 2k
+    k = M.shape[1]
+    TP, FP = C[0, :k], C[1, :k]
+    n_pos, n_neg = C[0, k:], C[1, k:]
+    return {"TP": TP, "FP": FP, "TN": n_neg - FP, "FN": n_pos - TP, "N": n_pos + n_neg}
+
+
+def _div(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return np.divide(a, b, out=np.full(np.broadcast(a, b).shape, np.nan), where=b != 0)
+
+
+def confusion_metrics(TP, FP, TN, FN) -> dict:
+    """Paper-style metrics from count arrays (any shape, elementwise). Positive class = 1 (non-answer)."""
+    N = TP + FP + TN + FN
+    acc = _div(TP + TN, N)
     # For single-label binary classification, micro avg precision/recall/F1 == accuracy
     return {
-        "TP": TP, "FP": FP, "TN": TN, "FN": FN, "N": N,
         "Accuracy": acc,
-        "Type I error": type1,
-        "Type II error": type2,
-        "Non-answers: Precision": prec,
-        "Non-answers: Recall": rec,
-        "Non-answers: F1 score": f1,
+        "Type I error": _div(FP, FP + TN),  # FP rate
+        "Type II error": _div(FN, FN + TP),  # FN rate
+        "Non-answers: Precision": _div(TP, TP + FP),
+        "Non-answers: Recall": _div(TP, TP + FN),
+        # Paper's F1: TP / (TP + 0.5*(FP+FN))  (equals standard F1 when defined)
+        "Non-answers: F1 score": _div(TP, TP + 0.5 * (FP + FN)),
         "Total: Precision": acc,
         "Total: Recall": acc,
         "Total: F1 score": acc,
     }
 
 
-def summarize_binary(series: pd.Series) -> dict:
-    """Counts of 0/1 ignoring NaN."""
-    s = series.dropna().astype(int)
-    return {"Answer": int((s == 0).sum()), "Non-answer": int((s == 1).sum()), "N": int(len(s))}
+def binary_desc_stats(M: np.ndarray) -> pd.DataFrame:
+    """Table 3 descriptive stats (Obs, Mean, Std_Dev, P5..P95) per column of a 0/1 matrix."""
+    n = (M != MISSING).sum(axis=0).astype(float)
+    n1 = (M == 1).sum(axis=0).astype(float)
+    n0 = n - n1
+    out = {"Obs": n.astype(int), "Mean": _div(n1, n)}
+    out["Std_Dev"] = np.where(n == 1, 0.0, np.sqrt(_div(n1 * n0, n * (n - 1))))
+    for q in PERCENTILES:
+        # np.percentile (linear) of n0 zeros followed by n1 ones
+        pos = q / 100.0 * (n - 1)
+        lo, hi = np.floor(pos), np.ceil(pos)
+        v_lo, v_hi = (lo >= n0).astype(float), (hi >= n0).astype(float)
+        t = pos - lo
+        d = v_hi - v_lo
+        out[f"P{q}"] = np.where(n > 0, np.where(t >= 0.5, v_hi - d * (1 - t), v_lo + d * t), np.nan)
+    return pd.DataFrame(out)
+
+
+# Bootstrap for Table 2: each replicate is a vector of resampling weights over
+# clusters (transcripts, or single pairs), so the counts of all replicates and
+# all methods are one (replicates x clusters) @ (clusters x 4 methods) product.
+# Clusters with identical indicator rows are merged first: drawing G clusters
+# with replacement puts multinomial(G, share of each distinct row) weight on
+# the distinct rows, which is the same distribution on fewer columns (pairs
+# only have as many distinct rows as there are label patterns).
+def _distinct_rows(A: np.ndarray):
+    """(code of every row, position of the first row of each code), codes in order of appearance."""
+    A = np.ascontiguousarray(A)
+    codes, _ = pd.factorize(A.view(np.dtype((np.void, A.dtype.itemsize * A.shape[1]))).ravel())
+    return codes, np.unique(codes, return_index=True)[1]
+
+
+def cluster_indicators(M: np.ndarray, y: np.ndarray, groups=None):
+    """
+    Distinct per-cluster sums of [y1&p1, y0&p1, y1&labelled, y0&labelled] for
+    every method (distinct clusters x 4k) and the number of clusters with each.
+    """
+    def indicators(M, y):
+        has = M != MISSING
+        y1, y0 = (y == 1)[:, None], (y == 0)[:, None]
+        return np.hstack([y1 & (M == 1), y0 & (M == 1), y1 & has, y0 & has]).astype(float)
+
+    if groups is None:
+        codes, first = _distinct_rows(np.column_stack([M, y]))  # on the int8 labels, before widening
+        X = indicators(M[first], y[first])
+    else:
+        X = indicators(M, y)
+        X = pd.DataFrame(X).groupby(pd.factorize(pd.Series(groups))[0], sort=False).sum().to_numpy()
+        codes, first = _distinct_rows(X)
+        X = X[first]
+    return X, np.bincount(codes, minlength=len(first))
 
 
-def desc_stats(x: pd.Series) -> dict:
-    """Descriptive stats matching Table 2 format."""
-    x = x.dropna().astype(float)
-    if len(x) == 0:
-        return {
-            "Obs": 0, "Mean": np.nan, "Std_Dev": np.nan,
-            "P5": np.nan, "P25": np.nan, "P50": np.nan, "P75": np.nan, "P95": np.nan,
-        }
-    return {
-        "Obs": int(len(x)),
-        "Mean": float(x.mean()),
-        "Std_Dev": float(x.std(ddof=1)) if len(x) > 1 else 0.0,
-        "P5": float(np.percentile(x, 5)),
-        "P25": float(np.percentile(x, 25)),
-        "P50": float(np.percentile(x, 50)),
-        "P75": float(np.percentile(x, 75)),
-        "P95": float(np.percentile(x, 95)),
-    }
+_BOOT = {}  # per worker process: distinct cluster rows and how many clusters have each
 
 
-def detect_prediction_columns(df: pd.DataFrame, manual_col: str) -> list:
-    """Detect binary 0/1 columns excluding obvious id/text columns."""
+def _bootstrap_init(U: np.ndarray, n: np.ndarray):
+    _BOOT.update(U=U, n=n, G=int(n.sum()), inverse=None)
+
+
+def _draws_multinomial(n: np.ndarray) -> bool:
+    # multinomial draws cost ~ distinct rows per replicate, index draws ~ clusters
+    return len(n) * 8 <= n.sum()
+
+
+def _bootstrap_chunk(reps: int, seed) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    U, n, G = _BOOT["U"], _BOOT["n"], _BOOT["G"]
+    P = len(n)
+    if _draws_multinomial(n):
+        W = rng.multinomial(G, n / G, size=reps)
+    else:
+        if _BOOT["inverse"] is None:
+            _BOOT["inverse"] = np.repeat(np.arange(P), n)  # cluster -> distinct row
+        draws = _BOOT["inverse"][rng.integers(0, G, size=(reps, G))] + P * np.arange(reps)[:, None]
+        W = np.bincount(draws.ravel(), minlength=reps * P).reshape(reps, P)  # times each row is drawn
+    return W.astype(float) @ U
+
+
+def bootstrap_counts(U: np.ndarray, n: np.ndarray, reps: int, seed: int, workers: int,
+                     max_cells: int = 8_000_000) -> dict:
+    """
+    TP/FP/TN/FN arrays (reps x k) from cluster_indicators() output. Replicates
+    run in chunks of at most `max_cells` draws (8 bytes each) on `workers`
+    processes.
+    """
+    chunk = max(1, max_cells // max(1, len(n) if _draws_multinomial(n) else int(n.sum())))
+    sizes = [min(chunk, reps - s) for s in range(0, reps, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers <= 1 or len(sizes) == 1:
+        _bootstrap_init(U, n)
+        C = np.vstack([_bootstrap_chunk(r, s) for r, s in zip(sizes, seeds)])
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sizes)), initializer=_bootstrap_init,
+                                 initargs=(U, n)) as ex:
+            C = np.vstack(list(ex.map(_bootstrap_chunk, sizes, seeds)))
+    k = U.shape[1] // 4
+    TP, FP, n_pos, n_neg = C[:, :k], C[:, k:2 * k], C[:, 2 * k:3 * k], C[:, 3 * k:]
+    return {"TP": TP, "FP": FP, "TN": n_neg - FP, "FN": n_pos - TP}
+
+
+def nan_percentiles(B: np.ndarray, q) -> np.ndarray:
+    """np.nanpercentile(B, q, axis=0) (linear), from one sort instead of a loop over columns."""
+    S = np.sort(B, axis=0)  # NaN last
+    n = np.isfinite(B).sum(axis=0)
+    cols = np.arange(B.shape[1])
+    out = []
+    for p in q:
+        pos = p / 100.0 * np.maximum(n - 1, 0)
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        v_lo, v_hi = S[lo, cols], S[hi, cols]
+        out.append(np.where(n > 0, v_lo + (v_hi - v_lo) * (pos - lo), np.nan))
+    return np.array(out)
+
+
+def bootstrap_tables(point: dict, boot: dict, methods, metrics, level: float = 0.95):
+    """(CI table per method x metric, paired table per method pair x metric)."""
+    alpha = (1.0 - level) / 2.0
+    q = [100 * alpha, 100 * (1 - alpha)]
+    methods = np.asarray(methods, dtype=object)
+    ia, ib = np.triu_indices(len(methods), k=1)
+    ci, paired = [], []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN replicates (metric undefined)
+        for m in metrics:
+            est, B = np.asarray(point[m], dtype=float), boot[m]
+            lo, hi = nan_percentiles(B, q)
+            ci.append(pd.DataFrame({"Metric": m, "Estimate": est, "CI low": lo, "CI high": hi,
+                                    "SE": np.nanstd(B, axis=0, ddof=1), "Replicates": np.isfinite(B).sum(axis=0)},
+                                   index=pd.Index(methods, name="Method")))
+
+            # paired: both methods are scored on the same resample in every replicate
+            D = B[:, ia] - B[:, ib]
+            n = np.isfinite(D).sum(axis=0)
+            p_two = 2.0 * np.minimum(_div((D <= 0).sum(axis=0), n), _div((D >= 0).sum(axis=0), n))
+            dlo, dhi = nan_percentiles(D, q)
+            paired.append(pd.DataFrame({"Method A": methods[ia], "Method B": methods[ib],
+                                        "Difference (A-B)": est[ia] - est[ib], "CI low": dlo, "CI high": dhi,
+                                        "p-value": np.minimum(1.0, p_two), "Replicates": n},
+                                       index=pd.Index([m] * len(ia), name="Metric")))
+    return pd.concat(ci), pd.concat(paired)
+
+
+def detect_prediction_columns(df: pd.DataFrame, manual_col: str) -> dict:
+    """Binary 0/1 columns excluding obvious id/text columns -> {column: binary_values}."""
     core_like = {manual_col}
     exclude_names = {
         "transcriptid", "qid", "question", "answer",
@@ -99,140 +274,136 @@ def detect_prediction_columns(df: pd.DataFrame, manual_col: str) -> list:
         if str(c).strip().lower() in exclude_names:
             core_like.add(c)
 
-    pred_cols = []
+    pred = {}
     for c in df.columns:
         if c in core_like:
             continue
-        s = to_binary_series(df[c])
-        vals = s.dropna().unique()
-        if len(vals) and set(vals).issubset({0, 1}):
-            pred_cols.append(c)
-
-    return [c for c in df.columns if c in pred_cols]
-
-
-df = pd.read_excel(IN_PATH, engine="openpyxl")
-df.columns = [str(c).strip() for c in df.columns]
+        v = binary_values(df[c])
+        if is_binary(v):
+            pred[c] = v
+    return pred
 
-manual_col = next((c for c in df.columns if c.lower() == "manual"), None)
-if manual_col is None:
-    raise ValueError("Cannot find 'Manual' column (case-insensitive).")
 
-pred_cols = detect_prediction_columns(df, manual_col)
-if len(pred_cols) == 0:
-    raise ValueError("No binary prediction columns detected (0/1).")
+def main():
+    # Only the id / label columns are needed: skip question, answer and model text.
+    SKIP_COLS = set(TEXT_COLS)
+    load_cols = [c for c in read_columns(IN_PATH) if str(c).strip().lower() not in SKIP_COLS]
+    df = read_table(IN_PATH, columns=load_cols)
+    df.columns = [str(c).strip() for c in df.columns]
 
+    manual_col = next((c for c in df.columns if c.lower() == "manual"), None)
+    if manual_col is None:
+        raise ValueError("Cannot find 'Manual' column (case-insensitive).")
 
+    pred_values = detect_prediction_columns(df, manual_col)
+    pred_cols = list(pred_values)
+    if len(pred_cols) == 0:
+        raise ValueError("No binary prediction columns detected (0/1).")
 
-# Table 2 (was Table 1): Manual non-missing
+    labels = binary_matrix([pred_values[c] for c in pred_cols])  # full sample, rows x methods
+    manual = binary_values(df[manual_col])
+    has_manual = ~np.isnan(manual)
+    y_true = binary_matrix([manual[has_manual]])[:, 0]
+    labels_eval = labels[has_manual]
 
-manual = to_binary_series(df[manual_col])
-df_eval = df.loc[manual.notna()].copy()
 
-y_true = to_binary_series(df_eval[manual_col])
 
-table2_rows = [
-    "Answer", "Non-answer",
-    "Accuracy", "Type I error", "Type II error",
-    "Non-answers: Precision", "Non-answers: Recall", "Non-answers: F1 score",
-    "Total: Precision", "Total: Recall", "Total: F1 score",
-    "N",
-]
+    # Table 2 (was Table 1): Manual non-missing
 
-table2 = pd.DataFrame(index=table2_rows)
-
-# Manual counts
-manual_counts = summarize_binary(y_true)
-table2["Manual"] = [
-    manual_counts.get(r, np.nan) if r in ["Answer", "Non-answer", "N"] else np.nan
-    for r in table2_rows
-]
-table2.loc["N", "Manual"] = manual_counts["N"]
-
-confusion_rows = []
-for c in pred_cols:
-    y_pred = to_binary_series(df_eval[c])
-    cnts = summarize_binary(y_pred)
-    m = confusion_metrics(y_true, y_pred)
-
-    col_vals = {}
-    col_vals["Answer"] = cnts["Answer"]
-    col_vals["Non-answer"] = cnts["Non-answer"]
-    for k in [
+    table2_rows = [
+        "Answer", "Non-answer",
         "Accuracy", "Type I error", "Type II error",
         "Non-answers: Precision", "Non-answers: Recall", "Non-answers: F1 score",
         "Total: Precision", "Total: Recall", "Total: F1 score",
-    ]:
-        col_vals[k] = m[k]
-    col_vals["N"] = m["N"]
+        "N",
+    ]
 
-    table2[c] = [col_vals.get(r, np.nan) for r in table2_rows]
-    confusion_rows.append({"Method": c, **{k: m[k] for k in ["TP", "FP", "TN", "FN", "N"]}})
+    counts = confusion_counts(labels_eval, y_true)
+    metrics = confusion_metrics(counts["TP"], counts["FP"], counts["TN"], counts["FN"])
 
-confusion_df = pd.DataFrame(confusion_rows).set_index("Method")
+    table2 = pd.DataFrame(
+        {"Answer": (labels_eval == 0).sum(axis=0), "Non-answer": (labels_eval == 1).sum(axis=0), **metrics, "N": counts["N"]},
+        index=pred_cols,
+    ).T.reindex(table2_rows)
 
-# Format Table 2 for Excel display (avoid dtype crash)
-table2_fmt = table2.copy().astype("object")  
+    # Manual counts
+    table2.insert(0, "Manual", np.nan)
+    table2.loc["Answer", "Manual"] = int((y_true == 0).sum())
+    table2.loc["Non-answer", "Manual"] = int((y_true == 1).sum())
+    table2.loc["N", "Manual"] = int((y_true != MISSING).sum())
 
-for r in table2_rows:
-    if r in ["Answer", "Non-answer", "N"]:
-        table2_fmt.loc[r] = table2_fmt.loc[r].apply(lambda v: "" if pd.isna(v) else int(v))
-    else:
-        table2_fmt.loc[r] = table2_fmt.loc[r].apply(lambda v: "" if pd.isna(v) else round(float(v), 2))
+    confusion_df = pd.DataFrame({k: counts[k] for k in ["TP", "FP", "TN", "FN", "N"]},
+                                index=pd.Index(pred_cols, name="Method"))
 
+    # Format Table 2 for Excel display (avoid dtype crash)
+    table2_fmt = table2.copy().astype("object")  
 
+    for r in table2_rows:
+        if r in ["Answer", "Non-answer", "N"]:
+            table2_fmt.loc[r] = table2_fmt.loc[r].apply(lambda v: "" if pd.isna(v) else int(v))
+        else:
+            table2_fmt.loc[r] = table2_fmt.loc[r].apply(lambda v: "" if pd.isna(v) else round(float(v), 2))
 
-# Table 3 (was Table 2): Full sample, pair level only
 
-pair_stats = {}
-for c in pred_cols:
-    pair_stats[f"{c} - % non-answer"] = desc_stats(to_binary_series(df[c]))
-table3_pair = pd.DataFrame(pair_stats).T
 
+    # Table 3 (was Table 2): Full sample, pair level only
 
+    table3_pair = binary_desc_stats(labels)
+    table3_pair.index = [f"{c} - % non-answer" for c in pred_cols]
 
-# Write Excel (Table2_eval, Confusion_eval, Table3_pair_level)
 
-with pd.ExcelWriter(OUT_PATH, engine="openpyxl") as writer:
-    table2_fmt.to_excel(writer, sheet_name="Table2_eval")
-    confusion_df.to_excel(writer, sheet_name="Confusion_eval")
-    table3_pair.to_excel(writer, sheet_name="Table3_pair_level")
 
-    # Basic formatting
-    from openpyxl.styles import Font, Alignment
-    from openpyxl.utils import get_column_letter
+    # Table 2 bootstrap: percentile CIs and paired differences between methods
 
-    wb = writer.book
-    for ws_name in wb.sheetnames:
-        ws = wb[ws_name]
+    boot_groups = None
+    table2_ci = table2_paired = None
+    if BOOTSTRAP_REPS > 0:
+        if BOOTSTRAP_CLUSTER:
+            if BOOTSTRAP_CLUSTER in df.columns:
+                boot_groups = df[BOOTSTRAP_CLUSTER].to_numpy()[has_manual]
+            else:
+                print(f"[BOOT] no '{BOOTSTRAP_CLUSTER}' column: resampling pairs")
+        boot_counts = bootstrap_counts(*cluster_indicators(labels_eval, y_true, boot_groups),
+                                       BOOTSTRAP_REPS, BOOTSTRAP_SEED, BOOTSTRAP_WORKERS)
+        table2_ci, table2_paired = bootstrap_tables(
+            metrics, confusion_metrics(boot_counts["TP"], boot_counts["FP"], boot_counts["TN"], boot_counts["FN"]),
+            pred_cols, BOOTSTRAP_METRICS, CI_LEVEL,
+        )
 
-        # header
-        for cell in ws[1]:
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
 
-        # index column
-        for cell in ws["A"]:
-            if cell.row == 1:
-                continue
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(vertical="center", wrap_text=True)
 
-        # column widths
-        for col_idx in range(1, ws.max_column + 1):
-            col_letter = get_column_letter(col_idx)
-            max_len = 0
-            for row in range(1, ws.max_row + 1):
-                v = ws.cell(row=row, column=col_idx).value
-                if v is None:
-                    continue
-                max_len = max(max_len, len(str(v)))
-            ws.column_dimensions[col_letter].width = min(max(10, max_len + 2), 45)
+    # Write Excel (Table2_eval, Confusion_eval, Table3_pair_level[, Table2_bootstrap_CI, Table2_paired]
+    # [, Predictions_rows])
 
-        ws.freeze_panes = "B2" if ws.max_column > 1 else "A2"
+    sheets = {
+        "Table2_eval": table2_fmt,
+        "Confusion_eval": confusion_df,
+        "Table3_pair_level": table3_pair,
+    }
+    if table2_ci is not None:
+        sheets["Table2_bootstrap_CI"] = table2_ci
+        sheets["Table2_paired"] = table2_paired
+    if WRITE_PREDICTION_ROWS:
+        # one row per pair: id columns, Manual and every method as 0/1 (blank = missing)
+        id_cols = [c for c in df.columns if c != manual_col and c not in pred_values]
+        rows = df[id_cols].copy()
+        rows[manual_col] = pd.Series(manual, index=df.index).astype("Int8")
+        pred_rows = pd.DataFrame(labels, index=df.index, columns=pred_cols)
+        rows = pd.concat([rows, pred_rows.where(pred_rows != MISSING).astype("Int8")], axis=1)
+        sheets["Predictions_rows"] = rows
+
+    write_workbook(OUT_PATH, sheets, index={"Predictions_rows": False})
+
+    print(f"Saved: {OUT_PATH.resolve()}")
+    print("Prediction columns used:", pred_cols)
+    print("Manual non-missing rows for Table 2:", int(df[manual_col].notna().sum()))
+    print("Full rows for Table 3:", len(df))
+    if BOOTSTRAP_REPS > 0:
+        print(f"Bootstrap: {BOOTSTRAP_REPS} replicates, clusters={BOOTSTRAP_CLUSTER if boot_groups is not None else 'pairs'}, "
+              f"CI={CI_LEVEL:.0%}")
+    else:
+        print("Bootstrap: off (BOOTSTRAP_REPS = 0)")
 
-print(f"Saved: {OUT_PATH.resolve()}")
-print("Prediction columns used:", pred_cols)
-print("Manual non-missing rows for Table 2:", int(df[manual_col].notna().sum()))
-print("Full rows for Table 3:", len(df))
 
+if __name__ == "__main__":
+    main()
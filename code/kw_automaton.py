@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Aho-Corasick automaton for the keyword prefilter of Keyword+Spark Max.py.
+
+All entries of kw_logic.kw_dict / kw_dict_with_future are compiled once; each
+answer is then scanned in a single pass, independent of how many keywords the
+dictionary holds. Matching is case-insensitive substring matching (optionally
+restricted to whole words), and find() returns the same (match, matches)
+pair as kw_logic.find_kw_matches, with matches as sorted distinct keywords
+(the form written to kw_matches).
+
+kw_logic.find_kw_matches stays the reference: check_automaton() compares the
+two on random answers, and the script falls back to kw_logic for every row
+when they differ (e.g. kw_logic uses other case / word-boundary rules, or a
+kw_dict layout that iter_keywords does not read the same way).
+
+Uses pyahocorasick (pip install pyahocorasick) when it is installed and a
+pure-Python automaton otherwise.
+"""
+import random
+from collections import deque
+
+try:
+    import ahocorasick  # C implementation, optional
+except ImportError:
+    ahocorasick = None
+
+
+def iter_keywords(kw_dict):
+    """Keywords of a {category: [keywords]} dict, in dict order."""
+    for key, val in kw_dict.items():
+        if isinstance(val, (list, tuple, set, frozenset)):
+            yield from val
+        else:
+            yield key
+
+
+class KeywordAutomaton:
+    def __init__(self, keywords, whole_words: bool = False):
+        self.keywords = [k for k in dict.fromkeys(str(k) for k in keywords) if k.strip()]
+        self.whole_words = whole_words
+        patterns = [k.lower() for k in self.keywords]
+        if ahocorasick is not None:
+            self._impl = ahocorasick.Automaton()
+            for n, p in enumerate(patterns):
+                # several keywords can share a lowercase form
+                ids = self._impl.get(p, ()) + (n,)
+                self._impl.add_word(p, ids)
+            self._impl.make_automaton()
+            self._iter = self._iter_c
+        else:
+            self._build(patterns)
+            self._iter = self._iter_py
+        self._len = [len(p) for p in patterns]
+
+    @classmethod
+    def from_kw_dict(cls, kw_dict, whole_words: bool = False):
+        return cls(iter_keywords(kw_dict), whole_words=whole_words)
+
+    # ---- pure-Python automaton: goto dicts + failure links + merged outputs
+    def _build(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for n, p in enumerate(patterns):
+            s = 0
+            for ch in p:
+                nxt = self._goto[s].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[s][ch] = nxt
+                s = nxt
+            self._out[s] += (n,)
+
+        q = deque(self._goto[0].values())
+        while q:
+            s = q.popleft()
+            for ch, nxt in self._goto[s].items():
+                q.append(nxt)
+                f = self._fail[s]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def _iter_py(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        s = 0
+        for end, ch in enumerate(text):
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            if out[s]:
+                yield end, out[s]
+
+    def _iter_c(self, text):
+        return self._impl.iter(text)
+
+    # ---- matching
+    def find(self, text):
+        """(match, [matched keywords]) -- same contract as kw_logic.find_kw_matches."""
+        t = str(text).lower()
+        hit = set()
+        for end, ids in self._iter(t):
+            for n in ids:
+                if n in hit or (self.whole_words and not _on_word_bounds(t, end - self._len[n] + 1, end)):
+                    continue
+                hit.add(n)
+        matches = sorted({self.keywords[n] for n in hit})
+        return bool(matches), matches
+
+
+def _is_word(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+def _on_word_bounds(t: str, start: int, end: int) -> bool:
+    if _is_word(t[start]) and start > 0 and _is_word(t[start - 1]):
+        return False
+    if _is_word(t[end]) and end + 1 < len(t) and _is_word(t[end + 1]):
+        return False
+    return True
+
+
+def check_automaton(automaton: KeywordAutomaton, answers, reference, sample: int, seed: int = 0):
+    """
+    Compare automaton.find with reference(text) -> (match, matches) on `sample`
+    random answers. Returns None if they agree, else (number of differing
+    answers, checked, first differing position).
+    """
+    answers = list(answers)
+    if sample <= 0 or not answers:
+        return None
+    pos = sorted(random.Random(seed).sample(range(len(answers)), min(sample, len(answers))))
+    bad = []
+    for p in pos:
+        match, matches = reference(answers[p])
+        if automaton.find(answers[p]) != (bool(match), sorted(set(matches or []))):
+            bad.append(p)
+    if not bad:
+        return None
+    return len(bad), len(pos), bad[0]
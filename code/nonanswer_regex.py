@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Gow et al. (2021) non-answer regexes, shared by the Gow classifier and the
+evidence windows of qa_compact.
+
+ling_features.non_answers() is the reference: it reports regex_ids, which
+map to REFUSE / UNABLE / AFTERCALL through get_regexes_df()["category"]
+(classify_answer). The combined matcher -- one alternation per category and
+flag set, compiled once -- is built only from pattern objects ling_features
+compiled itself, so pattern text and flags are exactly its own:
+  - compiled patterns stored in the regexes frame, or
+  - compiled patterns held by the ling_features module whose text is a
+    pattern of the regexes frame.
+When neither is available build_matcher() returns None and classify_answers()
+goes through non_answers() row by row.
+
+classify_answers() runs each merged pattern over the whole answer column
+with Series.str.contains. The matcher searches the whole answer, while
+ling_features may search sentence by sentence; check_matcher() compares the
+two on random rows and callers fall back to non_answers() on any difference.
+"""
+import re
+import ast
+import sys
+import random
+import warnings
+
+import pandas as pd
+
+TYPES = ("REFUSE", "UNABLE", "AFTERCALL")
+
+_REGEXES_DF = None
+
+
+def get_regexes():
+    """ling_features.get_regexes_df(), loaded once."""
+    global _REGEXES_DF
+    if _REGEXES_DF is None:
+        from ling_features import get_regexes_df
+        _REGEXES_DF = get_regexes_df()
+    return _REGEXES_DF
+
+
+# ---- reference path: non_answers() -> regex_id -> category
+
+def regex_id_to_category(rid: int):
+    regexes_df = get_regexes()
+    try:
+        return str(regexes_df.loc[rid, "category"])
+    except Exception:
+        pass
+
+    if "regex_id" in regexes_df.columns:
+        m = regexes_df.loc[regexes_df["regex_id"] == rid, "category"]
+        if len(m) > 0:
+            return str(m.iloc[0])
+    return None
+
+
+def extract_regex_id(item):
+    if item is None:
+        return None
+    if isinstance(item, dict):
+        return item.get("regex_id", None)
+    if isinstance(item, str):
+        try:
+            d = ast.literal_eval(item.strip())
+            if isinstance(d, dict):
+                return d.get("regex_id", None)
+        except Exception:
+            return None
+    return getattr(item, "regex_id", None)
+
+
+def answer_categories(ans: str) -> set:
+    """Categories non_answers() reports for one (stripped, non-empty) text."""
+    from ling_features import non_answers
+    cats = set()
+    for item in non_answers([ans]) or []:
+        rid = extract_regex_id(item)
+        if rid is None:
+            continue
+        cat = regex_id_to_category(rid)
+        if cat is not None:
+            cats.add(cat)
+    return cats
+
+
+def classify_answer(ans_text, types=TYPES):
+    if ans_text is None or (isinstance(ans_text, float) and pd.isna(ans_text)):
+        return {"is_nonans": False, "is_refuse": False, "is_unable": False, "is_aftercall": False}
+
+    ans = str(ans_text).strip()
+    if ans == "":
+        return {"is_nonans": False, "is_refuse": False, "is_unable": False, "is_aftercall": False}
+
+    s = answer_categories(ans)
+    return {
+        "is_nonans": len(s.intersection(set(types))) > 0,
+        "is_refuse": "REFUSE" in s,
+        "is_unable": "UNABLE" in s,
+        "is_aftercall": "AFTERCALL" in s,
+    }
+
+
+# ---- combined matcher from ling_features' own compiled patterns
+
+def _module_patterns() -> dict:
+    """pattern text -> compiled pattern, for patterns compiled by ling_features (None if ambiguous)."""
+    from ling_features import non_answers
+    import ling_features
+    modules = {ling_features, sys.modules.get(getattr(non_answers, "__module__", ""), ling_features)}
+    known = {}
+    for mod in modules:
+        for obj in vars(mod).values():
+            if isinstance(obj, dict):
+                items = obj.values()
+            elif isinstance(obj, (list, tuple, pd.Series)):
+                items = obj
+            else:
+                items = (obj,)
+            for v in items:
+                if isinstance(v, re.Pattern):
+                    # the same text compiled with two flag sets -> can not tell which one is used
+                    prev = known.get(v.pattern, v)
+                    known[v.pattern] = v if prev is not None and prev.flags == v.flags else None
+    return known
+
+
+def ling_features_patterns(rdf: pd.DataFrame = None):
+    """{category: [compiled pattern, ...]} as ling_features compiled them, or None."""
+    rdf = get_regexes() if rdf is None else rdf
+    compiled = None
+    for col in rdf.columns:
+        if len(rdf) and rdf[col].map(lambda v: isinstance(v, re.Pattern)).all():
+            compiled = rdf[col]
+            break
+    if compiled is None:
+        known = _module_patterns()
+        for col in rdf.columns:
+            if len(rdf) and rdf[col].map(lambda v: isinstance(v, str) and known.get(v) is not None).all():
+                compiled = rdf[col].map(known)
+                break
+    if compiled is None:
+        return None
+    cats = rdf["category"].astype(str)
+    return {cat: list(compiled[cats == cat]) for cat in TYPES}
+
+
+def build_matcher(rdf: pd.DataFrame = None):
+    """{category: [regex, ...]} with patterns of equal flags merged into one alternation, or None."""
+    pats = ling_features_patterns(rdf)
+    if pats is None:
+        return None
+    matcher = {}
+    for cat, regs in pats.items():
+        by_flags = {}
+        for r in regs:
+            by_flags.setdefault(r.flags, []).append(r)
+        matcher[cat] = []
+        for flags, group in by_flags.items():
+            try:
+                # non-capturing wrap keeps each pattern's own groups/anchors intact
+                matcher[cat].append(re.compile("|".join(f"(?:{r.pattern})" for r in group), flags))
+            except re.error:
+                # backrefs / inline flags cannot be merged -> keep them separate
+                matcher[cat] += group
+    return matcher
+
+
+def _texts(answers):
+    return ["" if a is None or (isinstance(a, float) and pd.isna(a)) else str(a).strip() for a in answers]
+
+
+def classify_answers(answers, matcher, types=TYPES) -> pd.DataFrame:
+    """classify_answer over a whole column; matcher None = non_answers() per row."""
+    if matcher is None:
+        rows = [classify_answer(a, types) for a in answers]
+        return pd.DataFrame(rows, columns=["is_nonans", "is_refuse", "is_unable", "is_aftercall"]).astype(bool)
+
+    # object dtype keeps Python re semantics (Arrow strings would go through RE2)
+    texts = pd.Series(_texts(answers), dtype=object)
+    hits = {}
+    for cat, regs in matcher.items():
+        hit = pd.Series(False, index=texts.index)
+        for r in regs:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)  # "has match groups": only the hit is used
+                hit |= texts.str.contains(r, regex=True)
+        hits[cat] = hit & (texts != "")
+    none = pd.Series(False, index=texts.index)
+    out = pd.DataFrame({
+        "is_refuse": hits.get("REFUSE", none),
+        "is_unable": hits.get("UNABLE", none),
+        "is_aftercall": hits.get("AFTERCALL", none),
+    })
+    nonans = none.copy()
+    for cat in types:
+        if cat in hits:
+            nonans |= hits[cat]
+    out.insert(0, "is_nonans", nonans)
+    return out.astype(bool)
+
+
+def check_matcher(answers, matcher, sample: int, seed: int = 0):
+    """
+    Compare matcher with non_answers() on `sample` random rows of answers.
+    Returns None if they agree, else (number of differing rows, checked, first differing position).
+    """
+    answers = list(answers)
+    if matcher is None or sample <= 0 or not answers:
+        return None
+    pos = sorted(random.Random(seed).sample(range(len(answers)), min(sample, len(answers))))
+    picked = [answers[p] for p in pos]
+    fast = classify_answers(picked, matcher)
+    slow = classify_answers(picked, None)
+    bad = (fast != slow).any(axis=1).to_numpy()
+    if not bad.any():
+        return None
+    return int(bad.sum()), len(pos), pos[int(bad.argmax())]
+
+
+def sentence_hit_fn(types=TYPES):
+    """is_hit(text) for qa_compact: any pattern of `types` matches (non_answers() if no matcher)."""
+    matcher = build_matcher()
+    if matcher is None:
+        wanted = set(types)
+        return lambda s: bool(str(s).strip()) and bool(answer_categories(str(s).strip()) & wanted)
+    regs = [r for cat in types for r in matcher.get(cat, [])]
+    return lambda s: any(r.search(s) for r in regs)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Evidence-window compaction of long answers before they go into a prompt.
+
+The Stata step concatenates every Answer component of a question block, so
+some answers run to thousands of words. compact_answer() splits an answer
+into sentences, keeps the sentences that hit a keyword (kw_logic) or a
+non-answer regex (Gow et al.) plus `context` sentences on each side, and
+fits the result into a token budget; gaps are marked with " [...] " so the
+model can see that text was cut. Answers already within budget pass through
+unchanged (same prompt, same cache key).
+
+Every Compaction keeps what was dropped (record()), so agreement with the
+Manual labels can be compared between compacted and full answers.
+"""
+import re
+
+from nonanswer_regex import sentence_hit_fn
+from spark_batch import estimate_tokens
+
+GAP = " [...] "
+
+# sentence end (. ! ? before a capital / digit / quote) or a line break
+_SPLIT_RE = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])|\s*\n\s*")
+
+
+def split_sentences(text) -> list:
+    return [s.strip() for s in _SPLIT_RE.split(str(text or "")) if s and s.strip()]
+
+
+def spans(idx) -> str:
+    """[0, 1, 2, 5, 7, 8] -> "0-2,5,7-8" """
+    out = []
+    for n in idx:
+        if out and out[-1][1] == n - 1:
+            out[-1][1] = n
+        else:
+            out.append([n, n])
+    return ",".join(f"{a}" if a == b else f"{a}-{b}" for a, b in out)
+
+
+def join_kept(sentences, kept) -> str:
+    """Kept sentences in order, GAP wherever sentences were left out."""
+    parts = []
+    prev = -1
+    for n in kept:
+        if n != prev + 1:
+            parts.append(GAP.strip())
+        parts.append(sentences[n])
+        prev = n
+    if kept and kept[-1] != len(sentences) - 1:
+        parts.append(GAP.strip())
+    return " ".join(parts)
+
+
+class Compaction:
+    """
+    Result of compact_answer(). reason:
+      within_budget   answer unchanged
+      windows         hits + `context` sentences each side
+      context_<c>     windows narrowed to c sentences to fit the budget
+      hits_truncated  hit sentences alone were over budget, leading ones kept
+      no_hit_head     no sentence hit on its own, leading sentences kept
+    """
+
+    def __init__(self, sentences, kept, hits, tokens_in: int, reason: str, text: str = None):
+        self.sentences = sentences
+        self.kept = list(kept)
+        self.hits = list(hits)
+        self.tokens_in = tokens_in
+        self.reason = reason
+        self.text = join_kept(sentences, self.kept) if text is None else text
+        self.tokens_out = estimate_tokens(self.text)
+
+    @property
+    def applied(self) -> bool:
+        return self.reason != "within_budget"
+
+    @property
+    def dropped(self) -> list:
+        kept = set(self.kept)
+        return [n for n in range(len(self.sentences)) if n not in kept]
+
+    def record(self) -> dict:
+        dropped = self.dropped
+        return {
+            "compact_reason": self.reason,
+            "n_sentences": len(self.sentences),
+            "hit_sentences": spans(self.hits),
+            "kept_sentences": spans(self.kept),
+            "dropped_sentences": spans(dropped),
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "dropped_text": GAP.join(self.sentences[n] for n in dropped),
+        }
+
+
+def compact_answer(answer, is_hit, context: int = 1, token_budget: int = 800) -> Compaction:
+    """
+    is_hit(sentence) -> bool marks evidence sentences. Windows are narrowed
+    (context, context-1, ..., 0) until they fit `token_budget`.
+    """
+    answer = str(answer or "").strip()
+    tokens_in = estimate_tokens(answer)
+    sents = split_sentences(answer)
+    if tokens_in <= token_budget or len(sents) <= 1:
+        return Compaction(sents, range(len(sents)), [], tokens_in, "within_budget", text=answer)
+
+    cost = [estimate_tokens(s) + 1 for s in sents]
+    gap_cost = estimate_tokens(GAP)
+    hits = [n for n, s in enumerate(sents) if is_hit(s)]
+
+    def fit(order):
+        # take sentences in `order` while they fit; the first one always goes in
+        kept, used = [], 0
+        for n in order:
+            if kept and used + cost[n] + gap_cost > token_budget:
+                break
+            kept.append(n)
+            used += cost[n] + gap_cost
+        return sorted(kept)
+
+    if not hits:
+        return Compaction(sents, fit(range(len(sents))), hits, tokens_in, "no_hit_head")
+
+    for c in range(max(0, int(context)), -1, -1):
+        window = sorted({k for n in hits for k in range(max(0, n - c), min(len(sents), n + c + 1))})
+        if sum(cost[n] + gap_cost for n in window) <= token_budget:
+            return Compaction(sents, window, hits, tokens_in, "windows" if c == context else f"context_{c}")
+    return Compaction(sents, fit(hits), hits, tokens_in, "hits_truncated")
+
+
+def gow_hit_fn(types=("REFUSE", "UNABLE", "AFTERCALL")):
+    """is_hit from the Gow et al. non-answer regexes -- the same matcher the Gow script labels with."""
+    return sentence_hit_fn(types)
+
+
+def any_hit_fn(*fns):
+    fns = [f for f in fns if f is not None]
+    return lambda s: any(f(s) for f in fns)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Q&A pairs as a Parquet dataset partitioned by call year (and optionally by
+GICS sector), instead of one monolithic Final.dta / Final.parquet.
+
+    root/_manifest.json
+    root/year=2013/gsector=45/part-0.parquet
+    ...
+
+year comes from the call date (mostimportantdateutc) of the component
+table, gsector from the first two digits of gind in corporate
+information.dta. The manifest records the partition columns and their
+types plus the row count of every partition.
+
+Readers pass {column: values} filters to qa_io.read_table, which opens only
+the matching partitions; the runners take them as --years / --sectors (Gow)
+or YEARS / SECTORS (Spark scripts):
+
+    python qa_dataset.py --pairs Final.parquet --components "Clean_Q&A.dta" \\
+        --corp "corporate information.dta" --out qa_pairs_dataset
+    python "Gow et al 2021.py" --input qa_pairs_dataset --years 2013-2016 --sectors 45
+"""
+import os
+import json
+import shutil
+import argparse
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa  # pip install pyarrow
+import pyarrow.dataset as ds
+
+from qa_io import MANIFEST, arrow_table, read_table
+from qa_pairs import DATA_DIR, IN_PATH as COMPONENTS_PATH, OUT_PATH as PAIRS_PATH, iter_components
+
+CORP_PATH = os.path.join(DATA_DIR, "corporate information.dta")
+OUT_DIR = os.path.join(DATA_DIR, "qa_pairs_dataset")
+
+DATE_COL = "mostimportantdateutc"
+PARTITION_TYPES = {"year": "int16", "gsector": "string"}
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"  # pyarrow's hive name for a missing value
+
+# Stata dates that arrive as plain numbers (no %t format in the .dta, or a Parquet / CSV
+# export) count from 1960-01-01: %td in days, %tc in milliseconds. Any %td date before
+# year 9999 is below 3e6 in absolute value, any %tc time after 1960-01-02 above 8.6e7.
+STATA_TC_MIN = 1e7
+
+
+def stata_dates(d: pd.Series) -> pd.Series:
+    """Numeric Stata %td / %tc values -> datetime64; the unit is told apart by magnitude."""
+    vals = d.dropna()
+    unit = "ms" if len(vals) and vals.abs().median() > STATA_TC_MIN else "D"
+    return pd.to_datetime(d, unit=unit, origin="1960-01-01", errors="coerce")
+
+
+def call_years(path: str, chunk_rows: int = 500000) -> pd.Series:
+    """transcriptid -> call year, streamed from the component table (two columns read)."""
+    parts = []
+    for chunk in iter_components(path, chunk_rows, columns=["transcriptid", DATE_COL]):
+        parts.append(chunk.drop_duplicates("transcriptid"))
+    calls = pd.concat(parts, ignore_index=True).drop_duplicates("transcriptid")
+    raw = calls[DATE_COL]
+    # .dta columns with a %td / %tc format are already datetimes (read_stata convert_dates)
+    d = stata_dates(raw) if pd.api.types.is_numeric_dtype(raw) else pd.to_datetime(raw, errors="coerce", format="mixed")
+    unread = int((d.isna() & raw.notna() & (raw.astype(str).str.strip() != "")).sum())
+    if unread:
+        print(f"[DATASET] {unread:,} of {len(calls):,} calls have a {DATE_COL} that is not a date -> year missing")
+    years = d.dt.year.astype("Int16")
+    return pd.Series(years.array, index=calls["transcriptid"].astype("int64"), name="year")
+
+
+def gics_sectors(path: str) -> pd.Series:
+    """cik -> 2-digit GICS sector, as substr(gind, 1, 2) in the .do file."""
+    corp = pd.read_stata(path, columns=["cik", "gind"]) if path.lower().endswith(".dta") else read_table(path, ["cik", "gind"])
+    corp = corp[corp["gind"].astype(str).str.strip() != ""].drop_duplicates("cik")
+    return pd.Series(corp["gind"].astype(str).str.strip().str[:2].to_numpy(),
+                     index=corp["cik"].astype(str).str.strip(), name="gsector")
+
+
+def add_partition_columns(pairs: pd.DataFrame, years: pd.Series, sectors: pd.Series = None) -> pd.DataFrame:
+    out = pairs.copy()
+    out["year"] = out["transcriptid"].astype("int64").map(years).astype("Int16")
+    if sectors is not None:
+        out["gsector"] = out["cik"].astype(str).str.strip().map(sectors).astype("string")
+    return out
+
+
+def write_dataset(pairs: pd.DataFrame, root: str, partition_by=("year",), overwrite: bool = False,
+                  source: str = None) -> dict:
+    """Write `pairs` under root, one directory level per partition column; returns the manifest."""
+    partition_by = list(partition_by)
+    if os.path.exists(root) and os.listdir(root):
+        if not (overwrite and os.path.exists(os.path.join(root, MANIFEST))):
+            raise ValueError(f"{root} is not empty (only an existing dataset can be replaced, with overwrite)")
+        shutil.rmtree(root)
+
+    types = {c: PARTITION_TYPES[c] for c in partition_by}
+    table = arrow_table(pairs)
+    for c, t in types.items():
+        table = table.set_column(table.schema.get_field_index(c), c, table[c].cast(pa.type_for_alias(t)))
+    ds.write_dataset(
+        table, root, format="parquet",
+        partitioning=ds.partitioning(pa.schema([(c, table.schema.field(c).type) for c in partition_by]), flavor="hive"),
+        basename_template="part-{i}.parquet",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        max_partitions=100000,
+    )
+
+    partitions = []
+    for key, n in pairs.groupby(partition_by, dropna=False, sort=True).size().items():
+        key = key if isinstance(key, tuple) else (key,)
+        values = [None if pd.isna(v) else (int(v) if types[c] != "string" else str(v)) for c, v in zip(partition_by, key)]
+        partitions.append({**dict(zip(partition_by, values)), "rows": int(n),
+                           "path": "/".join(f"{c}={NULL_PARTITION if v is None else v}" for c, v in zip(partition_by, values))})
+    manifest = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "source": source,
+        "rows": int(len(pairs)),
+        "columns": list(pairs.columns),
+        "partition_by": partition_by,
+        "partition_types": types,
+        "partitions": partitions,
+    }
+    with open(os.path.join(root, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    return manifest
+
+
+def read_manifest(root: str) -> dict:
+    with open(os.path.join(root, MANIFEST), encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ---- filters shared by the runners
+
+def parse_years(values) -> list:
+    """["2013-2016", "2019"] -> [2013, 2014, 2015, 2016, 2019]"""
+    years = []
+    for v in values:
+        for part in str(v).split(","):
+            part = part.strip()
+            if not part:
+                continue
+            a, _, b = part.partition("-")
+            years += list(range(int(a), int(b or a) + 1))
+    return sorted(set(years))
+
+
+def dataset_filters(years=None, sectors=None):
+    """YEARS / SECTORS settings -> read_table filters (None = whole corpus)."""
+    filters = {}
+    if years:
+        filters["year"] = parse_years(years)
+    if sectors:
+        filters["gsector"] = sorted({str(s).strip() for s in sectors})
+    return filters or None
+
+
+def sliced_path(path: str, filters) -> str:
+    """out.parquet -> out__year2013-2016__gsector45.parquet for a filtered run."""
+    if not filters:
+        return path
+    tags = []
+    for col, values in filters.items():
+        values = sorted(values)
+        if col == "year" and values == list(range(values[0], values[-1] + 1)) and len(values) > 1:
+            tags.append(f"year{values[0]}-{values[-1]}")
+        else:
+            tags.append(col + "+".join(str(v) for v in values))
+    base, ext = os.path.splitext(path)
+    return f"{base}__{'__'.join(tags)}{ext}"
+
+
+def add_filter_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--years", nargs="+", default=None, help="call years to read, e.g. 2013-2016 2019")
+    ap.add_argument("--sectors", nargs="+", default=None, help="2-digit GICS sectors to read, e.g. 45 20")
+
+
+def filters_from_args(args):
+    return dataset_filters(args.years, args.sectors)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Partition the Q&A pairs by call year (and GICS sector)")
+    ap.add_argument("--pairs", default=PAIRS_PATH, help="pairs from qa_pairs.py (or Final.dta)")
+    ap.add_argument("--components", default=COMPONENTS_PATH, help="component table with transcriptid + " + DATE_COL)
+    ap.add_argument("--corp", default=CORP_PATH, help="corporate information.dta (cik, gind)")
+    ap.add_argument("--out", default=OUT_DIR, help="dataset directory")
+    ap.add_argument("--no-sector", action="store_true", help="partition by year only")
+    ap.add_argument("--overwrite", action="store_true", help="replace an existing dataset at --out")
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    pairs = pd.read_stata(args.pairs) if args.pairs.lower().endswith(".dta") else read_table(args.pairs)
+    print(f"[DATASET] pairs={len(pairs):,} from {args.pairs}")
+    sectors = None if args.no_sector else gics_sectors(args.corp)
+    pairs = add_partition_columns(pairs, call_years(args.components), sectors)
+    partition_by = ["year"] if sectors is None else ["year", "gsector"]
+    for c in partition_by:
+        n = int(pairs[c].isna().sum())
+        if n:
+            print(f"[DATASET] {n:,} pairs without {c} -> {c}={NULL_PARTITION}")
+
+    manifest = write_dataset(pairs, args.out, partition_by, overwrite=args.overwrite, source=args.pairs)
+    print(f"[DATASET] partitions={len(manifest['partitions'])} | rows={manifest['rows']:,} | by={partition_by}")
+    by_year = pd.DataFrame(manifest["partitions"]).groupby("year", dropna=False)["rows"].sum()
+    for y, n in by_year.items():
+        print(f"[DATASET] year={y} rows={int(n):,}")
+    print("Saved:", args.out)
+
+
+if __name__ == "__main__":
+    main()
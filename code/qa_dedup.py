@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Duplicate clustering of Q&A rows, so each distinct text is classified once.
+
+Earnings-call answers repeat a lot of boilerplate ("we don't provide guidance
+on that"). Rows are grouped into clusters, one representative per cluster is
+classified, and fan_out() copies its labels to the other members.
+
+  - exact: rows whose key columns hash to the same text (normalize=True:
+           after lowercasing and dropping punctuation / extra whitespace)
+  - near:  exact clusters merged further by MinHash/LSH over word shingles,
+           kept only when the estimated Jaccard similarity >= threshold
+
+Representatives are the first member in row order, so reruns are stable.
+"""
+import re
+import zlib
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+_WS_RE = re.compile(r"\s+")
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+# universal hashing (a * x + b) mod P, with x < 2**32 and a, b < 2**32 so the
+# product fits in uint64 without wrapping
+_MERSENNE_P = np.uint64(4294967311)
+
+
+def normalize_text(s) -> str:
+    if s is None or (isinstance(s, float) and np.isnan(s)):
+        return ""
+    s = _PUNCT_RE.sub(" ", str(s).lower())
+    return _WS_RE.sub(" ", s).strip()
+
+
+def text_key(parts, normalize: bool = False) -> str:
+    norm = normalize_text if normalize else (lambda x: "" if x is None else str(x))
+    return hashlib.sha1("\x1f".join(norm(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def exact_clusters(df: pd.DataFrame, cols, normalize: bool = False) -> np.ndarray:
+    """Position of each row's representative (first row with the same key)."""
+    keys = [text_key(parts, normalize) for parts in zip(*(df[c].tolist() for c in cols))]
+    codes, _ = pd.factorize(pd.Series(keys, dtype=object))
+    first = np.full(codes.max() + 1 if len(codes) else 0, -1, dtype=np.int64)
+    for pos in range(len(codes) - 1, -1, -1):
+        first[codes[pos]] = pos
+    return first[codes]
+
+
+def shingles(text: str, k: int = 3) -> np.ndarray:
+    words = text.split()
+    if len(words) < k:
+        grams = [" ".join(words)]
+    else:
+        grams = [" ".join(words[j:j + k]) for j in range(len(words) - k + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)))
+
+
+def minhash_signatures(texts, num_perm: int = 64, k: int = 3, seed: int = 1) -> np.ndarray:
+    """(len(texts), num_perm) uint64 MinHash signatures over word k-shingles."""
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2 ** 32 - 1, size=num_perm, dtype=np.int64).astype(np.uint64)[:, None]
+    b = rng.randint(0, 2 ** 32 - 1, size=num_perm, dtype=np.int64).astype(np.uint64)[:, None]
+    sig = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for n, t in enumerate(texts):
+        sig[n] = ((a * shingles(t, k)[None, :] + b) % _MERSENNE_P).min(axis=1)
+    return sig
+
+
+def near_clusters(df: pd.DataFrame, cols, threshold: float = 0.9, num_perm: int = 64, bands: int = 16) -> np.ndarray:
+    """exact_clusters() merged with LSH candidates whose MinHash Jaccard >= threshold."""
+    if num_perm % bands:
+        raise ValueError(f"num_perm={num_perm} must be a multiple of bands={bands}")
+    rep = exact_clusters(df, cols, normalize=True)
+    uniq = np.flatnonzero(rep == np.arange(len(rep)))
+    texts = [" ".join(normalize_text(df[c].iat[p]) for c in cols) for p in uniq]
+    sig = minhash_signatures(texts, num_perm=num_perm)
+
+    parent = np.arange(len(uniq))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    rows = num_perm // bands
+    for band in range(bands):
+        buckets = {}
+        for n, h in enumerate(sig[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(h.tobytes(), []).append(n)
+        for members in buckets.values():
+            head = members[0]
+            for n in members[1:]:
+                if (sig[head] == sig[n]).mean() < threshold:
+                    continue
+                ra, rb = find(head), find(n)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)  # lowest position stays representative
+
+    root = np.array([find(n) for n in range(len(uniq))], dtype=np.int64)
+    uniq_rep = np.empty(len(rep), dtype=np.int64)
+    uniq_rep[uniq] = uniq[root]
+    return uniq_rep[rep]
+
+
+def dedup_clusters(df: pd.DataFrame, cols, mode: str = "exact", normalize: bool = False, **near_kw) -> pd.Series:
+    """
+    Representative index label for every row (itself for representatives).
+    mode: "none" | "exact" | "near" (near always compares normalized text)
+    """
+    if mode == "none" or len(df) == 0:
+        pos = np.arange(len(df))
+    elif mode == "exact":
+        pos = exact_clusters(df, cols, normalize=normalize)
+    elif mode == "near":
+        pos = near_clusters(df, cols, **near_kw)
+    else:
+        raise ValueError(f"unknown dedup mode: {mode!r} (none/exact/near)")
+    return pd.Series(df.index[pos], index=df.index, name="dedup_rep")
+
+
+def fan_out(df: pd.DataFrame, rep: pd.Series, columns):
+    """Copy `columns` from each representative row to the other members (in place)."""
+    members = rep[rep.index != rep.values]
+    for c in columns:
+        df.loc[members.index, c] = df.loc[members.values, c].to_numpy()
+
+
+def cluster_table(df: pd.DataFrame, rep: pd.Series, id_cols=("transcriptid", "qid")) -> pd.DataFrame:
+    """One row per input row: ids, representative row and cluster size."""
+    out = pd.DataFrame({c: df.loc[rep.index, c].to_numpy() for c in id_cols if c in df.columns}, index=rep.index)
+    out["row"] = rep.index
+    out["rep_row"] = rep.to_numpy()
+    out["cluster_size"] = rep.map(rep.value_counts()).to_numpy()
+    return out.reset_index(drop=True)
+
+
+class ExactDedupStream:
+    """
+    exact mode of dedup_clusters() for rows that arrive one at a time:
+    add() returns the representative label (the first row seen with that key).
+    """
+
+    def __init__(self, normalize: bool = False):
+        self.normalize = normalize
+        self._first = {}
+
+    def add(self, label, parts):
+        return self._first.setdefault(text_key(parts, self.normalize), label)
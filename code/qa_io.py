@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Shared Parquet/Arrow storage for the pipeline scripts.
+
+Every stage used to hand data to the next through .xlsx files. These helpers
+read/write the same tables as Parquet instead:
+  - text columns (question/answer/spark_raw/...) are stored as Arrow strings
+  - ids (transcriptid/qid/cik/companyid) are stored with one fixed type per
+    key, so files and partitions concatenate and merge without casts
+  - reads are memory-mapped and can project a subset of columns
+
+Excel stays supported: read_table/write_table dispatch on the file suffix,
+so a script can switch format by changing its path only. write_workbook
+writes formatted multi-sheet result workbooks straight from DataFrames.
+
+read_table also opens a partitioned dataset directory (qa_dataset.py) and
+takes `filters` ({column: allowed values}); on a dataset only the matching
+partitions are opened, on a .parquet file row groups are skipped by their
+statistics.
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa  # pip install pyarrow
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# the same type in every file, whatever the value range of this one
+ID_DTYPES = {"transcriptid": "int64", "qid": "int32", "cik": "int64", "companyid": "int64"}
+ID_COLS = tuple(ID_DTYPES)
+# ids stored as text (e.g. zero-padded cik) are dictionary-encoded with fixed int32 indices
+TEXT_ID_TYPE = pa.dictionary(pa.int32(), pa.string())
+TEXT_COLS = (
+    "question", "answer", "kw_matches",
+    "spark_raw", "spark_json_extracted", "spark_assessment", "spark_parse_error",
+)
+
+
+def is_parquet(path) -> bool:
+    return os.path.splitext(str(path))[1].lower() == ".parquet"
+
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Fixed integer types for id columns; text columns as Arrow-backed strings."""
+    df = df.copy()
+    for c, dtype in ID_DTYPES.items():
+        if c not in df.columns:
+            continue
+        s = df[c]
+        if pd.api.types.is_numeric_dtype(s):
+            if (s.dropna() % 1 == 0).all():
+                # nullable variant when ids are missing; same Arrow type either way
+                df[c] = s.astype(dtype if s.notna().all() else dtype.capitalize())
+        else:
+            # e.g. cik exported as zero-padded text: keep the labels, not the copies
+            df[c] = s.astype("category")
+    for c in TEXT_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("string[pyarrow]")
+    for c in df.columns:
+        if df[c].dtype != object:
+            continue
+        try:
+            pa.array(df[c], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # mixed cells (e.g. 1 and "1" from raw model JSON) -> text, nulls kept
+            df[c] = df[c].astype("string[pyarrow]")
+    return df
+
+
+def arrow_table(df: pd.DataFrame) -> pa.Table:
+    """compact_dtypes(df) as an Arrow table, text ids cast to TEXT_ID_TYPE."""
+    table = pa.Table.from_pandas(compact_dtypes(df), preserve_index=False)
+    for c in ID_COLS:
+        if c in table.column_names and pa.types.is_dictionary(table.schema.field(c).type):
+            table = table.set_column(table.schema.get_field_index(c), c, table[c].cast(TEXT_ID_TYPE))
+    return table
+
+
+def read_table(path, columns=None, filters=None) -> pd.DataFrame:
+    """Read .parquet (memory-mapped, column projection), a dataset directory or .xlsx/.xls/.csv."""
+    path = str(path)
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path) or (filters and ext == ".parquet"):
+        return read_dataset(path, columns=columns, filters=filters)
+    if ext == ".parquet":
+        if columns is not None:
+            available = set(pq.read_schema(path).names)
+            columns = [c for c in columns if c in available]
+        table = pq.read_table(path, columns=columns, memory_map=True)
+        return table.to_pandas(types_mapper=_arrow_string_mapper)
+    load = None if columns is None else list(columns) + [c for c in (filters or {}) if c not in columns]
+    if ext == ".csv":
+        df = pd.read_csv(path, usecols=_usecols(load), encoding="utf-8-sig")
+    else:
+        df = pd.read_excel(path, engine="openpyxl", usecols=_usecols(load))
+    if filters:
+        df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[[c for c in df.columns if c in set(columns)]]
+    return df
+
+
+def write_table(df: pd.DataFrame, path):
+    """Write .parquet (compacted, zstd) or fall back to .xlsx/.csv by suffix."""
+    path = str(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        pq.write_table(arrow_table(df), path, compression="zstd")
+    elif ext == ".csv":
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+    else:
+        df.to_excel(path, index=False)
+
+
+def read_columns(path):
+    """Column names without loading the data."""
+    path = str(path)
+    if os.path.isdir(path):
+        return list(open_dataset(path).schema.names)
+    if is_parquet(path):
+        return list(pq.read_schema(path).names)
+    if path.lower().endswith(".csv"):
+        return list(pd.read_csv(path, nrows=0, encoding="utf-8-sig").columns)
+    return list(pd.read_excel(path, engine="openpyxl", nrows=0).columns)
+
+
+EXCEL_MAX_ROWS = 1048576
+WRITE_CHUNK_ROWS = 10000
+
+
+def _cell_rows(df: pd.DataFrame, with_index: bool, chunk_rows: int = WRITE_CHUNK_ROWS):
+    """Rows as lists with None for missing cells (xlsxwriter rejects NaN / pd.NA), chunk by chunk."""
+    for start in range(0, len(df), chunk_rows):
+        part = df.iloc[start:start + chunk_rows]
+        vals = part.astype(object).to_numpy(copy=True)
+        if with_index:
+            vals = np.column_stack([part.index.to_numpy(dtype=object), vals])
+        vals[pd.isna(vals)] = None
+        yield from vals.tolist()
+
+
+def _text_width(values, head_rows: int = WRITE_CHUNK_ROWS) -> int:
+    """
+    Longest cell text: string values are measured over the whole column with
+    .str.len(), anything else on the first `head_rows` values only, so no
+    column is copied to objects.
+    """
+    s = pd.Series(values, copy=False)
+    width = 0
+    if pd.api.types.is_string_dtype(s.dtype):
+        try:
+            n = s.str.len().max()  # non-strings in an object column are NaN here
+        except AttributeError:  # object column with no strings at all
+            n = np.nan
+        width = 0 if pd.isna(n) else int(n)
+    if s.dtype == object or not pd.api.types.is_string_dtype(s.dtype):
+        head = s.iloc[:head_rows].dropna()
+        if len(head):
+            width = max(width, int(head.astype(str).str.len().max()))
+    return width
+
+
+def _naive_datetimes(df: pd.DataFrame) -> pd.DataFrame:
+    """tz-aware datetime columns / index as their wall-clock time: Excel cells have no time zone."""
+    out = df
+    for j, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            out = df.copy(deep=False) if out is df else out
+            out.isetitem(j, df.iloc[:, j].dt.tz_localize(None))
+    if isinstance(df.index, pd.DatetimeIndex) and df.index.tz is not None:
+        out = out.set_axis(df.index.tz_localize(None))
+    return out
+
+
+def _date_format(values):
+    """Excel number format for a datetime64 column (date only when every value is midnight), else None."""
+    if not pd.api.types.is_datetime64_dtype(values.dtype):
+        return None
+    d = pd.Series(values, copy=False).dropna()
+    return "yyyy-mm-dd" if (d == d.dt.normalize()).all() else "yyyy-mm-dd hh:mm:ss"
+
+
+def write_workbook(path, sheets, index=True, min_width: int = 10, max_width: int = 45):
+    """
+    Write {sheet name: DataFrame} to one .xlsx: bold wrapped header, bold index
+    column, column widths from the text length of the values (min_width..max_width),
+    date formats on datetime columns (tz-aware ones written as wall-clock time)
+    and frozen header / index. `index` is a bool or {sheet name: bool}.
+
+    Uses xlsxwriter in constant-memory mode (pip install xlsxwriter): rows are
+    converted WRITE_CHUNK_ROWS at a time and streamed to the file, so
+    pair-level sheets with hundreds of thousands of rows cost neither a
+    workbook reload nor an object copy of the whole frame. Sheets longer than Excel's row
+    limit continue on "<name>_2", "<name>_3", ...
+    """
+    try:
+        import xlsxwriter
+    except ImportError:
+        # unformatted fallback
+        with pd.ExcelWriter(path, engine="openpyxl") as writer:
+            for name, df in sheets.items():
+                _naive_datetimes(df).to_excel(writer, sheet_name=name,
+                                              index=index.get(name, True) if isinstance(index, dict) else index)
+        return
+
+    wb = xlsxwriter.Workbook(str(path), {"constant_memory": True, "nan_inf_to_errors": True})
+    header_fmt = wb.add_format({"bold": True, "align": "center", "valign": "vcenter", "text_wrap": True, "border": 1})
+    index_fmt = wb.add_format({"bold": True, "valign": "vcenter", "text_wrap": True})
+    formats = {}
+
+    def fmt(**props):
+        key = tuple(sorted(props.items()))
+        if key not in formats:
+            formats[key] = wb.add_format(props)
+        return formats[key]
+
+    try:
+        for name, df in sheets.items():
+            df = _naive_datetimes(df)
+            with_index = index.get(name, True) if isinstance(index, dict) else index
+            header = ([df.index.name or ""] if with_index else []) + [str(c) for c in df.columns]
+            cols = ([df.index] if with_index else []) + [df.iloc[:, j] for j in range(df.shape[1])]
+            num_fmts = [_date_format(col) for col in cols]
+            widths = [min(max(min_width, max(len(h), len(f) if f else _text_width(col)) + 2), max_width)
+                      for h, col, f in zip(header, cols, num_fmts)]
+            # cells are written without a format, so a date column's format comes from set_column
+            col_fmts = [fmt(num_format=f) if f else None for f in num_fmts]
+            row_index_fmt = index_fmt
+            if with_index and num_fmts[0]:
+                row_index_fmt = fmt(bold=True, valign="vcenter", text_wrap=True, num_format=num_fmts[0])
+            rows = _cell_rows(df, with_index)
+
+            per_sheet = EXCEL_MAX_ROWS - 1
+            for part, start in enumerate(range(0, max(len(df), 1), per_sheet), start=1):
+                ws = wb.add_worksheet(name if part == 1 else f"{name}_{part}"[:31])
+                for j, (w, f) in enumerate(zip(widths, col_fmts)):
+                    ws.set_column(j, j, w, f)
+                ws.freeze_panes(1, 1 if with_index and len(header) > 1 else 0)
+                ws.write_row(0, 0, header, header_fmt)
+                for row in range(1, min(per_sheet, len(df) - start) + 1):
+                    vals = next(rows)
+                    if with_index:
+                        ws.write(row, 0, vals[0], row_index_fmt)
+                        vals = vals[1:]
+                    ws.write_row(row, 1 if with_index else 0, vals)
+    finally:
+        wb.close()
+
+
+# ---- partitioned datasets / filters
+
+MANIFEST = "_manifest.json"
+
+
+def open_dataset(path) -> ds.Dataset:
+    """A .parquet file, or a hive-partitioned directory typed from its qa_dataset manifest."""
+    path = str(path)
+    if not os.path.isdir(path):
+        return ds.dataset(path, format="parquet")
+    manifest = os.path.join(path, MANIFEST)
+    partitioning = "hive"
+    if os.path.exists(manifest):
+        with open(manifest, encoding="utf-8") as f:
+            types = json.load(f)["partition_types"]
+        partitioning = ds.partitioning(pa.schema([(k, pa.type_for_alias(t)) for k, t in types.items()]), flavor="hive")
+    return ds.dataset(path, format="parquet", partitioning=partitioning)
+
+
+def filter_expression(schema: pa.Schema, filters):
+    """{column: allowed values} -> Arrow filter (values cast to the column type), None = no filter."""
+    expr = None
+    for col, values in (filters or {}).items():
+        if values is None:
+            continue
+        if col not in schema.names:
+            raise ValueError(f"can not filter on '{col}'; columns：{schema.names}")
+        e = ds.field(col).isin(pa.array([str(v) for v in values]).cast(schema.field(col).type))
+        expr = e if expr is None else expr & e
+    return expr
+
+
+def read_dataset(path, columns=None, filters=None) -> pd.DataFrame:
+    dataset = open_dataset(path)
+    if columns is not None:
+        columns = [c for c in columns if c in dataset.schema.names]
+    table = dataset.to_table(columns=columns, filter=filter_expression(dataset.schema, filters))
+    return table.to_pandas(types_mapper=_arrow_string_mapper)
+
+
+def iter_dataset(path, batch_rows: int, columns=None, filters=None):
+    """DataFrame chunks of a .parquet file / dataset directory, matching partitions only."""
+    dataset = open_dataset(path)
+    expr = filter_expression(dataset.schema, filters)
+    # partitions are small files: gather their batches up to batch_rows per chunk
+    pending, n = [], 0
+    for batch in dataset.to_batches(columns=columns, filter=expr, batch_size=batch_rows):
+        if not batch.num_rows:
+            continue
+        pending.append(batch)
+        n += batch.num_rows
+        if n >= batch_rows:
+            yield pa.Table.from_batches(pending).to_pandas(types_mapper=_arrow_string_mapper)
+            pending, n = [], 0
+    if pending:
+        yield pa.Table.from_batches(pending).to_pandas(types_mapper=_arrow_string_mapper)
+
+
+def apply_filters(df: pd.DataFrame, filters) -> pd.DataFrame:
+    """Same filters on an in-memory frame (.csv / .xlsx inputs)."""
+    mask = pd.Series(True, index=df.index)
+    for col, values in (filters or {}).items():
+        if values is None:
+            continue
+        if col not in df.columns:
+            raise ValueError(f"can not filter on '{col}'; columns：{list(df.columns)}")
+        s = df[col]
+        if pd.api.types.is_numeric_dtype(s):
+            mask &= s.isin(pd.to_numeric(pd.Series(list(values)), errors="coerce"))
+        else:
+            mask &= s.astype(str).isin({str(v) for v in values})
+    return df[mask]
+
+
+def _usecols(columns):
+    if columns is None:
+        return None
+    wanted = set(columns)
+    return lambda c: c in wanted
+
+
+def _arrow_string_mapper(dtype):
+    if dtype in (pa.string(), pa.large_string()):
+        return pd.StringDtype("pyarrow")
+    return None
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Q&A pair reconstruction from the transcript component table -- the Python
+port of the second half of `sample construction code.do` (Clean_Q&A.dta ->
+Final.dta).
+
+Same rules as the Stata step:
+  - only Question / Answer components, in file order inside a call
+  - qid = running count of Questions per (cik, transcriptid); Answers before
+    the first Question (qid == 0) are dropped
+  - answer = the block's Answer components joined in order, as the
+    `trim(answer[_n-1] + " " + componenttextpreview)` chain does
+  - one row per Question, kept if q_len >= 30 & a_len >= 10 & qa_len >= 75
+
+Answers are joined once per block (groupby + str.join) instead of copying
+the growing string for every component. The input is read in chunks that
+are cut at transcript boundaries, so a call is never split and the full
+component table never has to be in memory; chunks are built on a process
+pool and appended to one Parquet file in input order.
+
+Final.dta went through `rsort`, so its row order is random: check_pairs()
+compares on (cik, transcriptid, qid) instead.
+
+    python qa_pairs.py --input "Clean_Q&A.dta" --out "Final.parquet" --workers 8 --check "Final.dta"
+"""
+import os
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq  # pip install pyarrow
+
+from qa_io import arrow_table, read_table
+
+DATA_DIR = r"D:\2025_26 Spring\Replication\Data\Data clean"
+IN_PATH = os.path.join(DATA_DIR, "Clean_Q&A.dta")
+OUT_PATH = os.path.join(DATA_DIR, "Final.parquet")
+
+TYPE_COL = "transcriptcomponenttypename"
+TEXT_COL = "componenttextpreview"
+COMPONENT_COLS = ["cik", "transcriptid", TYPE_COL, TEXT_COL]
+KEYS = ["cik", "transcriptid", "qid"]
+OUT_COLS = KEYS + ["question", "answer", "q_len", "a_len", "qa_len"]
+
+# keep if q_len >= 30 & a_len >= 10 & qa_len >= 75
+MIN_Q_LEN = 30
+MIN_A_LEN = 10
+MIN_QA_LEN = 75
+
+
+def build_pairs(components: pd.DataFrame) -> pd.DataFrame:
+    """Components of whole calls -> one row per kept question (OUT_COLS)."""
+    c = components.loc[components[TYPE_COL].isin(("Question", "Answer")), COMPONENT_COLS].reset_index(drop=True)
+    is_q = c[TYPE_COL].eq("Question")
+    qid = is_q.groupby([c["cik"], c["transcriptid"]], sort=False).cumsum()
+    keep = qid > 0
+    c, is_q = c[keep].assign(qid=qid[keep]), is_q[keep]
+    text = c[TEXT_COL].fillna("").astype(str)
+
+    pairs = c.loc[is_q, KEYS].assign(question=text[is_q])
+
+    # Stata's trim() chain: a blank component adds nothing, trailing blanks of
+    # every component and leading blanks of the first one are cut
+    pieces = text[~is_q].str.rstrip(" ")
+    pieces = pieces[pieces != ""]
+    blocks = c.loc[pieces.index, KEYS]
+    answers = pieces.groupby([blocks[k] for k in KEYS], sort=False).agg(" ".join).str.lstrip(" ")
+    answers = answers.rename("answer").reset_index()
+
+    pairs = pairs.merge(answers, on=KEYS, how="left", sort=False)
+    pairs["answer"] = pairs["answer"].fillna("")
+    pairs["q_len"] = pairs["question"].str.len().astype("int32")
+    pairs["a_len"] = pairs["answer"].str.len().astype("int32")
+    pairs["qa_len"] = pairs["q_len"] + pairs["a_len"]
+    pairs["qid"] = pairs["qid"].astype("int32")
+    kept = (pairs["q_len"] >= MIN_Q_LEN) & (pairs["a_len"] >= MIN_A_LEN) & (pairs["qa_len"] >= MIN_QA_LEN)
+    return pairs.loc[kept, OUT_COLS].reset_index(drop=True)
+
+
+def iter_components(path: str, chunk_rows: int, columns=COMPONENT_COLS):
+    """Raw component chunks of `columns` (.dta / .parquet / .csv streamed, Excel read whole)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".dta":
+        with pd.read_stata(path, columns=columns, chunksize=chunk_rows, convert_categoricals=False) as reader:
+            yield from reader
+    elif ext == ".parquet":
+        pf = pq.ParquetFile(path, memory_map=True)
+        for batch in pf.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    elif ext == ".csv":
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_rows, encoding="utf-8-sig")
+    else:
+        yield read_table(path, columns=columns)
+
+
+def iter_call_chunks(path: str, chunk_rows: int):
+    """
+    Chunks holding whole calls: the rows of the last transcriptid in a chunk
+    are carried into the next one. Needs the input grouped by transcriptid
+    (Clean_Q&A.dta is saved sorted by transcriptid componentorder).
+    """
+    carry = None
+    finished = set()
+    for chunk in iter_components(path, chunk_rows):
+        chunk = chunk[chunk[TYPE_COL].isin(("Question", "Answer"))]
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        tid = chunk["transcriptid"].to_numpy()
+        starts = np.concatenate([[0], np.flatnonzero(tid[1:] != tid[:-1]) + 1])
+        run_ids = tid[starts].tolist()
+        if len(set(run_ids)) != len(run_ids) or finished.intersection(run_ids):
+            raise ValueError(f"input is not grouped by transcriptid; sort it by transcriptid componentorder：{path}")
+        carry = chunk.iloc[starts[-1]:]
+        if starts[-1] > 0:
+            finished.update(run_ids[:-1])
+            yield chunk.iloc[:starts[-1]]
+    if carry is not None and len(carry):
+        yield carry
+
+
+def reconstruct_pairs(in_path: str, out_path: str, workers: int = 1, chunk_rows: int = 200000) -> int:
+    """Stream in_path -> out_path (.parquet); returns the number of pairs written."""
+    writer = None
+    n_pairs = 0
+
+    def consume(pairs):
+        nonlocal writer, n_pairs
+        table = arrow_table(pairs)
+        if writer is None:
+            writer = pq.ParquetWriter(out_path, table.schema, compression="zstd")
+        writer.write_table(table.cast(writer.schema))
+        n_pairs += len(pairs)
+        print(f"[PAIRS] pairs={n_pairs:,}")
+
+    ex = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = deque()
+    try:
+        for chunk in iter_call_chunks(in_path, chunk_rows):
+            if ex is None:
+                consume(build_pairs(chunk))
+                continue
+            # at most 2 chunks per worker in flight; written in input order
+            pending.append(ex.submit(build_pairs, chunk))
+            while len(pending) >= 2 * workers:
+                consume(pending.popleft().result())
+        while pending:
+            consume(pending.popleft().result())
+        if writer is None:
+            consume(build_pairs(pd.DataFrame(columns=COMPONENT_COLS)))
+    finally:
+        if ex is not None:
+            ex.shutdown()
+        if writer is not None:
+            writer.close()
+    return n_pairs
+
+
+def _keyed(df: pd.DataFrame) -> pd.DataFrame:
+    out = df[OUT_COLS].copy()
+    out["cik"] = out["cik"].astype(str).str.strip()
+    out["transcriptid"] = out["transcriptid"].astype("int64")
+    out["qid"] = out["qid"].astype("int64")
+    for c in ("question", "answer"):
+        out[c] = out[c].fillna("").astype(str)
+    return out.set_index(KEYS).sort_index()
+
+
+def check_pairs(pairs: pd.DataFrame, reference: pd.DataFrame) -> dict:
+    """Compare with Final.dta on (cik, transcriptid, qid); all counts 0 = same rows."""
+    ours, ref = _keyed(pairs), _keyed(reference)
+    both = ours.index.intersection(ref.index)
+    out = {
+        "rows": len(ours),
+        "reference_rows": len(ref),
+        "missing": len(ref.index.difference(ours.index)),
+        "extra": len(ours.index.difference(ref.index)),
+        "duplicate_keys": int(ours.index.duplicated().sum()),
+    }
+    for c in ("question", "answer", "q_len", "a_len", "qa_len"):
+        out[f"{c}_diff"] = int((ours.loc[both, c].to_numpy() != ref.loc[both, c].to_numpy()).sum())
+    return out
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Rebuild Q&A pairs (Final.dta) from the component table")
+    ap.add_argument("--input", default=IN_PATH, help="component table (.dta/.parquet/.csv/.xlsx), grouped by transcriptid")
+    ap.add_argument("--out", default=OUT_PATH, help="output .parquet")
+    ap.add_argument("--workers", type=int, default=1, help="processes building chunks (1 = serial)")
+    ap.add_argument("--chunk-rows", type=int, default=200000, help="component rows read per chunk")
+    ap.add_argument("--check", default=None, help="compare the result with this Final.dta / .parquet")
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    n = reconstruct_pairs(args.input, args.out, workers=args.workers, chunk_rows=args.chunk_rows)
+    print("Saved:", args.out, f"({n:,} pairs)")
+    if args.check:
+        ref = pd.read_stata(args.check) if args.check.lower().endswith(".dta") else read_table(args.check)
+        res = check_pairs(read_table(args.out), ref)
+        print("[CHECK]", " ".join(f"{k}={v:,}" for k, v in res.items()))
+        same = all(v == 0 for k, v in res.items() if k not in ("rows", "reference_rows"))
+        print("[CHECK] matches reference row for row" if same else "[CHECK] DIFFERENT from reference")
+
+
+if __name__ == "__main__":
+    main()
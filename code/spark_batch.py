@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-pair batched classification for the Spark scripts.
+
+One request carries up to K question/answer pairs (bounded by a prompt token
+budget) and asks for a JSON array with one object per pair id, so the
+instruction block, the handshake and the rate-limit slot are paid once per
+batch instead of once per pair. Pairs that are missing or malformed in the
+response are handed back to the caller, which re-queues them on their own.
+
+parse_model_json reads both reply shapes (one object, or the batch array) and
+is what the Spark scripts use for every response.
+"""
+import re
+import json
+
+BATCH_PROMPT_TEMPLATE = """Below are {n} investor question / manager response pairs from earnings
+conference calls, each marked with a pair id.
+
+{pairs}
+
+For EACH pair, assess whether the manager's response includes a statement,
+explanation, or justification indicating an inability or unwillingness to
+answer the question. If you classify the response as reflecting inability
+or unwillingness to answer, justify your classification with specific
+phrases or sentences from the manager's response. If there's no such
+indication, explain why not. Judge every pair on its own.
+
+IMPORTANT OUTPUT RULES:
+1) Output MUST be exactly ONE valid JSON array with one object per pair id.
+2) Do NOT include markdown code fences.
+3) Do NOT include any extra text before or after the JSON.
+
+Return JSON in this exact format:
+[
+  {{"pair_id": "p1", "assessment": "a short assessment unique to this pair", "your_classification": 1}},
+  {{"pair_id": "p2", "assessment": "a short assessment unique to this pair", "your_classification": 0}}
+]
+"""
+
+PAIR_TEMPLATE = """### pair_id: {pid}
+Investor question:
+{question}
+
+Manager response:
+{answer}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    # rough English average (~4 chars per token); only used to size batches
+    return len(text or "") // 4 + 1
+
+
+def plan_batches(items, k: int, token_budget: int, text_of):
+    """
+    Greedily pack `items` into batches of at most `k` items whose estimated
+    prompt tokens (text_of(item)) stay within `token_budget`. An item that is
+    over budget on its own ends up in a batch of one.
+    """
+    base = estimate_tokens(BATCH_PROMPT_TEMPLATE)
+    batches, cur, cur_tokens = [], [], base
+    for it in items:
+        t = estimate_tokens(text_of(it)) + 12  # + pair header
+        if cur and (len(cur) >= k or cur_tokens + t > token_budget):
+            batches.append(cur)
+            cur, cur_tokens = [], base
+        cur.append(it)
+        cur_tokens += t
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def make_batch_prompt(pairs) -> str:
+    """pairs: [(pair_id, question, answer)]"""
+    body = "\n".join(
+        PAIR_TEMPLATE.format(pid=pid, question=(q or "").strip(), answer=(a or "").strip())
+        for pid, q, a in pairs
+    )
+    return BATCH_PROMPT_TEMPLATE.format(n=len(pairs), pairs=body)
+
+
+def parse_model_json(text: str):
+    """
+    (parsed, error or None, extracted JSON text) of a model reply: the whole
+    text, else its outermost {...} object, else its outermost [...] array.
+    """
+    if not text or str(text).strip() == "":
+        return None, "empty_response", ""
+
+    try:
+        return json.loads(text), None, text
+    except Exception:
+        pass
+
+    m = re.search(r"\{.*\}", text, flags=re.S)
+    # batched prompts answer with a JSON array of objects
+    arr = re.search(r"\[.*\]", text, flags=re.S)
+    if not m and not arr:
+        return None, "no_json_object_found", text
+
+    cand = (m or arr).group(0).strip()
+    try:
+        return json.loads(cand), None, cand
+    except Exception as e:
+        err = f"json_parse_failed: {repr(e)}"
+
+    if arr and m:
+        # "[{...}, {...}]" with prose around it: the object match spans two items
+        cand_arr = arr.group(0).strip()
+        try:
+            return json.loads(cand_arr), None, cand_arr
+        except Exception:
+            pass
+    return None, err, cand
+
+
+def split_batch_response(parsed, pair_ids):
+    """
+    Map a parsed JSON array back to pair ids.
+    Returns ({pair_id: single-pair JSON text}, [pair ids to re-queue]).
+    The JSON text has the same keys as a one-pair response, so the scripts'
+    normal per-row parsing (parse_model_json, then the label coercion) applies unchanged.
+    """
+    got = {}
+    if isinstance(parsed, dict):
+        # some models wrap the array: {"results": [...]}
+        parsed = next((v for v in parsed.values() if isinstance(v, list)), [parsed])
+    if isinstance(parsed, list):
+        wanted = set(pair_ids)
+        for item in parsed:
+            if not isinstance(item, dict):
+                continue
+            pid = str(item.get("pair_id", "")).strip()
+            if pid not in wanted or pid in got:
+                continue
+            if str(item.get("your_classification", "")).strip() not in ("0", "1"):
+                continue
+            got[pid] = json.dumps(
+                {"assessment": item.get("assessment", ""), "your_classification": int(str(item["your_classification"]).strip())},
+                ensure_ascii=False,
+            )
+    return got, [pid for pid in pair_ids if pid not in got]
+
+
+def score_batch(rows, call, parse):
+    """
+    rows: [(key, question, answer)]; call(prompt) -> raw text; parse = parse_model_json.
+    Returns ({key: single-pair JSON text}, [keys to re-queue], error or None).
+    """
+    pid_to_key = {f"p{n}": key for n, (key, _q, _a) in enumerate(rows, start=1)}
+    prompt = make_batch_prompt([(pid, q, a) for pid, (_key, q, a) in zip(pid_to_key, rows)])
+    try:
+        raw = call(prompt)
+    except Exception as e:
+        return {}, [key for key, _q, _a in rows], repr(e)
+    return _finish(raw, pid_to_key, parse)
+
+
+async def score_batch_async(rows, call, parse):
+    """asyncio version of score_batch; `call` is a coroutine function."""
+    pid_to_key = {f"p{n}": key for n, (key, _q, _a) in enumerate(rows, start=1)}
+    prompt = make_batch_prompt([(pid, q, a) for pid, (_key, q, a) in zip(pid_to_key, rows)])
+    try:
+        raw = await call(prompt)
+    except Exception as e:
+        return {}, [key for key, _q, _a in rows], repr(e)
+    return _finish(raw, pid_to_key, parse)
+
+
+def _finish(raw, pid_to_key, parse):
+    parsed, err, _extracted = parse(raw)
+    got, missing = split_batch_response(None if err else parsed, list(pid_to_key))
+    return {pid_to_key[p]: txt for p, txt in got.items()}, [pid_to_key[p] for p in missing], err
@@ -0,0 +1,780 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio client for the iFlytek Spark websocket chat API.
+
+Shared by `Spark Pro(or Max).py` and `Keyword+Spark Max.py`. The blocking
+websocket-client path keeps one OS thread per in-flight call; here all calls
+run on one event loop and a semaphore bounds how many are in flight, so a few
+hundred concurrent requests cost little more than their sockets.
+
+Usage (inside a script):
+    client = AsyncSparkClient(APP_ID, API_KEY, API_SECRET, SPARK_URL, SPARK_DOMAIN, concurrency=200)
+    raw = await client.chat(prompt, uid="tid_1_row_2")
+
+The signed URL is cached for its validity window (SignedUrlCache) and, with
+`prewarm > 0`, handshakes happen ahead of demand (AsyncWarmPool /
+WarmConnectionPool for the threaded scripts). open_ws is the scripts' blocking
+handshake on the same SignedUrlCache.
+
+HedgePolicy / run_hedged: when a call is slower than a percentile of recent
+latency, a duplicate is sent and the first response wins (AsyncSparkClient
+takes `hedge=` for the asyncio path).
+
+CallTrace: timing marks of one call (pacing wait, signing, handshake, first
+frame, end of stream) plus frame count and the usage block; collected and
+summarized by spark_telemetry.Telemetry (AsyncSparkClient takes `telemetry=`).
+"""
+import re
+import json
+import time
+import queue
+import base64
+import hmac
+import hashlib
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from urllib.parse import urlencode, urlparse
+from email.utils import formatdate, parsedate_to_datetime
+
+import websockets  # pip install "websockets>=14"
+
+
+# 1) auth URL
+def build_auth(ws_url: str, api_key: str, api_secret: str, timeval: float = None):
+    """
+    返回: (authed_url, date_str, host); `timeval` lets callers sign with server time.
+    """
+    u = urlparse(ws_url)
+    host = u.netloc
+    path = u.path
+
+    date_str = formatdate(timeval=timeval, localtime=False, usegmt=True)
+    signature_origin = f"host: {host}\n" f"date: {date_str}\n" f"GET {path} HTTP/1.1"
+
+    signature_sha = hmac.new(
+        api_secret.encode("utf-8"),
+        signature_origin.encode("utf-8"),
+        digestmod=hashlib.sha256,
+    ).digest()
+    signature = base64.b64encode(signature_sha).decode("utf-8")
+
+    authorization_origin = (
+        f'api_key="{api_key}", algorithm="hmac-sha256", '
+        f'headers="host date request-line", signature="{signature}"'
+    )
+    authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode("utf-8")
+
+    params = {"authorization": authorization, "date": date_str, "host": host}
+    authed_url = ws_url + "?" + urlencode(params)
+    return authed_url, date_str, host
+
+
+class SignedUrlCache:
+    """
+    Reuse one signed URL for `ttl_sec` instead of re-signing every call.
+
+    The server only checks that `date` is within ~300s of its own clock at
+    handshake time, so a URL signed once stays valid for a few minutes.
+    `observe_server_date` takes the `date` response header (from a failed or
+    successful handshake) and shifts our signing clock onto the server's,
+    so clock skew stops turning into handshake failures and burnt retries.
+    """
+
+    def __init__(self, ws_url: str, api_key: str, api_secret: str, ttl_sec: float = 240.0,
+                 resync_threshold_sec: float = 2.0):
+        self.ws_url = ws_url
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.ttl_sec = float(ttl_sec)
+        self.resync_threshold_sec = float(resync_threshold_sec)
+        self.offset_sec = 0.0  # server clock - local clock
+        self._lock = threading.Lock()
+        self._signed = None
+        self._expires = 0.0
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._signed is None or now >= self._expires:
+                self._signed = build_auth(self.ws_url, self.api_key, self.api_secret, timeval=now + self.offset_sec)
+                self._expires = now + self.ttl_sec
+            return self._signed
+
+    def observe_server_date(self, server_date):
+        if not server_date:
+            return
+        try:
+            offset = parsedate_to_datetime(server_date).timestamp() - time.time()
+        except Exception:
+            return
+        with self._lock:
+            # the header has 1s resolution; ignore jitter, re-sign on real skew
+            if abs(offset - self.offset_sec) >= self.resync_threshold_sec:
+                self.offset_sec = offset
+                self._signed = None
+
+
+class WarmConnectionPool:
+    """
+    Keep up to `size` handshaken websocket connections ready ahead of demand
+    (thread version, for the websocket-client path).
+
+    Spark serves one chat per connection, so every connection is used once and
+    closed by the caller; the pool only moves the TLS + websocket handshake off
+    the critical path. Connections idle longer than `max_idle_sec` are dropped.
+    """
+
+    def __init__(self, open_fn, size: int = 4, fillers: int = 2, max_idle_sec: float = 20.0):
+        self.open_fn = open_fn
+        self.max_idle_sec = float(max_idle_sec)
+        self._q = queue.Queue(maxsize=int(size))
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._fill, daemon=True) for _ in range(int(fillers))]
+        for t in self._threads:
+            t.start()
+
+    def _fill(self):
+        while not self._stop.is_set():
+            try:
+                ws = self.open_fn()
+            except Exception:
+                self._stop.wait(1.0)
+                continue
+            while not self._stop.is_set():
+                try:
+                    self._q.put((ws, time.monotonic()), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                _close_quietly(ws)
+
+    def acquire(self):
+        while True:
+            try:
+                ws, opened = self._q.get_nowait()
+            except queue.Empty:
+                return self.open_fn()
+            if time.monotonic() - opened <= self.max_idle_sec and getattr(ws, "connected", True):
+                return ws
+            _close_quietly(ws)
+
+    def close(self):
+        self._stop.set()
+        while True:
+            try:
+                ws, _ = self._q.get_nowait()
+            except queue.Empty:
+                break
+            _close_quietly(ws)
+
+
+def _close_quietly(ws):
+    try:
+        ws.close()
+    except Exception:
+        pass
+
+
+class AsyncWarmPool:
+    """asyncio version of WarmConnectionPool; fillers start on first acquire."""
+
+    def __init__(self, open_fn, size: int = 32, fillers: int = 4, max_idle_sec: float = 20.0):
+        self.open_fn = open_fn
+        self.size = int(size)
+        self.fillers = int(fillers)
+        self.max_idle_sec = float(max_idle_sec)
+        self._q = None
+        self._tasks = []
+
+    async def _fill(self):
+        while True:
+            try:
+                ws = await self.open_fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(1.0)
+                continue
+            await self._q.put((ws, time.monotonic()))
+
+    async def acquire(self):
+        if self._q is None:
+            self._q = asyncio.Queue(maxsize=self.size)
+            self._tasks = [asyncio.create_task(self._fill()) for _ in range(self.fillers)]
+        while not self._q.empty():
+            ws, opened = self._q.get_nowait()
+            if time.monotonic() - opened <= self.max_idle_sec and ws.state.name == "OPEN":
+                return ws
+            await ws.close()
+        return await self.open_fn()
+
+    async def close(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._q is not None and not self._q.empty():
+            ws, _ = self._q.get_nowait()
+            await ws.close()
+
+
+def build_request(app_id: str, domain: str, prompt: str, uid: str, temperature: float, max_tokens: int) -> dict:
+    return {
+        "header": {"app_id": app_id, "uid": uid},
+        "parameter": {
+            "chat": {
+                "domain": domain,
+                "temperature": float(temperature),
+                "max_tokens": int(max_tokens),
+            }
+        },
+        "payload": {"message": {"text": [{"role": "user", "content": prompt}]}},
+    }
+
+
+class SparkAPIError(RuntimeError):
+    """Non-zero header.code in a response frame."""
+
+    def __init__(self, code, message):
+        super().__init__(f"Spark API error code={code}, message={message}")
+        self.code = code
+
+
+class CallTrace:
+    """
+    Marks of one chat call in ms since the trace was created: admitted (the
+    rate limiter let it out), signed, connected, first_frame, done, cancelled.
+    read_frame() counts the frames and keeps the usage block (token counts).
+    """
+
+    def __init__(self, uid: str = "", kind: str = "chat"):
+        self.uid = uid
+        self.kind = kind
+        self.ts = time.time()
+        self.pooled = False  # socket taken from a warm pool: "connected" marks the acquire
+        self.frames = 0
+        self.usage = {}
+        self.marks = {}
+        self._t0 = time.perf_counter()
+
+    def mark(self, name: str):
+        self.marks[name] = (time.perf_counter() - self._t0) * 1000.0
+
+    def frame(self, usage=None):
+        self.frames += 1
+        if self.frames == 1:
+            self.mark("first_frame")
+        if usage:
+            self.usage = usage
+
+
+def open_ws(auth: SignedUrlCache, timeout_sec: int = 60, debug_time: bool = False, trace: CallTrace = None):
+    """
+    Blocking websocket-client handshake (the threaded scripts' path) with a URL
+    from `auth`. The server's date header, from an accepted or a rejected
+    handshake, re-syncs auth's signing clock.
+    """
+    import websocket  # pip install websocket-client
+
+    authed_url, date_str, _host = auth.get()
+    if trace is not None:
+        trace.mark("signed")
+
+    if debug_time:
+        print(f"[AUTH] client date_str = {date_str} (GMT RFC1123)")
+
+    try:
+        ws = websocket.create_connection(
+            authed_url,
+            timeout=timeout_sec,
+            header=[f"X-Date: {date_str}"],
+        )
+    except websocket._exceptions.WebSocketBadStatusException as e:
+        server_date = None
+        try:
+            server_date = (e.resp_headers or {}).get("date") or (e.resp_headers or {}).get("Date")
+        except Exception:
+            server_date = None
+        auth.observe_server_date(server_date)
+
+        if debug_time:
+            print("[AUTH] handshake failed.")
+            print("       client date_str:", date_str)
+            if server_date:
+                print("       server date    :", server_date)
+                try:
+                    dt_client = parsedate_to_datetime(date_str)
+                    dt_server = parsedate_to_datetime(server_date)
+                    skew_sec = abs((dt_client - dt_server).total_seconds())
+                    print(f"       |client-server| skew_sec = {skew_sec:.1f}")
+                    print(f"       signing offset now = {auth.offset_sec:+.1f}s")
+                except Exception:
+                    pass
+        raise
+
+    try:
+        auth.observe_server_date((ws.getheaders() or {}).get("date"))
+    except Exception:
+        pass
+    if trace is not None:
+        trace.mark("connected")
+    return ws
+
+
+def read_frame(raw, chunks: list, trace: CallTrace = None) -> int:
+    """Parse one response frame into `chunks`; return choices.status (2 = last)."""
+    msg = json.loads(raw)
+    if trace is not None:
+        trace.frame(msg.get("payload", {}).get("usage", {}).get("text"))
+
+    code = msg.get("header", {}).get("code", -1)
+    if code != 0:
+        raise SparkAPIError(code, msg.get("header", {}).get("message"))
+
+    choices = msg.get("payload", {}).get("choices", {})
+    for t in choices.get("text", []):
+        if isinstance(t, dict) and "content" in t:
+            chunks.append(t["content"])
+    return choices.get("status", 0)
+
+
+# label-first mode: the label can be read before the rationale has streamed in
+LABEL_RE = re.compile(r'"your_classification"\s*:\s*"?\s*([01])\b')
+
+
+def extract_label(text: str):
+    m = LABEL_RE.search(text or "")
+    return int(m.group(1)) if m else None
+
+
+def label_seen(text: str) -> bool:
+    return LABEL_RE.search(text or "") is not None
+
+
+def label_stop_rule(label_first: bool, collect_rationale: bool):
+    """stop_when for a label-first call: close the stream once the label is in, unless the rationale is wanted."""
+    return label_seen if (label_first and not collect_rationale) else None
+
+
+# the scripts' PROMPT_TEMPLATE with the label asked for first (their LABEL_FIRST switch)
+PROMPT_TEMPLATE_LABEL_FIRST = """Investor question:
+{question}
+
+Manager response:
+{answer}
+
+A research assistant has marked the above response as including a
+statement that reflects unwillingness or inability to answer (part) of the
+analysts' question, because of the following comment(s):
+> {comments}
+
+Based on the question and full response above, first classify whether the
+manager's response includes a statement, explanation, or justification
+indicating an inability or unwillingness to answer the question
+(1 = yes, 0 = no). Then give a short assessment that justifies the
+classification with specific phrases or sentences from the manager's
+response, or explains why there is no such indication.
+
+IMPORTANT OUTPUT RULES:
+1) Output MUST be exactly ONE valid JSON object.
+2) Do NOT include markdown code fences.
+3) Do NOT include any extra text before or after the JSON.
+4) "your_classification" MUST be the FIRST key.
+
+Return JSON in this exact format:
+{{
+  "your_classification": 1,
+  "assessment": "a short assessment unique to this evaluation"
+}}
+"""
+
+
+
+# 2) adaptive rate limit
+# header.code values that mean "slow down" (QPS / concurrency / busy limits)
+THROTTLE_CODES = {10007, 10110, 11202, 11203}
+
+
+def is_throttle_error(exc) -> bool:
+    code = getattr(exc, "code", None)
+    if code is None:
+        # handshake rejections carry an HTTP status instead
+        code = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+        return code == 429
+    return code in THROTTLE_CODES
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket (rate `rate` starts/sec, up to `burst` back-to-back) whose
+    rate is tuned AIMD-style from call outcomes:
+      - success      -> rate grows by ~`increase` starts/sec per second of successes
+      - throttle code -> rate *= `decrease` (at most once per `cooldown_sec`)
+    Thread-safe; `wait_turn` blocks, `wait_turn_async` awaits.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0, min_rate: float = 0.2, max_rate: float = 50.0,
+                 increase: float = 0.5, decrease: float = 0.5, cooldown_sec: float = 2.0):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.cooldown_sec = float(cooldown_sec)
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._last_cut = 0.0
+
+    def _reserve(self) -> float:
+        # take one token now (balance may go negative); return the wait for it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1.0
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def wait_turn(self):
+        sleep_sec = self._reserve()
+        if sleep_sec > 0:
+            time.sleep(sleep_sec)
+
+    async def wait_turn_async(self):
+        sleep_sec = self._reserve()
+        if sleep_sec > 0:
+            await asyncio.sleep(sleep_sec)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / max(self.rate, 1e-9))
+
+    def on_error(self, exc):
+        if not is_throttle_error(exc):
+            return
+        with self._lock:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_cut < self.cooldown_sec:
+                return
+            self._last_cut = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+
+
+# 3) client
+class HedgePolicy:
+    """
+    Fire a duplicate request once a call has been running longer than the
+    `percentile` of recently observed call latency. `budget` caps the extra
+    load: duplicates <= budget * calls (0.05 = at most 5% more requests).
+    No hedging until `min_samples` latencies have been seen; calls started
+    before that re-check every `recheck_sec`.
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, window: int = 500,
+                 min_samples: int = 20, min_delay_sec: float = 0.2, recheck_sec: float = 0.5):
+        self.percentile = float(percentile)
+        self.budget = float(budget)
+        self.min_samples = int(min_samples)
+        self.min_delay_sec = float(min_delay_sec)
+        self.recheck_sec = float(recheck_sec)
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0  # duplicates that answered first
+        self._lat = deque(maxlen=int(window))
+        self._lock = threading.Lock()
+
+    def observe(self, latency_sec: float):
+        with self._lock:
+            self._lat.append(float(latency_sec))
+
+    def start(self):
+        with self._lock:
+            self.calls += 1
+
+    def delay(self):
+        """Current hedge delay in seconds (None = not enough samples yet)."""
+        with self._lock:
+            if len(self._lat) < self.min_samples:
+                return None
+            lat = sorted(self._lat)
+        k = min(len(lat) - 1, int(round(self.percentile / 100.0 * (len(lat) - 1))))
+        return max(self.min_delay_sec, lat[k])
+
+    def next_wait(self, elapsed: float):
+        """(seconds to keep waiting, hedge now?) for a call running `elapsed` seconds."""
+        d = self.delay()
+        if d is None:
+            return self.recheck_sec, False
+        return max(0.0, d - elapsed), elapsed >= d
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def won(self):
+        with self._lock:
+            self.wins += 1
+
+    def summary(self) -> str:
+        return f"calls={self.calls} | hedged={self.hedges} | hedge_won={self.wins}"
+
+
+class _Attempt:
+    """Cancel hooks of one in-flight attempt (e.g. ws.abort); hooks registered after cancel() run at once."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.cancelled = False
+
+    def on_cancel(self, fn):
+        with self._lock:
+            if not self.cancelled:
+                self._hooks.append(fn)
+                return
+        _call_quietly(fn)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            hooks, self._hooks = self._hooks, []
+        for fn in hooks:
+            _call_quietly(fn)
+
+
+def _call_quietly(fn):
+    try:
+        fn()
+    except Exception:
+        pass
+
+
+def run_hedged(attempt, policy: HedgePolicy, pool):
+    """
+    Blocking hedged call for the threaded scripts (pace the call before this).
+    attempt(on_cancel) -> result runs in `pool` (an executor with room for two
+    attempts per caller); on_cancel(fn) registers how to abort that attempt,
+    which is called for the loser. The duplicate is not paced again: the
+    hedge budget caps it.
+    """
+    t0 = time.monotonic()
+    policy.start()
+    attempts = [_Attempt()]
+    futs = [pool.submit(attempt, attempts[0].on_cancel)]
+    while True:
+        timeout, due = policy.next_wait(time.monotonic() - t0)
+        if due:
+            if policy.try_spend():
+                attempts.append(_Attempt())
+                futs.append(pool.submit(attempt, attempts[1].on_cancel))
+            break
+        done, _ = wait(futs, timeout=timeout)
+        if done:
+            break
+
+    first_err = None
+    pending = set(futs)
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    if fut is not futs[0]:
+                        policy.won()
+                    policy.observe(time.monotonic() - t0)
+                    return fut.result()
+                first_err = first_err or fut.exception()
+        raise first_err
+    finally:
+        for fut, att in zip(futs, attempts):
+            if not fut.done():
+                fut.cancel()
+                att.cancel()
+
+
+class AsyncSparkClient:
+    def __init__(
+        self,
+        app_id: str,
+        api_key: str,
+        api_secret: str,
+        url: str,
+        domain: str,
+        concurrency: int = 200,
+        timeout_sec: float = 60,
+        limiter: AdaptiveRateLimiter = None,
+        prewarm: int = 0,
+        hedge: HedgePolicy = None,
+        telemetry=None,
+    ):
+        self.app_id = app_id
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.url = url
+        self.domain = domain
+        self.timeout_sec = float(timeout_sec)
+        self.limiter = limiter
+        self.hedge = hedge
+        self.telemetry = telemetry  # spark_telemetry.Telemetry: one CallTrace per attempt
+        self._sem = asyncio.Semaphore(int(concurrency))
+        self.auth = SignedUrlCache(url, api_key, api_secret)
+        self._pool = AsyncWarmPool(self._open, size=prewarm) if prewarm > 0 else None
+
+    async def aclose(self):
+        if self._pool is not None:
+            await self._pool.close()
+
+    async def _open(self, trace: CallTrace = None):
+        authed_url, date_str, _host = self.auth.get()
+        if trace is not None:
+            trace.mark("signed")
+        try:
+            ws = await websockets.connect(
+                authed_url,
+                additional_headers={"X-Date": date_str},
+                open_timeout=self.timeout_sec,
+                max_size=None,
+            )
+        except websockets.exceptions.InvalidStatus as e:
+            self.auth.observe_server_date(e.response.headers.get("date"))
+            raise
+        self.auth.observe_server_date(ws.response.headers.get("date"))
+        if trace is not None:
+            trace.mark("connected")
+        return ws
+
+    async def chat(self, prompt: str, uid: str, temperature: float = 0.2, max_tokens: int = 1024,
+                   stop_when=None) -> str:
+        """`stop_when(text_so_far) -> True` closes the stream early (e.g. label_seen)."""
+        async with self._sem:
+            if self.hedge is None:
+                return await self._attempt(prompt, uid, temperature, max_tokens, stop_when)
+            return await self._hedged(prompt, uid, temperature, max_tokens, stop_when)
+
+    async def _hedged(self, *args) -> str:
+        # the hedge clock starts once the limiter lets the call out; the duplicate
+        # shares the caller's concurrency slot and skips the limiter queue (the
+        # hedge budget is its cap), otherwise it would start behind every waiting call
+        if self.limiter is not None:
+            await self.limiter.wait_turn_async()
+        t0 = time.monotonic()
+        self.hedge.start()
+        tasks = [asyncio.ensure_future(self._attempt(*args, paced=False))]
+        while True:
+            timeout, due = self.hedge.next_wait(time.monotonic() - t0)
+            if due:
+                if self.hedge.try_spend():
+                    tasks.append(asyncio.ensure_future(self._attempt(*args, paced=False)))
+                break
+            done, _ = await asyncio.wait(tasks, timeout=timeout)
+            if done:
+                break
+
+        first_err = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is not tasks[0]:
+                            self.hedge.won()
+                        self.hedge.observe(time.monotonic() - t0)
+                        return t.result()
+                    first_err = first_err or t.exception()
+            raise first_err
+        finally:
+            for t in tasks:
+                t.cancel()  # the loser's socket is closed by _chat's finally
+
+    async def _attempt(self, prompt, uid, temperature, max_tokens, stop_when=None, paced: bool = True) -> str:
+        trace = CallTrace(uid)
+        if paced and self.limiter is not None:
+            await self.limiter.wait_turn_async()
+        trace.mark("admitted")
+        try:
+            raw = await asyncio.wait_for(
+                self._chat(prompt, uid, temperature, max_tokens, stop_when, trace),
+                timeout=self.timeout_sec,
+            )
+        except asyncio.CancelledError:
+            # hedge loser (or the caller went away)
+            trace.mark("cancelled")
+            self._record(trace)
+            raise
+        except Exception as e:
+            if self.limiter is not None:
+                self.limiter.on_error(e)
+            self._record(trace, error=e)
+            raise
+        if self.limiter is not None:
+            self.limiter.on_success()
+        self._record(trace, raw)
+        return raw
+
+    def _record(self, trace: CallTrace, text: str = None, error=None):
+        if self.telemetry is not None:
+            self.telemetry.record(trace, text, error)
+
+    async def _chat(self, prompt, uid, temperature, max_tokens, stop_when=None, trace: CallTrace = None) -> str:
+        req = build_request(self.app_id, self.domain, prompt, uid, temperature, max_tokens)
+        if self._pool is not None:
+            ws = await self._pool.acquire()
+            if trace is not None:
+                trace.pooled = True
+                trace.mark("connected")
+        else:
+            ws = await self._open(trace)
+
+        chunks = []
+        try:
+            await ws.send(json.dumps(req, ensure_ascii=False))
+            while True:
+                if read_frame(await ws.recv(), chunks, trace) == 2:
+                    break
+                if stop_when is not None and stop_when("".join(chunks)):
+                    break
+        finally:
+            await ws.close()
+        return "".join(chunks).strip()
+
+
+_ERR_CODE_RE = re.compile(r"code=(-?\d+)")
+_HTTP_STATUS_RE = re.compile(r"\b(401|403|429)\b")
+
+
+def classify_error(err) -> str:
+    """
+    Error class of a failed call (exception, or its text as stored in
+    spark_parse_error): throttle | auth | timeout | network | api | parse | other.
+    Text that is not a "call_failed: ..." record is a response that did not parse.
+    """
+    if isinstance(err, BaseException):
+        if is_throttle_error(err):
+            return "throttle"
+        err = "call_failed: " + repr(err)
+    text = str(err or "")
+    if not text.startswith("call_failed"):
+        return "parse"
+    m = _ERR_CODE_RE.search(text)
+    if m:
+        return "throttle" if int(m.group(1)) in THROTTLE_CODES else "api"
+    m = _HTTP_STATUS_RE.search(text)
+    if m:
+        return "throttle" if m.group(1) == "429" else "auth"
+    low = text.lower()
+    if "timeout" in low or "timed out" in low:
+        return "timeout"
+    if any(w in low for w in ("connection", "websocket", "closed", "eof", "reset", "refused")):
+        return "network"
+    return "other"
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Load-test driver for the Spark clients, against spark_stub_server (or any
+endpoint speaking the protocol).
+
+Every combination of --modes x --workers x --qps x --prewarm is run for
+--requests calls and reported as one line: throughput (req/s), latency
+percentiles of the calls, and errors by class. Latency is measured from the
+moment a worker slot and the pacing let the call out, in both modes; replies
+that are not valid JSON count as "parse" errors.
+
+  threads: websocket-client + ThreadPoolExecutor, one socket per call -- the
+           spark_chat_once / spark_worker setup of the scripts
+  async:   AsyncSparkClient on one event loop
+
+    python spark_loadtest.py --serve --requests 400 --modes threads async --workers 10 40 --qps 0 20
+    python spark_loadtest.py --url ws://127.0.0.1:8765/v3.5/chat --workers 20 --out loadtest.csv
+"""
+import json
+import time
+import asyncio
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import websocket  # pip install websocket-client
+
+from spark_client import (AdaptiveRateLimiter, AsyncSparkClient, SignedUrlCache, WarmConnectionPool,
+                          build_request, classify_error, read_frame)
+import spark_stub_server as stub
+
+APP_ID, API_KEY, API_SECRET, DOMAIN = "stub-app", "stub-key", "stub-secret", "generalv3.5"
+
+PROMPT = """Investor question:
+{q}
+
+Manager response:
+{a}
+
+Return JSON in this exact format:
+{{"assessment": "...", "your_classification": 0}}
+"""
+
+
+def make_prompt(chars: int) -> str:
+    filler = ("we do not provide guidance on that but the quarter was strong across segments " * 200)[:chars]
+    return PROMPT.format(q="What is your outlook for next year?", a=filler)
+
+
+def make_limiter(qps: float):
+    # fixed pacing like StartRateLimiter when qps > 0 (min_rate == max_rate)
+    if qps <= 0:
+        return None
+    return AdaptiveRateLimiter(qps, burst=1, min_rate=qps, max_rate=qps)
+
+
+def run_threads(url, prompt, n, workers, qps, prewarm, timeout_sec):
+    auth = SignedUrlCache(url, API_KEY, API_SECRET)
+    limiter = make_limiter(qps)
+
+    def open_ws():
+        authed_url, date_str, _host = auth.get()
+        return websocket.create_connection(authed_url, timeout=timeout_sec)
+
+    pool = WarmConnectionPool(open_ws, size=prewarm) if prewarm > 0 else None
+
+    def call(k):
+        if limiter is not None:
+            limiter.wait_turn()
+        t0 = time.perf_counter()
+        try:
+            ws = pool.acquire() if pool is not None else open_ws()
+            chunks = []
+            try:
+                ws.send(json.dumps(build_request(APP_ID, DOMAIN, prompt, f"load_{k}", 0.2, 1024)))
+                while read_frame(ws.recv(), chunks) != 2:
+                    pass
+            finally:
+                ws.close()
+            return time.perf_counter() - t0, reply_error("".join(chunks))
+        except Exception as e:
+            return time.perf_counter() - t0, classify_error(e)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            return list(ex.map(call, range(n)))
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def run_async(url, prompt, n, workers, qps, prewarm, timeout_sec):
+    async def go():
+        # slots and pacing are taken here (not inside the client) so the clock starts like in run_threads
+        client = AsyncSparkClient(APP_ID, API_KEY, API_SECRET, url, DOMAIN, concurrency=workers,
+                                  timeout_sec=timeout_sec, prewarm=prewarm)
+        limiter = make_limiter(qps)
+        slots = asyncio.Semaphore(workers)
+
+        async def call(k):
+            async with slots:
+                if limiter is not None:
+                    await limiter.wait_turn_async()
+                t0 = time.perf_counter()
+                try:
+                    raw = await client.chat(prompt, uid=f"load_{k}")
+                    return time.perf_counter() - t0, reply_error(raw)
+                except Exception as e:
+                    return time.perf_counter() - t0, classify_error(e)
+
+        try:
+            return await asyncio.gather(*(call(k) for k in range(n)))
+        finally:
+            await client.aclose()
+
+    return asyncio.run(go())
+
+
+def reply_error(text: str):
+    try:
+        json.loads(text)
+        return None
+    except ValueError:
+        return "parse"
+
+
+RUNNERS = {"threads": run_threads, "async": run_async}
+
+
+def summarize(results, wall_sec: float, **config) -> dict:
+    lat = np.array([t for t, err in results if err is None]) * 1000.0
+    errors = pd.Series([err for _t, err in results if err is not None], dtype=object).value_counts()
+    row = dict(config)
+    row.update({
+        "requests": len(results),
+        "ok": int(len(lat)),
+        "req_per_s": len(results) / wall_sec if wall_sec > 0 else float("nan"),
+        "ok_per_s": len(lat) / wall_sec if wall_sec > 0 else float("nan"),
+        "wall_s": wall_sec,
+    })
+    for p in (50, 90, 95, 99):
+        row[f"p{p}_ms"] = float(np.percentile(lat, p)) if len(lat) else float("nan")
+    row["max_ms"] = float(lat.max()) if len(lat) else float("nan")
+    row["errors"] = ";".join(f"{k}={v}" for k, v in errors.items())
+    return row
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Spark client load test")
+    ap.add_argument("--url", default=None, help="endpoint to test (default: start a stub server, see --serve)")
+    ap.add_argument("--serve", action="store_true", help="start spark_stub_server in-process")
+    ap.add_argument("--port", type=int, default=8765, help="--serve port")
+    ap.add_argument("--requests", type=int, default=200, help="calls per configuration")
+    ap.add_argument("--modes", nargs="+", default=["threads", "async"], choices=sorted(RUNNERS))
+    ap.add_argument("--workers", nargs="+", type=int, default=[20], help="threads / in-flight calls")
+    ap.add_argument("--qps", nargs="+", type=float, default=[0.0], help="client-side pacing (0 = none)")
+    ap.add_argument("--prewarm", nargs="+", type=int, default=[0], help="warm sockets kept ready (0 = off)")
+    ap.add_argument("--prompt-chars", type=int, default=1500, help="length of the answer text in the prompt")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--out", default=None, help="also write the table (.csv/.parquet/.xlsx)")
+    stub.add_config_args(ap)
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    shutdown = None
+    url = args.url
+    if url is None or args.serve:
+        url, shutdown = stub.serve_in_thread(stub.config_from_args(args), port=args.port)
+        print(f"[STUB] {url}")
+
+    prompt = make_prompt(args.prompt_chars)
+    rows = []
+    try:
+        for mode, workers, qps, prewarm in itertools.product(args.modes, args.workers, args.qps, args.prewarm):
+            t0 = time.perf_counter()
+            results = RUNNERS[mode](url, prompt, args.requests, workers, qps, prewarm, args.timeout)
+            row = summarize(results, time.perf_counter() - t0, mode=mode, workers=workers, qps=qps, prewarm=prewarm)
+            rows.append(row)
+            print(f"[LOAD] {mode:<7} workers={workers:<4} qps={qps:<5g} prewarm={prewarm:<3} | "
+                  f"{row['req_per_s']:7.1f} req/s | p50={row['p50_ms']:.0f} p90={row['p90_ms']:.0f} "
+                  f"p99={row['p99_ms']:.0f} max={row['max_ms']:.0f} ms | ok={row['ok']}/{row['requests']} {row['errors']}")
+    finally:
+        if shutdown is not None:
+            shutdown()
+
+    table = pd.DataFrame(rows)
+    if args.out:
+        from qa_io import write_table
+        write_table(table, args.out)
+        print("[LOAD] saved:", args.out)
+    return table
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Deferred retry pass over dead-lettered rows (spark_store.DeadLetterQueue).
+
+Workers make one attempt per row and never sleep; rows that fail or do not
+parse are dead-lettered and retried here at the end of the run (or on
+demand), with their own concurrency and a retry policy per error class
+(spark_client.classify_error). Backoff is a due time in a heap, so a waiting
+row holds no worker slot.
+"""
+import heapq
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from spark_client import classify_error
+
+# error class -> (attempts in the retry pass, first backoff sec, backoff factor)
+RETRY_POLICIES = {
+    "throttle": (6, 5.0, 2.0),
+    "timeout": (3, 2.0, 2.0),
+    "network": (4, 1.0, 2.0),
+    "api": (2, 2.0, 2.0),
+    "parse": (2, 0.0, 1.0),   # ask again; sampling usually fixes a malformed answer
+    "auth": (0, 0.0, 1.0),    # signature / clock problems need a human, not retries
+    "other": (2, 2.0, 2.0),
+}
+
+
+def backoff_sec(policy, attempt: int) -> float:
+    """Delay before retry number `attempt` (1-based)."""
+    _n, first, factor = policy
+    return first * factor ** (attempt - 1)
+
+
+def run_retry_pass(items, work, workers: int, on_success, on_give_up, policies=None):
+    """
+    items: [(key, payload, error)] -- error is what sent the row to the queue.
+    work(payload) -> (result, error or None); runs on `workers` threads.
+    on_success(key, result) / on_give_up(key, result, error, error_class, attempts)
+    are called on the calling thread. Returns {error_class: rows given up}.
+    """
+    policies = dict(RETRY_POLICIES, **(policies or {}))
+    heap = []
+    gave_up = {}
+    seq = 0
+
+    def schedule(key, payload, result, error, attempts):
+        nonlocal seq
+        cls = classify_error(error)
+        policy = policies.get(cls, policies["other"])
+        if attempts >= policy[0]:
+            gave_up[cls] = gave_up.get(cls, 0) + 1
+            on_give_up(key, result, error, cls, attempts)
+            return
+        seq += 1
+        heapq.heappush(heap, (time.monotonic() + backoff_sec(policy, attempts + 1), seq, key, payload, attempts + 1))
+
+    for key, payload, error in items:
+        schedule(key, payload, None, error, 0)
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        while heap or running:
+            now = time.monotonic()
+            while heap and heap[0][0] <= now and len(running) < workers:
+                _due, _seq, key, payload, attempts = heapq.heappop(heap)
+                running[ex.submit(work, payload)] = (key, payload, attempts)
+
+            timeout = None
+            if heap and len(running) < workers:
+                timeout = max(0.0, heap[0][0] - now)
+            if not running:
+                time.sleep(timeout)  # only the coordinator waits for the next due row
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                key, payload, attempts = running.pop(fut)
+                try:
+                    result, error = fut.result()
+                except Exception as e:
+                    result, error = None, e
+                if error is None:
+                    on_success(key, result)
+                else:
+                    schedule(key, payload, result, error, attempts)
+    return gave_up
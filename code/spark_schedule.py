@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Submission order for queued Spark tasks.
+
+A thread pool (or a FIFO semaphore) starts tasks in the order they are
+submitted. In dataframe order a few very long answers that happen to start
+late become the tail of the run. Longest-processing-time-first (LPT) starts
+the expensive prompts while there is still short work to fill the other
+workers around them, which keeps the makespan close to the optimum.
+
+fair_key: optional per-group round robin (e.g. by transcriptid), LPT inside
+each group, so one huge call does not monopolize the workers and partial
+results cover every transcript early.
+"""
+from itertools import zip_longest
+
+from spark_batch import estimate_tokens
+
+POLICIES = ("fifo", "lpt")
+
+
+def prompt_cost(prompt_text: str, expected_output_tokens: int = 0) -> int:
+    """Estimated tokens processed for one call: prompt in + expected answer out."""
+    return estimate_tokens(prompt_text) + expected_output_tokens
+
+
+def order_tasks(tasks, cost_of, policy: str = "lpt", fair_key=None):
+    """
+    tasks: any sequence; cost_of(task) -> number; fair_key(task) -> group or None.
+    Returns a new list in submission order (stable for equal costs).
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"unknown schedule policy: {policy!r} ({'/'.join(POLICIES)})")
+    tasks = list(tasks)
+    if policy == "fifo" and fair_key is None:
+        return tasks
+
+    costs = [cost_of(t) for t in tasks]
+    order = list(range(len(tasks)))
+    if policy == "lpt":
+        order.sort(key=lambda n: -costs[n])
+    if fair_key is None:
+        return [tasks[n] for n in order]
+
+    groups = {}
+    for n in order:
+        groups.setdefault(fair_key(tasks[n]), []).append(n)
+    # the group holding the most expensive task leads every round
+    rounds = zip_longest(*groups.values())
+    return [tasks[n] for rnd in rounds for n in rnd if n is not None]
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk state for the Spark scripts (SQLite / JSONL, standard library only).
+
+ResponseCache: content-addressed cache of raw model responses. The key is a
+hash of everything that determines the answer -- the rendered prompt (so
+question, answer and template), model endpoint, domain, temperature,
+max_tokens and the caller's prompt version (bumped when anything outside the
+rendered text changes, e.g. parsing rules) -- so a rerun with unchanged inputs
+skips the network entirely. PromptCache is the scripts' view of it: keys from
+the prompt alone under fixed call settings, and only replayable responses
+stored.
+
+ResultJournal: append-only record of finished rows, replayed on restart so a
+run resumes where it stopped.
+
+DeadLetterQueue: the same kind of journal for rows that failed or did not
+parse, consumed by the deferred retry pass (spark_retry).
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def cache_key(prompt: str, model: str, domain: str, temperature: float, max_tokens: int,
+              version: str) -> str:
+    blob = json.dumps([prompt, model, domain, float(temperature), int(max_tokens), str(version)],
+                      ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    key -> raw response text, evicted least-recently-used once the stored
+    text exceeds `max_mb`. Safe to share between worker threads.
+    """
+
+    def __init__(self, path: str, max_mb: float = 512.0):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, raw TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._db.execute("SELECT raw FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def contains(self, key: str) -> bool:
+        """Membership test that leaves hit/miss counters and recency alone."""
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key: str, raw: str):
+        size = len(raw.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, raw, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, raw, size, now, now),
+            )
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # drop least recently used rows until 90% of the budget is free again
+        target = int(self.max_bytes * 0.9)
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        drop = []
+        for key, size in rows:
+            if self._total <= target:
+                break
+            drop.append((key,))
+            self._total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", drop)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class PromptCache:
+    """
+    ResponseCache addressed by rendered prompt under one script's fixed call
+    settings. `cache=None` turns it off (every lookup misses, nothing is
+    stored); `replayable(raw)` decides which responses are worth storing.
+    """
+
+    def __init__(self, cache: ResponseCache, model: str, domain: str, temperature: float, max_tokens: int,
+                 version: str, replayable=None):
+        self.cache = cache
+        self.settings = (model, domain, temperature, max_tokens, version)
+        self.replayable = replayable
+
+    def key(self, prompt: str) -> str:
+        return cache_key(prompt, *self.settings)
+
+    def lookup(self, prompt: str):
+        """(key, raw) -- raw is the cached response, or None on a miss / no cache."""
+        if self.cache is None:
+            return None, None
+        key = self.key(prompt)
+        return key, self.cache.get(key)
+
+    def contains(self, prompt: str) -> bool:
+        return self.cache is not None and self.cache.contains(self.key(prompt))
+
+    def store(self, key: str, raw: str):
+        if self.cache is None or raw is None:
+            return
+        if self.replayable is None or self.replayable(raw):
+            self.cache.put(key, raw)
+
+
+class ResultJournal:
+    """
+    Append-only JSONL journal of finished rows, keyed by (transcriptid, qid/row).
+
+    Each completed row is one flushed line, so a crash loses at most the line
+    being written (a torn last line is ignored on replay) and the cost per row
+    is constant -- unlike rewriting the whole workbook every N rows.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fh = None
+
+    @staticmethod
+    def make_key(tid, rid) -> str:
+        return f"{tid}|{rid}"
+
+    @staticmethod
+    def row_key(df, i) -> str:
+        """make_key for row `i` of the scripts' Q&A frame (qid when it has one, else the row label)."""
+        return ResultJournal.make_key(df.at[i, "transcriptid"], df.at[i, "qid"] if "qid" in df.columns else i)
+
+    def replay(self) -> dict:
+        """key -> last journaled record (empty if the journal does not exist yet)."""
+        done = {}
+        try:
+            fh = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return done
+        with fh:
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # torn write from a crash
+                done[rec.pop("_key")] = rec
+        return done
+
+    def append(self, key: str, record: dict):
+        line = json.dumps({"_key": key, **record}, ensure_ascii=False, default=_json_default)
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self.path, "a+", encoding="utf-8")
+                if self._fh.tell() > 0:
+                    # start on a fresh line if the last run died mid-write
+                    self._fh.seek(self._fh.tell() - 1)
+                    torn = self._fh.read(1) != "\n"
+                    self._fh.seek(0, 2)
+                    if torn:
+                        self._fh.write("\n")
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def _json_default(o):
+    if hasattr(o, "item"):  # numpy scalars
+        return o.item()
+    if type(o).__name__ in ("NAType", "NaTType"):  # pd.NA / pd.NaT
+        return None
+    raise TypeError(f"not JSON serializable: {type(o).__name__}")
+
+
+class DeadLetterQueue(ResultJournal):
+    """
+    Rows that failed or did not parse, waiting for the deferred retry pass.
+    Same JSONL format as ResultJournal (last line per key wins) with a
+    status of dead / resolved / gave_up.
+    """
+
+    def add(self, key: str, record: dict):
+        self.append(key, {**record, "status": "dead"})
+
+    def resolve(self, key: str):
+        self.append(key, {"status": "resolved"})
+
+    def give_up(self, key: str, record: dict):
+        self.append(key, {**record, "status": "gave_up"})
+
+    def pending(self, include_gave_up: bool = False) -> dict:
+        wanted = ("dead", "gave_up") if include_gave_up else ("dead",)
+        return {k: r for k, r in self.replay().items() if r.get("status") in wanted}
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the iFlytek Spark websocket chat endpoint.
+
+Speaks the same protocol as the real service closely enough for the clients
+in this folder (spark_chat_once, AsyncSparkClient): signed-URL query
+parameters on the handshake, one {header, parameter, payload} request per
+socket, and `choices.text` frames with status 0/1/2 followed by usage.
+Latency, rate-limit rejections, API errors and malformed replies are
+configurable, so concurrency and limiter settings can be tuned offline
+(see spark_loadtest.py).
+
+    python spark_stub_server.py --port 8765 --latency-median-ms 800 --max-qps 20
+    # then point SPARK_URL at ws://127.0.0.1:8765/v3.5/chat
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlparse
+
+import websockets  # pip install "websockets>=14"
+
+from spark_batch import estimate_tokens
+
+# real service codes: 10163 bad request parameters, 11200 auth, 11202 QPS, 11203 concurrency
+CODE_BAD_REQUEST = 10163
+CODE_QPS = 11202
+CODE_CONCURRENCY = 11203
+
+PAIR_ID_RE = re.compile(r"### pair_id: (\S+)")
+
+
+class StubConfig:
+    def __init__(
+        self,
+        latency_median_ms: float = 300.0,  # time to first frame, lognormal
+        latency_sigma: float = 0.5,
+        frame_ms: float = 20.0,            # gap between streamed frames
+        frame_chars: int = 40,
+        reply_words: int = 40,             # length of the generated assessment
+        max_qps: float = 0.0,              # 0 = unlimited; over it -> code 11202
+        max_concurrent: int = 0,           # 0 = unlimited; over it -> code 11203
+        handshake_429_rate: float = 0.0,   # share of handshakes rejected with HTTP 429
+        error_rate: float = 0.0,           # share of calls answered with `error_code`
+        error_code: int = 10000,
+        malformed_rate: float = 0.0,       # share of replies that are not valid JSON
+        require_auth: bool = True,         # handshake must carry authorization/date/host
+        seed: int = None,
+    ):
+        self.latency_median_ms = latency_median_ms
+        self.latency_sigma = latency_sigma
+        self.frame_ms = frame_ms
+        self.frame_chars = frame_chars
+        self.reply_words = reply_words
+        self.max_qps = max_qps
+        self.max_concurrent = max_concurrent
+        self.handshake_429_rate = handshake_429_rate
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.malformed_rate = malformed_rate
+        self.require_auth = require_auth
+        self.seed = seed
+
+
+class StubState:
+    """Per-server counters and the QPS token bucket (event-loop thread only)."""
+
+    def __init__(self, cfg: StubConfig):
+        self.cfg = cfg
+        self.rng = random.Random(cfg.seed)
+        self.active = 0
+        self.requests = 0
+        self.rejected = 0
+        self._tokens = max(1.0, cfg.max_qps)
+        self._last = time.monotonic()
+
+    def take_token(self) -> bool:
+        if self.cfg.max_qps <= 0:
+            return True
+        now = time.monotonic()
+        self._tokens = min(max(1.0, self.cfg.max_qps), self._tokens + (now - self._last) * self.cfg.max_qps)
+        self._last = now
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+
+def make_reply(prompt: str, rng: random.Random, cfg: StubConfig) -> str:
+    """Reply shaped like the prompt asks: single object (label-first or not) or batch array."""
+    words = " ".join(rng.choice(("the", "manager", "response", "question", "guidance", "quarter", "declines"))
+                     for _ in range(cfg.reply_words))
+    pids = PAIR_ID_RE.findall(prompt)
+    if pids:
+        return json.dumps([{"pair_id": p, "assessment": words, "your_classification": rng.randint(0, 1)} for p in pids])
+    label = rng.randint(0, 1)
+    a, c = prompt.find('"assessment"'), prompt.find('"your_classification"')
+    if c != -1 and (a == -1 or c < a):
+        return json.dumps({"your_classification": label, "assessment": words})
+    return json.dumps({"assessment": words, "your_classification": label})
+
+
+def frame(code: int, status: int, seq: int = 0, content: str = None, usage: dict = None, message: str = "Success"):
+    msg = {"header": {"code": code, "message": message, "sid": f"stub{seq:04d}", "status": status}}
+    if content is not None:
+        msg["payload"] = {"choices": {"status": status, "seq": seq,
+                                      "text": [{"content": content, "role": "assistant", "index": 0}]}}
+        if usage is not None:
+            msg["payload"]["usage"] = {"text": usage}
+    return json.dumps(msg, ensure_ascii=False)
+
+
+def bad_request(req) -> bool:
+    try:
+        return not (req["header"]["app_id"] and req["parameter"]["chat"]["domain"]
+                    and req["payload"]["message"]["text"][-1]["content"])
+    except (KeyError, IndexError, TypeError):
+        return True
+
+
+def make_process_request(state: StubState):
+    def process_request(connection, request):
+        cfg = state.cfg
+        if cfg.require_auth:
+            q = parse_qs(urlparse(request.path).query)
+            if not all(k in q for k in ("authorization", "date", "host")):
+                return connection.respond(HTTPStatus.UNAUTHORIZED, "HMAC signature cannot be verified\n")
+        if cfg.handshake_429_rate and state.rng.random() < cfg.handshake_429_rate:
+            return connection.respond(HTTPStatus.TOO_MANY_REQUESTS, "too many requests\n")
+        return None
+    return process_request
+
+
+async def handle(ws, state: StubState):
+    cfg, rng = state.cfg, state.rng
+    state.active += 1
+    try:
+        req = json.loads(await ws.recv())
+        state.requests += 1
+        if bad_request(req):
+            await ws.send(frame(CODE_BAD_REQUEST, 2, message="invalid request parameters"))
+            return
+        if cfg.max_concurrent and state.active > cfg.max_concurrent:
+            state.rejected += 1
+            await ws.send(frame(CODE_CONCURRENCY, 2, message="concurrency limit exceeded"))
+            return
+        if not state.take_token():
+            state.rejected += 1
+            await ws.send(frame(CODE_QPS, 2, message="qps limit exceeded"))
+            return
+
+        await asyncio.sleep(rng.lognormvariate(0.0, cfg.latency_sigma) * cfg.latency_median_ms / 1000.0)
+        if cfg.error_rate and rng.random() < cfg.error_rate:
+            await ws.send(frame(cfg.error_code, 2, message="stub error"))
+            return
+
+        prompt = req["payload"]["message"]["text"][-1]["content"]
+        text = make_reply(prompt, rng, cfg)
+        if cfg.malformed_rate and rng.random() < cfg.malformed_rate:
+            text = text[: max(1, len(text) // 2)]  # cut mid-object, like a truncated stream
+
+        parts = [text[i:i + cfg.frame_chars] for i in range(0, len(text), cfg.frame_chars)] or [""]
+        for seq, part in enumerate(parts):
+            last = seq == len(parts) - 1
+            status = 2 if last else (0 if seq == 0 else 1)
+            usage = None
+            if last:
+                p_tok, c_tok = estimate_tokens(prompt), estimate_tokens(text)
+                usage = {"question_tokens": p_tok, "prompt_tokens": p_tok,
+                         "completion_tokens": c_tok, "total_tokens": p_tok + c_tok}
+            await ws.send(frame(0, status, seq, part, usage))
+            if not last and cfg.frame_ms:
+                await asyncio.sleep(cfg.frame_ms / 1000.0)
+    except websockets.ConnectionClosed:
+        pass  # the client stopped reading (label-first, hedge loser, timeout)
+    finally:
+        state.active -= 1
+
+
+async def serve(host: str, port: int, cfg: StubConfig, ready=None, stop=None):
+    state = StubState(cfg)
+    async with websockets.serve(lambda ws: handle(ws, state), host, port,
+                                process_request=make_process_request(state), max_size=None):
+        if ready is not None:
+            ready(state)
+        await (stop if stop is not None else asyncio.Future())
+
+
+def serve_in_thread(cfg: StubConfig, host: str = "127.0.0.1", port: int = 8765):
+    """Start the stub on a daemon thread; returns (ws_url, shutdown)."""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    stop = loop.create_future()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve(host, port, cfg, ready=lambda _s: started.set(), stop=stop))
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    if not started.wait(10):
+        raise RuntimeError(f"stub server did not start on {host}:{port}")
+
+    def shutdown():
+        loop.call_soon_threadsafe(lambda: stop.done() or stop.set_result(None))
+        t.join(10)
+
+    return f"ws://{host}:{port}/v3.5/chat", shutdown
+
+
+def add_config_args(ap: argparse.ArgumentParser):
+    d = StubConfig()
+    ap.add_argument("--latency-median-ms", type=float, default=d.latency_median_ms, help="median time to first frame")
+    ap.add_argument("--latency-sigma", type=float, default=d.latency_sigma, help="lognormal sigma of that latency")
+    ap.add_argument("--frame-ms", type=float, default=d.frame_ms, help="gap between streamed frames")
+    ap.add_argument("--frame-chars", type=int, default=d.frame_chars, help="characters per frame")
+    ap.add_argument("--reply-words", type=int, default=d.reply_words, help="words in the generated assessment")
+    ap.add_argument("--max-qps", type=float, default=d.max_qps, help="server QPS limit (0 = off) -> code 11202")
+    ap.add_argument("--max-concurrent", type=int, default=d.max_concurrent, help="concurrent calls (0 = off) -> code 11203")
+    ap.add_argument("--handshake-429-rate", type=float, default=d.handshake_429_rate, help="share of handshakes rejected with 429")
+    ap.add_argument("--error-rate", type=float, default=d.error_rate, help="share of calls answered with --error-code")
+    ap.add_argument("--error-code", type=int, default=d.error_code)
+    ap.add_argument("--malformed-rate", type=float, default=d.malformed_rate, help="share of replies cut mid-JSON")
+    ap.add_argument("--no-auth", action="store_true", help="accept handshakes without signed-URL parameters")
+    ap.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args) -> StubConfig:
+    return StubConfig(
+        latency_median_ms=args.latency_median_ms, latency_sigma=args.latency_sigma,
+        frame_ms=args.frame_ms, frame_chars=args.frame_chars, reply_words=args.reply_words,
+        max_qps=args.max_qps, max_concurrent=args.max_concurrent,
+        handshake_429_rate=args.handshake_429_rate, error_rate=args.error_rate, error_code=args.error_code,
+        malformed_rate=args.malformed_rate, require_auth=not args.no_auth, seed=args.seed,
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local Spark websocket stand-in")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    add_config_args(ap)
+    args = ap.parse_args()
+    print(f"[STUB] ws://{args.host}:{args.port}/v3.5/chat")
+    asyncio.run(serve(args.host, args.port, config_from_args(args)))
+
+
+if __name__ == "__main__":
+    main()
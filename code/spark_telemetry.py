@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Per-call telemetry for the Spark scripts.
+
+Every chat attempt carries a spark_client.CallTrace; Telemetry.record() turns
+it into one row with the time spent in each stage
+
+  wait         rate limiter / pacing, before the call was let out
+  sign         signing the URL (cached, so usually ~0)
+  handshake    TLS + websocket handshake (or taking a warm pooled socket)
+  first_frame  request sent -> first response frame
+  stream       first frame -> last frame (generation)
+  total        whole attempt, wait included
+
+plus frame count, response length, usage tokens (when the API reports them)
+and the outcome ("ok", an error class from classify_error, or "cancelled"
+for hedge losers). Rows go to a .jsonl file as they arrive (or to .csv /
+.parquet at close); close() also writes a Prometheus text dump, and
+`port=` serves the same text over HTTP while the run is going.
+
+    tel = Telemetry("calls.jsonl", prom_path="calls.prom", port=9108)
+    ...  # tel.record(trace, raw) / tel.record(trace, error=e) per attempt
+         # (the scripts call record_call(TELEMETRY, ...), a no-op when off)
+    tel.close()
+    print(tel.summary_text())
+"""
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from spark_client import CallTrace, classify_error
+from qa_io import write_table
+
+STAGES = ("wait", "sign", "handshake", "first_frame", "stream", "total")
+# stage -> mark that ends it; each stage starts at the previous mark that was set
+_STAGE_ENDS = (("wait", "admitted"), ("sign", "signed"), ("handshake", "connected"),
+               ("first_frame", "first_frame"), ("stream", "done"))
+TOKEN_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens")
+# histogram upper bounds in seconds (Prometheus `le`)
+BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PERCENTILES = (50, 90, 95, 99)
+
+
+def trace_row(trace: CallTrace, text: str = None, error=None) -> dict:
+    """One flat row per attempt (stage times in ms, NaN where the call never got there)."""
+    m = trace.marks
+    if "done" not in m:
+        trace.mark("done")
+    if "cancelled" in m:
+        outcome = "cancelled"
+    elif error is not None:
+        outcome = classify_error(error)
+    else:
+        outcome = "ok"
+
+    row = {"ts": trace.ts, "uid": trace.uid, "kind": trace.kind, "outcome": outcome, "pooled": trace.pooled}
+    prev = 0.0
+    for stage, end in _STAGE_ENDS:
+        if end in m:
+            row[f"{stage}_ms"] = m[end] - prev
+            prev = m[end]
+        else:
+            row[f"{stage}_ms"] = float("nan")
+    row["total_ms"] = m["done"]
+    row["frames"] = trace.frames
+    row["response_chars"] = len(text) if text is not None else 0
+    for k in TOKEN_FIELDS:
+        v = trace.usage.get(k)
+        row[k] = int(v) if v is not None else None
+    row["error"] = repr(error)[:300] if error is not None else ""
+    return row
+
+
+class Telemetry:
+    """
+    Thread-safe sink for CallTrace rows (shared by worker threads, the event
+    loop and the hedge pool). Keeps the rows in memory for the summary.
+    """
+
+    def __init__(self, path: str = None, prom_path: str = None, port: int = 0, host: str = "127.0.0.1"):
+        self.path = path
+        self.prom_path = prom_path
+        self.rows = []
+        self._lock = threading.Lock()
+        self._fh = open(path, "a", encoding="utf-8") if path and path.lower().endswith(".jsonl") else None
+        self._server = self.serve(port, host) if port else None
+
+    def record(self, trace: CallTrace, text: str = None, error=None):
+        row = trace_row(trace, text, error)
+        with self._lock:
+            self.rows.append(row)
+            if self._fh is not None:
+                self._fh.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+                self._fh.flush()
+
+    def frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame(list(self.rows))
+
+    # ---- summaries
+    def summary(self) -> pd.DataFrame:
+        """Per stage: calls, mean, percentiles and max in ms, over successful attempts."""
+        df = self.frame()
+        out = {}
+        for stage in STAGES:
+            col = f"{stage}_ms"
+            v = df.loc[df["outcome"] == "ok", col].dropna().to_numpy(dtype=float) if len(df) else np.array([])
+            out[stage] = {"n": len(v), "mean_ms": v.mean() if len(v) else float("nan"),
+                          **{f"p{p}_ms": np.percentile(v, p) if len(v) else float("nan") for p in PERCENTILES},
+                          "max_ms": v.max() if len(v) else float("nan")}
+        return pd.DataFrame(out).T
+
+    def histogram(self, stage: str = "total") -> pd.Series:
+        """Successful attempts per latency bucket of `stage` (labels are upper bounds)."""
+        df = self.frame()
+        v = df.loc[df["outcome"] == "ok", f"{stage}_ms"].dropna() / 1000.0 if len(df) else pd.Series(dtype=float)
+        edges = (0.0,) + BUCKETS_SEC + (math.inf,)
+        labels = [f"<={b:g}s" for b in BUCKETS_SEC] + [f">{BUCKETS_SEC[-1]:g}s"]
+        return pd.cut(v, edges, labels=labels, include_lowest=True).value_counts(sort=False)
+
+    def summary_text(self) -> str:
+        df = self.frame()
+        if len(df) == 0:
+            return "[TELEMETRY] no calls recorded"
+        lines = [f"[TELEMETRY] attempts={len(df)} | "
+                 + " ".join(f"{k}={v}" for k, v in df["outcome"].value_counts().items())
+                 + f" | pooled={int(df['pooled'].sum())}"]
+        for stage, r in self.summary().iterrows():
+            lines.append(f"[TELEMETRY] {stage:<11} n={int(r['n']):<6} "
+                         + " ".join(f"p{p}={r[f'p{p}_ms']:.0f}" for p in PERCENTILES)
+                         + f" max={r['max_ms']:.0f} ms")
+        tok = df[list(TOKEN_FIELDS)].apply(pd.to_numeric, errors="coerce")
+        if tok.notna().any().any():
+            lines.append("[TELEMETRY] tokens " + " ".join(f"{k}={int(tok[k].sum()):,}" for k in TOKEN_FIELDS))
+        hist = self.histogram("total")
+        width = max(1, int(hist.max())) if len(hist) else 1
+        for label, n in hist.items():
+            if n:
+                lines.append(f"[TELEMETRY] total {label:>7} {int(n):>6} {'#' * max(1, round(40 * n / width))}")
+        return "\n".join(lines)
+
+    # ---- Prometheus text exposition
+    def prometheus_text(self) -> str:
+        df = self.frame()
+        out = ["# HELP spark_call_stage_seconds Time per stage of a Spark chat attempt (successful attempts).",
+               "# TYPE spark_call_stage_seconds histogram"]
+        ok = df[df["outcome"] == "ok"] if len(df) else df
+        for stage in STAGES:
+            v = np.sort(ok[f"{stage}_ms"].dropna().to_numpy(dtype=float) / 1000.0) if len(ok) else np.array([])
+            for b in BUCKETS_SEC:
+                out.append(f'spark_call_stage_seconds_bucket{{stage="{stage}",le="{b:g}"}} '
+                           f"{int(np.searchsorted(v, b, side='right'))}")
+            out.append(f'spark_call_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {len(v)}')
+            out.append(f'spark_call_stage_seconds_sum{{stage="{stage}"}} {v.sum():.6f}')
+            out.append(f'spark_call_stage_seconds_count{{stage="{stage}"}} {len(v)}')
+
+        out += ["# HELP spark_calls_total Spark chat attempts by outcome.", "# TYPE spark_calls_total counter"]
+        counts = df["outcome"].value_counts() if len(df) else pd.Series(dtype=int)
+        for outcome, n in counts.items():
+            out.append(f'spark_calls_total{{outcome="{outcome}"}} {int(n)}')
+
+        out += ["# HELP spark_tokens_total Tokens reported in the usage block.", "# TYPE spark_tokens_total counter"]
+        for k in TOKEN_FIELDS:
+            n = pd.to_numeric(df[k], errors="coerce").sum() if len(df) else 0
+            out.append(f'spark_tokens_total{{type="{k.replace("_tokens", "")}"}} {int(n)}')
+
+        out += ["# HELP spark_frames_total Response frames received.", "# TYPE spark_frames_total counter",
+                f"spark_frames_total {int(df['frames'].sum()) if len(df) else 0}",
+                "# HELP spark_response_chars_total Characters of response text.",
+                "# TYPE spark_response_chars_total counter",
+                f"spark_response_chars_total {int(df['response_chars'].sum()) if len(df) else 0}"]
+        return "\n".join(out) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """Serve prometheus_text() at http://host:port/metrics on a daemon thread."""
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"[TELEMETRY] metrics at http://{host}:{port}/metrics")
+        return server
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        elif self.path:
+            write_table(self.frame(), self.path)
+        if self.prom_path:
+            with open(self.prom_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+def record_call(telemetry, trace: CallTrace, text: str = None, error=None):
+    """Telemetry.record() when the script has a sink (TELEMETRY is None when telemetry is off)."""
+    if telemetry is not None:
+        telemetry.record(trace, text, error)
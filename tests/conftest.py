@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the pipeline modules live in code/ and are imported by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code"))
@@ -0,0 +1,105 @@
+import random
+import re
+
+import pytest
+
+import kw_automaton
+from kw_automaton import KeywordAutomaton, check_automaton, iter_keywords
+
+KW_DICT = {
+    "refuse": ["not comment", "decline", "no comment", "comment"],
+    "unable": ["don't know", "not sure", "know"],
+    "future": ["going forward", "in the future", "Going Forward"],
+}
+
+
+def reference_find(text, keywords, whole_words=False):
+    """Plain substring scan (kw_logic.find_kw_matches semantics), sorted distinct keywords."""
+    t = str(text).lower()
+    hits = set()
+    for k in keywords:
+        p = k.lower()
+        if whole_words:
+            # a boundary is needed only where the keyword itself starts / ends with a word character
+            pattern = ((r"(?<!\w)" if re.match(r"\w", p) else "") + re.escape(p)
+                       + (r"(?!\w)" if re.match(r"\w", p[-1]) else ""))
+            found = re.search(pattern, t) is not None
+        else:
+            found = p in t
+        if found:
+            hits.add(k)
+    matches = sorted(hits)
+    return bool(matches), matches
+
+
+@pytest.fixture(params=["python", "c"])
+def backend(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(kw_automaton, "ahocorasick", None)
+    elif kw_automaton.ahocorasick is None:
+        pytest.skip("pyahocorasick not installed")
+    return request.param
+
+
+def test_several_matches_sorted_not_dict_order(backend):
+    a = KeywordAutomaton(["not comment", "decline"])
+    assert a.find("We decline and will not comment.") == (True, ["decline", "not comment"])
+
+
+def test_overlapping_and_nested_keywords(backend):
+    a = KeywordAutomaton.from_kw_dict(KW_DICT)
+    match, matches = a.find("I'd rather not comment, no comment, I don't know")
+    assert match
+    assert matches == ["comment", "don't know", "know", "no comment", "not comment"]
+
+
+def test_case_insensitive_and_duplicate_case_forms(backend):
+    a = KeywordAutomaton.from_kw_dict(KW_DICT)
+    assert a.find("GOING FORWARD we expect growth") == (True, ["Going Forward", "going forward"])
+    assert a.find("Revenue grew 5%.") == (False, [])
+
+
+def test_whole_words(backend):
+    a = KeywordAutomaton(["know", "comment"], whole_words=True)
+    assert a.find("the acknowledged commentary") == (False, [])
+    assert a.find("acknowledged, but I know") == (True, ["know"])
+    assert a.find("comment_x comment.") == (True, ["comment"])
+    assert KeywordAutomaton(["know"]).find("acknowledged") == (True, ["know"])
+
+
+def test_matches_reference_on_random_text(backend):
+    rng = random.Random(7)
+    words = ["not", "comment", "decline", "no", "don't", "know", "sure", "going", "forward",
+             "in", "the", "future", "acknowledge", "commentary", "Know", "NOT"]
+    keywords = list(iter_keywords(KW_DICT))
+    for whole_words in (False, True):
+        a = KeywordAutomaton(keywords, whole_words=whole_words)
+        for _ in range(500):
+            text = rng.choice(["", " ", ", "]).join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+            assert a.find(text) == reference_find(text, a.keywords, whole_words), text
+
+
+def test_check_automaton_agrees_with_reference():
+    a = KeywordAutomaton.from_kw_dict(KW_DICT)
+    answers = ["We decline to comment.", "Revenue grew.", "I don't know yet.", "Going forward, yes."] * 50
+    assert check_automaton(a, answers, lambda t: reference_find(t, a.keywords), sample=40, seed=3) is None
+    assert check_automaton(a, answers, lambda t: (False, []), sample=0) is None
+
+
+def test_check_automaton_reports_other_word_rules():
+    # a reference with whole-word rules: "know" inside "acknowledge" only hits the substring automaton
+    a = KeywordAutomaton(["know"])
+    answers = ["I know.", "We acknowledge that."] * 10
+    bad = check_automaton(a, answers, lambda t: reference_find(t, ["know"], whole_words=True), sample=20, seed=0)
+    assert bad == (10, 20, 1)
+    # the same random rows for the same seed
+    assert check_automaton(a, answers, lambda t: reference_find(t, ["know"], True), sample=5, seed=1) == \
+        check_automaton(a, answers, lambda t: reference_find(t, ["know"], True), sample=5, seed=1)
+
+
+def test_matches_kw_logic():
+    kw_logic = pytest.importorskip("kw_logic")
+    a = KeywordAutomaton.from_kw_dict(kw_logic.kw_dict_with_future)
+    for text in ["We will not comment on that going forward.", "No guidance.", "I don't know, not sure."]:
+        match, matches = kw_logic.find_kw_matches(text, kw_dict=kw_logic.kw_dict_with_future)
+        assert a.find(text) == (bool(match), sorted(set(matches or [])))
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from qa_dedup import ExactDedupStream, dedup_clusters, exact_clusters, fan_out, near_clusters
+
+BOILERPLATE = ("we do not provide guidance on individual line items but we can say that the quarter "
+               "was in line with what we laid out at the start of the year and we remain comfortable "
+               "with the full year outlook that we gave")
+
+
+def frame(answers, index=None):
+    return pd.DataFrame({"question": ["Q"] * len(answers), "answer": answers}, index=index)
+
+
+def test_exact_clusters_first_row_is_representative():
+    df = frame(["No comment.", "Yes.", "No comment.", "no comment", "Yes."])
+    assert exact_clusters(df, ["question", "answer"]).tolist() == [0, 1, 0, 3, 1]
+    # normalize: case and punctuation no longer split a cluster
+    assert exact_clusters(df, ["question", "answer"], normalize=True).tolist() == [0, 1, 0, 0, 1]
+
+
+def test_exact_clusters_key_columns_are_separate():
+    # "a b" + "c" must not collide with "a" + "b c"
+    df = pd.DataFrame({"question": ["a b", "a"], "answer": ["c", "b c"]})
+    assert exact_clusters(df, ["question", "answer"]).tolist() == [0, 1]
+
+
+def test_near_clusters_merges_one_word_edits_only():
+    other = "revenue grew double digits in every region and margins expanded for the third straight quarter"
+    df = frame([BOILERPLATE, other, BOILERPLATE + " thanks", BOILERPLATE.upper() + "!", other + " again"])
+    assert near_clusters(df, ["answer"], threshold=0.8).tolist() == [0, 1, 0, 0, 1]
+    # no estimate reaches this threshold: only the normalized-exact merge is left
+    assert near_clusters(df, ["answer"], threshold=1.01).tolist() == [0, 1, 2, 0, 4]
+    with pytest.raises(ValueError):
+        near_clusters(df, ["answer"], num_perm=60, bands=16)
+
+
+def test_dedup_clusters_labels_and_modes():
+    df = frame(["x", "y", "x"], index=[10, 20, 30])
+    assert dedup_clusters(df, ["answer"]).tolist() == [10, 20, 10]
+    assert dedup_clusters(df, ["answer"], mode="none").tolist() == [10, 20, 30]
+    assert dedup_clusters(df.iloc[:0], ["answer"]).tolist() == []
+    with pytest.raises(ValueError):
+        dedup_clusters(df, ["answer"], mode="fuzzy")
+
+
+def test_fan_out_copies_representative_labels():
+    df = frame(["x", "y", "x", "y"], index=[5, 6, 7, 8])
+    df["label"] = [1.0, 0.0, np.nan, np.nan]
+    fan_out(df, dedup_clusters(df, ["answer"]), ["label"])
+    assert df["label"].tolist() == [1.0, 0.0, 1.0, 0.0]
+
+
+def test_stream_matches_batch_exact():
+    answers = ["No comment.", "Yes.", "No comment.", "no comment", "Yes."]
+    for normalize in (False, True):
+        stream = ExactDedupStream(normalize=normalize)
+        got = [stream.add(label, ("Q", a)) for label, a in zip(range(100, 105), answers)]
+        batch = dedup_clusters(frame(answers, index=range(100, 105)), ["question", "answer"], normalize=normalize)
+        assert got == batch.tolist()
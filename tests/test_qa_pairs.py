@@ -0,0 +1,99 @@
+import random
+
+import pandas as pd
+
+from qa_pairs import COMPONENT_COLS, KEYS, MIN_A_LEN, MIN_Q_LEN, MIN_QA_LEN, OUT_COLS, build_pairs, reconstruct_pairs
+
+
+def stata_trim(s):
+    # Stata trim(): leading and trailing blanks (char 32) only
+    return s.strip(" ")
+
+
+def stata_final(components):
+    """
+    Row-by-row emulation of `sample construction code.do` (Clean_Q&A.dta -> Final.dta),
+    before rsort: the qid sum(), the trim(answer[_n-1] + " " + text) chain and the length filter.
+    """
+    rows = [r for r in components.itertuples(index=False)
+            if r.transcriptcomponenttypename in ("Question", "Answer")]
+    rows = sorted(enumerate(rows), key=lambda t: (t[1].cik, t[1].transcriptid, t[0]))  # sort cik transcriptid __seq
+    blocks, qid, last_call = {}, 0, None
+    for _seq, r in rows:
+        if (r.cik, r.transcriptid) != last_call:
+            qid, last_call = 0, (r.cik, r.transcriptid)
+        qid += r.transcriptcomponenttypename == "Question"
+        if qid == 0:
+            continue  # drop if qid==0
+        blocks.setdefault((r.cik, r.transcriptid, qid), []).append(r)
+
+    out = []
+    for (cik, tid, q), block in blocks.items():
+        text = ["" if pd.isna(r.componenttextpreview) else r.componenttextpreview for r in block]
+        question = text[0]  # the block starts with its Question
+        answer = [""] * len(block)
+        for n in range(1, len(block)):
+            if block[n].transcriptcomponenttypename == "Answer":
+                answer[n] = stata_trim(answer[n - 1] + " " + text[n])
+        answer = answer[-1]  # answer[_N]
+        q_len, a_len = len(question), len(answer)
+        if q_len >= MIN_Q_LEN and a_len >= MIN_A_LEN and q_len + a_len >= MIN_QA_LEN:
+            out.append((cik, tid, q, question, answer, q_len, a_len, q_len + a_len))
+    return pd.DataFrame(out, columns=OUT_COLS)
+
+
+def random_components(seed, n_calls=40):
+    rng = random.Random(seed)
+    words = ["guidance", "margin", "we", "don't", "comment", "é", "中文", "Q3", "\t", ""]
+    rows = []
+    for tid in range(n_calls):
+        cik = f"{rng.randint(1, 5):010d}"
+        for _ in range(rng.randint(0, 12)):
+            kind = rng.choice(["Question", "Answer", "Answer", "Presenter Speech", "Operator"])
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+            text = " " * rng.randint(0, 2) + text + " " * rng.randint(0, 2)
+            rows.append((cik, 1000 + tid, kind, None if rng.random() < 0.05 else text))
+    return pd.DataFrame(rows, columns=COMPONENT_COLS)
+
+
+def keyed(df):
+    # Final.dta is rsort-ed and Parquet may store cik as a dictionary: compare sorted plain columns
+    df = df.astype({"cik": str, "question": str, "answer": str,
+                    "qid": "int64", "q_len": "int64", "a_len": "int64", "qa_len": "int64"})
+    return df.sort_values(KEYS).reset_index(drop=True)
+
+
+def test_build_pairs_matches_stata_chain_on_examples():
+    comp = pd.DataFrame([
+        ("1", 7, "Answer", "an answer before any question is dropped with qid 0"),
+        ("1", 7, "Question", "What is the outlook for margins next year?"),
+        ("1", 7, "Answer", "  We expect them, as we said in the prepared remarks,  "),
+        ("1", 7, "Operator", "Next question please."),
+        ("1", 7, "Answer", ""),
+        ("1", 7, "Answer", None),
+        ("1", 7, "Answer", "  to expand.  "),
+        ("1", 7, "Question", "And the dividend policy going forward then?"),
+        ("1", 7, "Answer", "No change to the payout ratio we laid out last year."),
+    ], columns=COMPONENT_COLS)
+    got = build_pairs(comp)
+    assert got["answer"].tolist() == ["We expect them, as we said in the prepared remarks,   to expand.",
+                                      "No change to the payout ratio we laid out last year."]
+    assert keyed(got).equals(keyed(stata_final(comp)))
+
+
+def test_build_pairs_matches_stata_chain_on_random_calls():
+    for seed in range(5):
+        comp = random_components(seed)
+        expected = keyed(stata_final(comp))
+        assert len(expected) > 0
+        assert keyed(build_pairs(comp)).equals(expected), seed
+
+
+def test_reconstruct_in_small_chunks_matches_one_pass(tmp_path):
+    comp = random_components(11)
+    src, dst = tmp_path / "components.parquet", tmp_path / "pairs.parquet"
+    comp.to_parquet(src, index=False)
+    n = reconstruct_pairs(str(src), str(dst), chunk_rows=7)
+    got = pd.read_parquet(dst)
+    assert n == len(got)
+    assert keyed(got).equals(keyed(build_pairs(comp)))
@@ -0,0 +1,72 @@
+import json
+
+from spark_batch import parse_model_json, plan_batches, score_batch, split_batch_response
+
+
+def test_parse_model_json_objects_arrays_and_failures():
+    assert parse_model_json('{"your_classification": 1}') == ({"your_classification": 1}, None, '{"your_classification": 1}')
+    parsed, err, extracted = parse_model_json('Sure! {"assessment": "x", "your_classification": 0} Hope this helps.')
+    assert parsed == {"assessment": "x", "your_classification": 0} and err is None and extracted.startswith("{")
+    # an array with prose around it: the {...} match spans two items, the [...] one parses
+    parsed, err, _ = parse_model_json('Here: [{"pair_id": "p1"}, {"pair_id": "p2"}] done')
+    assert parsed == [{"pair_id": "p1"}, {"pair_id": "p2"}] and err is None
+    assert parse_model_json("  ")[1] == "empty_response"
+    assert parse_model_json("no json here")[1] == "no_json_object_found"
+    assert parse_model_json('{"your_classification": 1')[1] == "no_json_object_found"
+    assert parse_model_json('{"a": 1,}')[1].startswith("json_parse_failed")
+
+
+def test_split_maps_items_back_to_pair_ids():
+    parsed = [
+        {"pair_id": "p2", "assessment": "declines", "your_classification": "1"},
+        {"pair_id": " p1 ", "assessment": "answers", "your_classification": 0},
+    ]
+    got, missing = split_batch_response(parsed, ["p1", "p2"])
+    assert missing == []
+    assert json.loads(got["p1"]) == {"assessment": "answers", "your_classification": 0}
+    assert json.loads(got["p2"]) == {"assessment": "declines", "your_classification": 1}
+
+
+def test_split_requeues_missing_duplicate_and_malformed_items():
+    parsed = [
+        {"pair_id": "p1", "assessment": "first", "your_classification": 1},
+        {"pair_id": "p1", "assessment": "duplicate", "your_classification": 0},
+        {"pair_id": "p2", "assessment": "bad label", "your_classification": "maybe"},
+        {"pair_id": "p9", "assessment": "not asked", "your_classification": 1},
+        "not an object",
+    ]
+    got, missing = split_batch_response(parsed, ["p1", "p2", "p3"])
+    assert list(got) == ["p1"]
+    assert json.loads(got["p1"])["assessment"] == "first"
+    assert missing == ["p2", "p3"]
+
+
+def test_split_unwraps_object_and_rejects_non_json():
+    wrapped = {"results": [{"pair_id": "p1", "assessment": "", "your_classification": 0}]}
+    assert split_batch_response(wrapped, ["p1"])[1] == []
+    # a single one-pair object is read as a one-item array
+    assert list(split_batch_response({"pair_id": "p1", "your_classification": 1}, ["p1"])[0]) == ["p1"]
+    assert split_batch_response(None, ["p1", "p2"]) == ({}, ["p1", "p2"])
+
+
+def test_score_batch_keys_results_and_requeues():
+    rows = [("row7", "Q1?", "A1."), ("row8", "Q2?", "A2.")]
+    prompts = []
+
+    def call(prompt):
+        prompts.append(prompt)
+        return json.dumps([{"pair_id": "p2", "assessment": "x", "your_classification": 1}])
+
+    got, missing, err = score_batch(rows, call, parse_model_json)
+    assert len(prompts) == 1 and "### pair_id: p1" in prompts[0] and "### pair_id: p2" in prompts[0]
+    assert list(got) == ["row8"] and missing == ["row7"] and err is None
+
+    got, missing, err = score_batch(rows, lambda p: "not json", parse_model_json)
+    assert got == {} and missing == ["row7", "row8"] and err == "no_json_object_found"
+
+
+def test_plan_batches_respects_k_and_budget():
+    items = ["a" * 40] * 5
+    assert [len(b) for b in plan_batches(items, 2, 10_000, str)] == [2, 2, 1]
+    # an item over budget on its own still gets a batch of one
+    assert [len(b) for b in plan_batches(["a" * 40_000, "b"], 8, 1_000, str)] == [1, 1]
@@ -0,0 +1,129 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from spark_client import (PROMPT_TEMPLATE_LABEL_FIRST, AdaptiveRateLimiter, HedgePolicy, SparkAPIError,
+                          extract_label, label_seen, label_stop_rule, run_hedged)
+
+
+def test_limiter_additive_increase_up_to_ceiling():
+    lim = AdaptiveRateLimiter(2.0, max_rate=3.0, increase=1.0)
+    lim.on_success()
+    assert lim.rate == pytest.approx(2.5)
+    for _ in range(10):
+        lim.on_success()
+    assert lim.rate == 3.0
+    # starting at the ceiling (the scripts' default) it never goes above the starting pace
+    lim = AdaptiveRateLimiter(4.0, max_rate=4.0)
+    lim.on_success()
+    assert lim.rate == 4.0
+
+
+def test_limiter_multiplicative_decrease_once_per_cooldown():
+    lim = AdaptiveRateLimiter(8.0, min_rate=1.5, decrease=0.5, cooldown_sec=3600)
+    lim.on_error(SparkAPIError(11202, "over QPS limit"))
+    lim.on_error(SparkAPIError(10110, "busy"))  # same burst of throttling: counted, not cut again
+    assert lim.rate == 4.0 and lim.throttled == 2
+
+    lim = AdaptiveRateLimiter(8.0, min_rate=1.5, decrease=0.5, cooldown_sec=0.0)
+    for _ in range(5):
+        lim.on_error(SparkAPIError(11202, "over QPS limit"))
+    assert lim.rate == 1.5  # floor
+
+
+def test_limiter_ignores_other_errors():
+    lim = AdaptiveRateLimiter(8.0)
+    lim.on_error(SparkAPIError(10013, "content filtered"))
+    lim.on_error(TimeoutError("read timed out"))
+    assert lim.rate == 8.0 and lim.throttled == 0
+
+
+def test_limiter_bucket_allows_burst_then_paces():
+    lim = AdaptiveRateLimiter(10.0, burst=2)
+    assert lim._reserve() == 0.0 and lim._reserve() == 0.0
+    assert lim._reserve() == pytest.approx(0.1, abs=0.01)
+    assert lim._reserve() == pytest.approx(0.2, abs=0.01)
+    # a throttle cut also drops the banked tokens
+    lim = AdaptiveRateLimiter(10.0, burst=5, cooldown_sec=0.0)
+    lim.on_error(SparkAPIError(11202, "over QPS limit"))
+    assert lim._reserve() == pytest.approx(0.2, abs=0.01)
+
+
+class SlowThenFast:
+    """attempt() for run_hedged: the first attempt of a call stalls, a duplicate answers at once."""
+
+    def __init__(self, stall_sec=0.2):
+        self.stall_sec = stall_sec
+        self.started = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def new_call(self):
+        n = [0]
+
+        def attempt(on_cancel):
+            with self._lock:
+                n[0] += 1
+                first = n[0] == 1
+                self.started += 1
+            if not first:
+                return "fast"
+            stop = threading.Event()
+
+            def cancel():
+                with self._lock:
+                    self.cancelled += 1
+                stop.set()
+
+            on_cancel(cancel)
+            stop.wait(self.stall_sec)
+            return "slow"
+
+        return attempt
+
+
+def hedge_policy(budget):
+    # percentile 0 of one seeded 10 ms sample: every call is due for a hedge after 10 ms
+    policy = HedgePolicy(percentile=0, budget=budget, min_samples=1, min_delay_sec=0.0)
+    policy.observe(0.01)
+    return policy
+
+
+def test_hedge_budget_caps_duplicates():
+    policy, calls = hedge_policy(0.5), SlowThenFast()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        got = [run_hedged(calls.new_call(), policy, pool) for _ in range(4)]
+    # a duplicate is allowed only while hedges + 1 <= budget * calls: calls 2 and 4
+    assert got == ["slow", "fast", "slow", "fast"]
+    assert (policy.calls, policy.hedges, policy.wins) == (4, 2, 2)
+    assert calls.started == 6 and calls.cancelled == 2  # each losing original was aborted
+
+
+def test_no_hedge_before_min_samples_or_with_zero_budget():
+    calls = SlowThenFast(stall_sec=0.05)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert run_hedged(calls.new_call(), HedgePolicy(budget=1.0, min_samples=5), pool) == "slow"
+        policy = hedge_policy(0.0)
+        assert run_hedged(calls.new_call(), policy, pool) == "slow"
+    assert policy.hedges == 0 and calls.started == 2 and calls.cancelled == 0
+
+
+def test_hedged_call_raises_when_every_attempt_fails():
+    def attempt(on_cancel):
+        raise SparkAPIError(10013, "content filtered")
+
+    policy = hedge_policy(1.0)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with pytest.raises(SparkAPIError):
+            run_hedged(attempt, policy, pool)
+    assert policy.calls == 1 and policy.wins == 0
+
+
+def test_label_first_prompt_and_stop_rule():
+    prompt = PROMPT_TEMPLATE_LABEL_FIRST.format(question="Q?", answer="A.", comments="N/A")
+    assert prompt.index('"your_classification"') < prompt.index('"assessment"')
+    assert label_stop_rule(True, False) is label_seen
+    assert label_stop_rule(True, True) is None and label_stop_rule(False, False) is None
+    assert extract_label('{"your_classification": "1", "assess') == 1
+    assert not label_seen('{"your_classif')
@@ -0,0 +1,95 @@
+import threading
+import time
+
+from spark_retry import RETRY_POLICIES, backoff_sec, run_retry_pass
+
+# fast policies: (attempts, first backoff sec, factor)
+FAST = {"parse": (3, 0.0, 1.0), "timeout": (2, 0.05, 1.0), "network": (2, 0.0, 1.0)}
+
+
+class Recorder:
+    def __init__(self):
+        self.succeeded, self.gave_up = {}, {}
+
+    def on_success(self, key, result):
+        self.succeeded[key] = result
+
+    def on_give_up(self, key, result, error, error_class, attempts):
+        self.gave_up[key] = (result, error_class, attempts)
+
+
+def test_backoff_is_geometric():
+    assert [backoff_sec((3, 2.0, 2.0), n) for n in (1, 2, 3)] == [2.0, 4.0, 8.0]
+    assert RETRY_POLICIES["auth"][0] == 0
+
+
+def test_success_after_transient_failures():
+    calls = []
+
+    def work(payload):
+        calls.append(payload)
+        return (f"ok-{payload}", None) if len(calls) >= 2 else ("half", "not json")
+
+    rec = Recorder()
+    lost = run_retry_pass([("k", "row1", "not json")], work, 2, rec.on_success, rec.on_give_up, FAST)
+    assert lost == {} and rec.succeeded == {"k": "ok-row1"} and calls == ["row1", "row1"]
+
+
+def test_gives_up_after_policy_attempts_with_last_result():
+    rec = Recorder()
+    lost = run_retry_pass([("k", 1, "not json")], lambda p: ("bad", "still not json"), 1,
+                          rec.on_success, rec.on_give_up, FAST)
+    assert lost == {"parse": 1}
+    assert rec.gave_up == {"k": ("bad", "parse", 3)}
+
+
+def test_auth_errors_are_not_retried():
+    calls = []
+    rec = Recorder()
+    lost = run_retry_pass([("k", 1, "call_failed: Handshake status 401 Unauthorized")],
+                          lambda p: calls.append(p), 1, rec.on_success, rec.on_give_up, FAST)
+    assert calls == [] and lost == {"auth": 1} and rec.gave_up == {"k": (None, "auth", 0)}
+
+
+def test_due_time_orders_rows_not_input_order():
+    order = []
+
+    def work(payload):
+        order.append(payload)
+        return payload, None
+
+    items = [("slow", "timeout-row", "call_failed: read timed out"), ("fast", "parse-row", "not json")]
+    run_retry_pass(items, work, 1, Recorder().on_success, Recorder().on_give_up, FAST)
+    assert order == ["parse-row", "timeout-row"]
+
+
+def test_exceptions_are_classified_and_reclassified():
+    # the first attempt raises a network error, the second a timeout whose policy is exhausted
+    errors = iter([ConnectionResetError("reset by peer"), TimeoutError("timed out")])
+
+    def work(payload):
+        raise next(errors)
+
+    rec = Recorder()
+    lost = run_retry_pass([("k", 1, "call_failed: connection closed")], work, 1,
+                          rec.on_success, rec.on_give_up, FAST)
+    assert lost == {"timeout": 1} and rec.gave_up["k"][1:] == ("timeout", 2)
+
+
+def test_never_more_than_workers_in_flight():
+    lock = threading.Lock()
+    running, peak = 0, 0
+
+    def work(payload):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+        return payload, None
+
+    rec = Recorder()
+    run_retry_pass([(n, n, "not json") for n in range(12)], work, 3, rec.on_success, rec.on_give_up, FAST)
+    assert sorted(rec.succeeded) == list(range(12)) and peak <= 3
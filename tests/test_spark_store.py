@@ -0,0 +1,34 @@
+import pandas as pd
+
+from spark_store import PromptCache, ResponseCache, ResultJournal, cache_key
+
+
+def test_prompt_cache_keys_by_settings_and_stores_replayable_only(tmp_path):
+    responses = ResponseCache(str(tmp_path / "cache.sqlite"))
+    cache = PromptCache(responses, "wss://spark", "generalv3", 0.2, 1024, "1",
+                        replayable=lambda raw: raw.startswith("{"))
+    key, raw = cache.lookup("prompt A")
+    assert key == cache_key("prompt A", "wss://spark", "generalv3", 0.2, 1024, "1") and raw is None
+
+    cache.store(key, "cut off")
+    assert not cache.contains("prompt A")
+    cache.store(key, '{"your_classification": 1}')
+    assert cache.contains("prompt A") and cache.lookup("prompt A")[1] == '{"your_classification": 1}'
+
+    # a different prompt version is a different key
+    bumped = PromptCache(responses, "wss://spark", "generalv3", 0.2, 1024, "2")
+    assert bumped.lookup("prompt A")[1] is None
+    assert (responses.hits, responses.misses) == (1, 2)
+    responses.close()
+
+
+def test_prompt_cache_off():
+    cache = PromptCache(None, "wss://spark", "generalv3", 0.2, 1024, "1")
+    assert cache.lookup("prompt A") == (None, None) and not cache.contains("prompt A")
+    cache.store(None, "{}")
+
+
+def test_row_key_uses_qid_when_present():
+    df = pd.DataFrame({"transcriptid": [7, 7], "qid": [1, 2]}, index=[10, 11])
+    assert ResultJournal.row_key(df, 11) == "7|2"
+    assert ResultJournal.row_key(df.drop(columns="qid"), 11) == "7|11"